@@ -57,6 +57,11 @@ setup(
         "Pillow<7.0.0",  # monetate.retailer.models - monetate.retailer.creative, dropped python 2.7 support in 7.0.0
     ],
     extras_require={
+        # in process pair counts of small collab jobs, see pair_counts.py
+        "sparse": [
+            "numpy<1.17",  # dropped python 2.7 support in 1.17
+            "scipy<1.3",  # dropped python 2.7 support in 1.3
+        ],
         "test": [
             "mock>=2.0,<2.1",
             "monetate-s3",
@@ -0,0 +1,115 @@
+"""
+Concurrent Account Pipelines
+============================
+
+Runs the independent per-account work of a precompute job (building metric tables, ranking, unloading) at the same
+time instead of one account after the other, so a job for a multi-account retailer takes about as long as its slowest
+account.
+
+  - Every pipeline runs on its own SQLAlchemy connection, but all of them share the DBAPI connection of the job, i.e.
+    one warehouse session. Snowflake runs the statements of several cursors of a session concurrently, and the python
+    connector's connections are thread safe, so the pipelines see the temp tables the job created earlier (metric and
+    pid rank tables) without copying them to permanent or transient tables. Statements of the pipelines are reported
+    to the listeners of the job's engine, so a WarehouseSession still drops the temp tables they create.
+  - At most ACCOUNT_CONCURRENCY pipelines run at once (RECS_PRECOMPUTE_ACCOUNT_CONCURRENCY). With the default of 1 the
+    pipelines run in order on the job's own connection, as before.
+  - Stage timings of the pipelines are added to the job's StageTimer, so with concurrency they add up to more than the
+    job's wall time.
+
+Usage
+-----
+    pipelines = [functools.partial(unload_recset_account, recset=recset, account_id=account_id, ...), ...]
+    result_counts = run_account_pipelines(warehouse_conn, pipelines)
+"""
+
+import contextlib
+import os
+import sys
+import threading
+
+import six
+from django.conf import settings
+from django.db import connections
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
+
+from .precompute_history import current_stage_timer
+
+ACCOUNT_CONCURRENCY = int(getattr(settings, 'RECS_PRECOMPUTE_ACCOUNT_CONCURRENCY',
+                                  os.environ.get('RECS_PRECOMPUTE_ACCOUNT_CONCURRENCY', 1)))
+
+
+def get_session_engine(conn):
+    """
+    Return an engine whose connections all use the DBAPI connection of conn, and so its warehouse session. The engine
+    must not be disposed, since that would close the job's connection.
+    """
+    dbapi_conn = conn.connection.connection
+    engine = create_engine(conn.engine.url, poolclass=StaticPool, creator=lambda: dbapi_conn,
+                           pool_reset_on_return=None)
+
+    def forward_cursor_execute(*args):
+        conn.engine.dispatch.before_cursor_execute(*args)
+
+    event.listen(engine, 'before_cursor_execute', forward_cursor_execute)
+    return engine
+
+
+def run_account_pipelines(conn, pipelines, concurrency=None):
+    """
+    Call every pipeline with a connection to the warehouse session of conn, running up to concurrency of them at once.
+    The first exception raised by a pipeline is raised once the running pipelines finish; pipelines not started yet
+    are skipped.
+
+    :param conn: The job's warehouse connection.
+    :param pipelines: Callables taking a connection, e.g. functools.partial of a per-account function.
+    :param concurrency: Defaults to ACCOUNT_CONCURRENCY.
+    :return: the results of the pipelines, in order
+    """
+    concurrency = min(ACCOUNT_CONCURRENCY if concurrency is None else concurrency, len(pipelines))
+    if concurrency <= 1:
+        return [pipeline(conn) for pipeline in pipelines]
+
+    engine = get_session_engine(conn)
+    timer = current_stage_timer()
+    pending = list(enumerate(pipelines))
+    results = [None] * len(pipelines)
+    errors = []
+    lock = threading.Lock()
+
+    def next_pipeline():
+        with lock:
+            if errors or not pending:
+                return None, None
+            return pending.pop(0)
+
+    def run():
+        try:
+            with contextlib.closing(engine.connect()) as pipeline_conn:
+                index, pipeline = next_pipeline()
+                while pipeline is not None:
+                    try:
+                        if timer is not None:
+                            with timer.activate():
+                                results[index] = pipeline(pipeline_conn)
+                        else:
+                            results[index] = pipeline(pipeline_conn)
+                    except Exception:
+                        with lock:
+                            errors.append(sys.exc_info())
+                    index, pipeline = next_pipeline()
+        except Exception:
+            with lock:
+                errors.append(sys.exc_info())
+        finally:
+            # config db connections are per thread
+            connections.close_all()
+
+    threads = [threading.Thread(target=run) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        six.reraise(*errors[0])
+    return results
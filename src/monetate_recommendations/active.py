@@ -34,8 +34,7 @@ import contextlib
 import datetime
 from django.db import connection
 
-RECENT_INPUT_COUNT = """
-SELECT count(*)
+RECENT_INPUTS = """
 FROM recs_recommendationset recs
 JOIN action_actioninput ri ON recs.id = ri.int_value
 JOIN action_actioninput pi ON ri.action_id = pi.action_id  /* parent list or dict */
@@ -49,7 +48,16 @@ WHERE ((ri.name IN ('recset_id', 'strategy_id') AND /* single row join */ pi.lft
   AND ((cg.last_modified_time > (now() - INTERVAL 30 DAY)) OR
        (cg.active = 1 AND (cg.end_time IS NULL OR cg.end_time > (now() - INTERVAL 30 DAY))) OR
        (cg.campaign_type = 'email_exp') /* email recommendation experiences are never active */)
-  AND recs.id = %s
+"""
+
+RECENT_INPUT_COUNT = """
+SELECT count(*)""" + RECENT_INPUTS + """  AND recs.id = %s
+"""
+
+RECENT_INPUT_COUNTS = """
+SELECT recs.id, count(*)""" + RECENT_INPUTS + """GROUP BY recs.id
+ORDER BY count(*) DESC
+LIMIT %s
 """
 
 
@@ -82,10 +90,31 @@ def is_strategy_active(rs):
 
     # strategy referenced by non archived experience modified in the past 30 days
     # strategy referenced by non archived experience active in past 30 days
+    if get_recent_input_count(rs) > 0:
+        return True
+
+    return False
+
+
+def get_recent_input_count(rs):
+    """
+    Number of experience inputs referencing the strategy from non archived experiences that were modified or active
+    in the past 30 days (or are email recommendation experiences).
+
+    :param rs: RecommendationSet
+    :return: int
+    """
     with contextlib.closing(connection.cursor()) as cursor:
         cursor.execute(RECENT_INPUT_COUNT, [rs.id])
-        count = cursor.fetchone()[0]
-        if count > 0:
-            return True
+        return cursor.fetchone()[0]
 
-    return False
+
+def get_recent_input_counts(limit):
+    """
+    get_recent_input_count of the limit strategies with the most recent experience inputs, in one query.
+
+    :return: dict of RecommendationSet id to input count
+    """
+    with contextlib.closing(connection.cursor()) as cursor:
+        cursor.execute(RECENT_INPUT_COUNTS, [limit])
+        return dict(cursor.fetchall())
@@ -0,0 +1,238 @@
+"""
+Catalog Snapshots
+=================
+
+Materializes the latest catalog of a retailer's catalog once per warehouse session, so that the rank builds of a job
+(and of later jobs on a reused WarehouseSession) read a temp table holding only that catalog's current rows, instead
+of each scanning product_catalog and joining it to config_dataset_data_expiration.
+
+  - A snapshot holds the rows of the catalog updated since the dataset's expiration cutoff, i.e. what the
+    latest_catalog of SKU_RANKS_BY_RECSET and SKU_RANKS_BY_COLLAB_RECSET used to select.
+  - A snapshot is keyed by the catalog's max update_time and expiration cutoff. get_catalog_snapshot reads that
+    version (one column of the catalog's partitions) on every call and rebuilds the snapshot when it changed, so a
+    catalog import between jobs is picked up by the next job.
+  - get_reduced_catalog also caches the representative skus a noncollab recset is ranked over (at most 50 visually
+    distinct skus per item group passing its filters) per snapshot version and filter fingerprint, so recsets and
+    accounts with the same filters share one reduction. Hits and misses are counted per session and logged by the
+    precompute functions with pop_reduced_catalog_stats.
+  - Snapshots and reduced catalogs are not dropped by WarehouseSession cleanup (see SESSION_TEMP_TABLE_RE) and live
+    as long as their session. At most SNAPSHOTS_PER_SESSION and REDUCED_CATALOGS_PER_SESSION are kept per session;
+    the least recently used ones are dropped first.
+  - With RECS_CATALOG_SNAPSHOTS off, get_catalog_snapshot returns a subquery reading product_catalog, as before, and
+    reduced catalogs are rebuilt on every call.
+
+Usage
+-----
+    latest_catalog = get_catalog_snapshot(warehouse_conn, retailer_id, catalog_id)
+    reduced_catalog = get_reduced_catalog(warehouse_conn, retailer_id, catalog_id, early_filter_sql, late_filter_sql,
+                                          filter_variables)
+    warehouse_conn.execute(text(SKU_RANKS_BY_RECSET.format(latest_catalog=latest_catalog,
+                                                           reduced_catalog=reduced_catalog, ...)), ...)
+    hits, misses = pop_reduced_catalog_stats(warehouse_conn)
+"""
+
+import collections
+import hashlib
+import json
+import os
+import threading
+import weakref
+
+from django.conf import settings
+from monetate_monitoring import log
+from sqlalchemy.sql import text
+
+from .precompute_history import job_stage
+
+CATALOG_SNAPSHOTS = getattr(settings, 'RECS_CATALOG_SNAPSHOTS',
+                            os.environ.get('RECS_CATALOG_SNAPSHOTS', 'true').lower() == 'true')
+SNAPSHOTS_PER_SESSION = int(getattr(settings, 'RECS_CATALOG_SNAPSHOTS_PER_SESSION',
+                                    os.environ.get('RECS_CATALOG_SNAPSHOTS_PER_SESSION', 8)))
+REDUCED_CATALOGS_PER_SESSION = int(getattr(settings, 'RECS_REDUCED_CATALOGS_PER_SESSION',
+                                           os.environ.get('RECS_REDUCED_CATALOGS_PER_SESSION', 32)))
+
+LATEST_CATALOG = """
+SELECT pc.* FROM product_catalog as pc
+JOIN config_dataset_data_expiration e
+    ON pc.dataset_id = e.dataset_id
+WHERE pc.retailer_id = {retailer_id} AND pc.dataset_id = {catalog_id}
+    AND pc.update_time >= e.cutoff_time
+"""
+
+CATALOG_VERSION = """
+SELECT
+    (SELECT MAX(update_time) FROM product_catalog WHERE retailer_id = :retailer_id AND dataset_id = :catalog_id),
+    (SELECT MAX(cutoff_time) FROM config_dataset_data_expiration WHERE dataset_id = :catalog_id)
+"""
+
+CATALOG_SNAPSHOT = """
+CREATE OR REPLACE TEMPORARY TABLE {table} AS
+{latest_catalog}
+"""
+
+REDUCED_CATALOG = """
+CREATE OR REPLACE TEMPORARY TABLE {table} AS
+WITH
+filtered_catalog AS (
+SELECT *
+FROM {latest_catalog} as lc
+{early_filter}
+)
+/*
+    Reduce catalog to representative visually distinct items by (image link, color) per item group
+    Limit to at most 50 representative items per item group for later post filtering.
+*/
+SELECT
+    item_group_id,
+    id
+FROM (
+    SELECT
+        item_group_id,
+        id,
+        ROW_NUMBER() OVER (PARTITION by item_group_id ORDER BY id DESC) AS ordinal
+    FROM (
+        SELECT
+            c.item_group_id,
+            c.image_link,
+            c.color,
+            /* Flatten, trim extra spaces, and convert back to string for filtering */
+            array_to_string(array_agg(TRIM(split_product_type.value::string, ' ')), ',') as product_type,
+            MAX(c.id) AS id
+        FROM filtered_catalog as c,
+        LATERAL FLATTEN(input=>split(c.product_type, ',')) split_product_type
+        GROUP BY 1, 2, 3
+    )
+    {late_filter}
+)
+WHERE ordinal <= 50
+"""
+
+# DBAPI connection (i.e. warehouse session) -> SessionCatalogs
+_sessions = weakref.WeakKeyDictionary()
+_sessions_lock = threading.Lock()
+
+
+class SessionCatalogs(object):
+    """The catalog tables kept in one warehouse session, with the version of the catalog each was built from."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (retailer_id, catalog_id) -> version
+        self.snapshots = collections.OrderedDict()
+        # ((retailer_id, catalog_id), filter fingerprint) -> version
+        self.reduced_catalogs = collections.OrderedDict()
+        self.reduced_catalog_hits = 0
+        self.reduced_catalog_misses = 0
+
+
+def get_snapshot_table(retailer_id, catalog_id):
+    return 'scratch.catalog_snapshot_{}_{}'.format(int(retailer_id), int(catalog_id))
+
+
+def get_reduced_catalog_table(retailer_id, catalog_id, fingerprint):
+    return 'scratch.reduced_catalog_{}_{}_{}'.format(int(retailer_id), int(catalog_id), fingerprint)
+
+
+def get_latest_catalog_query(retailer_id, catalog_id):
+    return LATEST_CATALOG.format(retailer_id=int(retailer_id), catalog_id=int(catalog_id))
+
+
+def get_filter_fingerprint(early_filter_sql, late_filter_sql, filter_variables):
+    """
+    Hash filters to a key that is the same for equal filters, whatever their whitespace or the order of their
+    variables.
+    """
+    canonical = json.dumps([' '.join(early_filter_sql.split()), ' '.join(late_filter_sql.split()),
+                            sorted(filter_variables.items())], sort_keys=True, default=str)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:16]
+
+
+def get_session_catalogs(conn):
+    with _sessions_lock:
+        dbapi_conn = conn.connection.connection
+        if dbapi_conn not in _sessions:
+            _sessions[dbapi_conn] = SessionCatalogs()
+        return _sessions[dbapi_conn]
+
+
+def _use(tables, key, version):
+    """Mark a cached table as most recently used; return False if it is missing or of another version."""
+    if key not in tables or tables[key] != version:
+        return False
+    tables[key] = tables.pop(key)
+    return True
+
+
+def _add(conn, tables, key, version, max_tables, get_table):
+    """Record a table built at version, dropping the least recently used tables beyond max_tables."""
+    tables.pop(key, None)
+    tables[key] = version
+    while len(tables) > max_tables:
+        evicted, _ = tables.popitem(last=False)
+        conn.execute("DROP TABLE IF EXISTS {}".format(get_table(evicted)))
+
+
+def get_catalog_snapshot(conn, retailer_id, catalog_id):
+    """
+    Return the table holding the latest catalog of a retailer's catalog in conn's warehouse session, building it if
+    the session has no snapshot of the catalog's current version.
+
+    :return: a table name, or a parenthesized subquery with RECS_CATALOG_SNAPSHOTS off; either can follow FROM
+    """
+    if not CATALOG_SNAPSHOTS:
+        return '({})'.format(get_latest_catalog_query(retailer_id, catalog_id))
+    key = (int(retailer_id), int(catalog_id))
+    table = get_snapshot_table(*key)
+    catalogs = get_session_catalogs(conn)
+    with catalogs.lock:
+        row = conn.execute(text(CATALOG_VERSION), retailer_id=key[0], catalog_id=key[1]).first()
+        version = tuple(row) if row else None
+        if _use(catalogs.snapshots, key, version):
+            return table
+        with job_stage('catalog'):
+            conn.execute(text(CATALOG_SNAPSHOT.format(table=table,
+                                                      latest_catalog=get_latest_catalog_query(*key))))
+        log.log_info('Built catalog snapshot {} at version {}'.format(table, version))
+        _add(conn, catalogs.snapshots, key, version, SNAPSHOTS_PER_SESSION,
+             lambda evicted: get_snapshot_table(*evicted))
+    return table
+
+
+def get_reduced_catalog(conn, retailer_id, catalog_id, early_filter_sql, late_filter_sql, filter_variables):
+    """
+    Return the table of representative skus (item_group_id, id) of a retailer's catalog passing a recset's filters,
+    building it unless the session has one for the same filters and snapshot version.
+
+    :param early_filter_sql: 'WHERE ...' on the catalog rows (alias lc), or ''
+    :param late_filter_sql: 'WHERE ...' on the (item group, image, color) representatives, or ''
+    :param filter_variables: The bind variables of both filters
+    """
+    key = (int(retailer_id), int(catalog_id))
+    fingerprint = get_filter_fingerprint(early_filter_sql, late_filter_sql, filter_variables)
+    table = get_reduced_catalog_table(key[0], key[1], fingerprint)
+    latest_catalog = get_catalog_snapshot(conn, *key)
+    catalogs = get_session_catalogs(conn)
+    with catalogs.lock:
+        version = catalogs.snapshots.get(key) if CATALOG_SNAPSHOTS else None
+        if CATALOG_SNAPSHOTS and _use(catalogs.reduced_catalogs, (key, fingerprint), version):
+            catalogs.reduced_catalog_hits += 1
+            return table
+        catalogs.reduced_catalog_misses += 1
+        with job_stage('catalog'):
+            conn.execute(text(REDUCED_CATALOG.format(table=table,
+                                                     latest_catalog=latest_catalog,
+                                                     early_filter=early_filter_sql,
+                                                     late_filter=late_filter_sql)),
+                         **filter_variables)
+        _add(conn, catalogs.reduced_catalogs, (key, fingerprint), version, REDUCED_CATALOGS_PER_SESSION,
+             lambda evicted: get_reduced_catalog_table(evicted[0][0], evicted[0][1], evicted[1]))
+    return table
+
+
+def pop_reduced_catalog_stats(conn):
+    """Return (hits, misses) of get_reduced_catalog in conn's session since the last call, and reset them."""
+    catalogs = get_session_catalogs(conn)
+    with catalogs.lock:
+        stats = catalogs.reduced_catalog_hits, catalogs.reduced_catalog_misses
+        catalogs.reduced_catalog_hits = catalogs.reduced_catalog_misses = 0
+    return stats
@@ -0,0 +1,103 @@
+import threading
+import time
+
+import monetate.recs.precompute_constants as precompute_constants
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+from monetate.recs.models import PrecomputeQueue
+
+from monetate_recommendations.precompute_worker import PrecomputeWorker, supports_skip_locked
+
+# Rows created by this command use an algorithm no worker processes, so real workers never claim them and
+# the benchmark never claims real work.
+BENCHMARK_ALGORITHM = 'benchmark_claims'
+
+
+class Command(BaseCommand):
+    help = ("Measure PrecomputeQueue claim throughput with many concurrent workers. Point the config db at a local "
+            "MySQL (or SQLite stand-in) before running; rows are created and deleted by the command.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000, help='Number of pending queue rows to claim')
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16],
+                            help='Worker counts to benchmark')
+        parser.add_argument('--batch-size', type=int, default=1, help='Rows claimed per claim call')
+        parser.add_argument('--modes', nargs='+', default=['locking', 'optimistic'],
+                            choices=['locking', 'optimistic'], help='Claim paths to benchmark')
+
+    def handle(self, *args, **options):
+        db_connection = connections[PrecomputeQueue.objects.db]
+        if 'locking' in options['modes'] and not supports_skip_locked(db_connection):
+            print('{} does not support SKIP LOCKED; "locking" mode uses the optimistic fallback'.format(
+                db_connection.vendor))
+        print('mode        workers  claims  seconds  claims/sec  p50 ms  p95 ms  empty claims')
+        for mode in options['modes']:
+            for n_workers in options['workers']:
+                self.create_rows(options['rows'])
+                try:
+                    self.report(mode, n_workers, *self.run(mode, n_workers, options['batch_size']))
+                finally:
+                    PrecomputeQueue.objects.filter(algorithm=BENCHMARK_ALGORITHM).delete()
+
+    def create_rows(self, n_rows):
+        PrecomputeQueue.objects.bulk_create([
+            PrecomputeQueue(
+                account=None,
+                market=None,
+                retailer=None,
+                algorithm=BENCHMARK_ALGORITHM,
+                lookback_days=i,
+                purchase_data_source='online',
+                status=precompute_constants.STATUS_PENDING,
+                process_complete=False,
+                products_returned=0,
+                attempts=0,
+                precompute_enqueue_time=timezone.now(),
+            ) for i in range(n_rows)
+        ])
+
+    def run(self, mode, n_workers, batch_size):
+        latencies = []
+        claimed_ids = []
+        empty_claims = [0]
+        lock = threading.Lock()
+
+        def claim_until_empty():
+            worker = PrecomputeWorker(use_combined_queue=True)
+            while True:
+                recs_qs = worker.query_recommendations().filter(algorithm=BENCHMARK_ALGORITHM)
+                start = time.time()
+                if mode == 'locking':
+                    claimed = worker.claim_recommendations(recs_qs, batch_size)
+                else:
+                    rec = worker.claim_recommendation_optimistic(recs_qs)
+                    claimed = [rec] if rec is not None else []
+                elapsed = time.time() - start
+                with lock:
+                    latencies.append(elapsed)
+                    claimed_ids.extend(rec.id for rec in claimed)
+                    if not claimed:
+                        empty_claims[0] += 1
+                if not claimed and not recs_qs.exists():
+                    break
+            connections.close_all()
+
+        threads = [threading.Thread(target=claim_until_empty) for _ in range(n_workers)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        if len(claimed_ids) != len(set(claimed_ids)):
+            raise AssertionError('{} claimed the same row more than once'.format(mode))
+        return len(claimed_ids), elapsed, sorted(latencies), empty_claims[0]
+
+    def report(self, mode, n_workers, n_claimed, elapsed, latencies, empty_claims):
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0
+
+        print('{:<10}  {:>7}  {:>6}  {:>7.2f}  {:>10.1f}  {:>6.1f}  {:>6.1f}  {:>12}'.format(
+            mode, n_workers, n_claimed, elapsed, n_claimed / elapsed if elapsed else 0,
+            percentile(0.5), percentile(0.95), empty_claims))
@@ -0,0 +1,65 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from sqlalchemy.sql import text
+
+from monetate_recommendations import precompute_utils
+from monetate_recommendations.precompute_view_associated_pids import DEVICE_EARLIEST_PRODUCT_VIEW, \
+    GET_EARLIEST_VIEW_PER_MID_AND_PID, VIEW_ALSO_VIEW, get_device_view_limit
+from monetate_recommendations.warehouse_session import warehouse_connection
+
+# devices, device views and the device level pairs VIEW_ALSO_VIEW joins, before pairs seen on one device are dropped
+DEVICE_PAIRS = """
+SELECT COUNT(*), COALESCE(SUM(views), 0), COALESCE(SUM(views * (views - 1) / 2), 0)
+FROM (
+    SELECT COUNT(*) views
+    FROM scratch.earliest_view_per_mid_and_pid_{table_key}_None_None_{lookback_days}
+    GROUP BY account_id, mid_epoch, mid_ts, mid_rnd
+)
+"""
+
+PAIRS = """
+SELECT COUNT(*) FROM scratch.view_also_view_{table_key}_None_None_{lookback_days}_online
+"""
+
+
+class Command(BaseCommand):
+    help = ("Measure view_also_view pair generation for accounts with different per device view caps "
+            "(RECS_VAV_DEVICE_VIEW_CAP). Only temp tables are created; nothing is unloaded.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--account-ids', type=int, nargs='+', required=True, help='Accounts to read views of')
+        parser.add_argument('--lookback-days', type=int, default=30)
+        parser.add_argument('--caps', type=int, nargs='+', default=[0, 500, 200, 100],
+                            help='Device view caps to benchmark, 0 for no cap')
+        parser.add_argument('--sampling', default='recent', choices=['recent', 'sample'],
+                            help='Products kept of capped devices')
+
+    def handle(self, *args, **options):
+        lookback_days = options['lookback_days']
+        begin_fact_time, end_fact_time = precompute_utils.get_fact_time(lookback_days)
+        print('cap    devices  device views  device pairs   pair rows  views secs  pairs secs')
+        with warehouse_connection(getattr(settings, 'RECS_COLLAB_QUERY_WH',
+                                          os.environ.get('RECS_COLLAB_QUERY_WH', 'QUERY4_WH'))) as conn:
+            for cap in options['caps']:
+                table_key = 'benchmark{}'.format(cap)
+                start = time.time()
+                conn.execute(text(GET_EARLIEST_VIEW_PER_MID_AND_PID.format(
+                    device_products=DEVICE_EARLIEST_PRODUCT_VIEW, account_id=table_key, market_id=None, retailer_id=None, lookback_days=lookback_days,
+                    device_view_limit=get_device_view_limit(options['account_ids'], cap=cap, cap_by_account={},
+                                                            sampling=options['sampling']))),
+                    account_ids=options['account_ids'], begin_fact_time=begin_fact_time,
+                    end_fact_time=end_fact_time, lookback=lookback_days)
+                views_seconds = time.time() - start
+                start = time.time()
+                conn.execute(text(VIEW_ALSO_VIEW.format(algorithm='view_also_view', account_id=table_key,
+                                                        market_id=None, retailer_id=None,
+                                                        lookback_days=lookback_days, purchase_data_source='online')))
+                pairs_seconds = time.time() - start
+                devices, views, device_pairs = conn.execute(
+                    DEVICE_PAIRS.format(table_key=table_key, lookback_days=lookback_days)).first()
+                pairs = conn.execute(PAIRS.format(table_key=table_key, lookback_days=lookback_days)).scalar()
+                print('{:<5}  {:>7}  {:>12}  {:>12}  {:>10}  {:>10.2f}  {:>10.2f}'.format(
+                    cap or '-', devices, views, int(device_pairs), pairs, views_seconds, pairs_seconds))
@@ -4,6 +4,8 @@ from django.db.models import Q
 from monetate.recs.models import RecommendationSet, RecommendationsPrecompute
 from monetate.retailer.models import Account
 
+from monetate_recommendations.precompute_wakeup import notify_workers
+
 
 class Command(BaseCommand):
     def add_arguments(self, parser):
@@ -42,3 +44,5 @@ class Command(BaseCommand):
             recsets_enqueued.append(recset.id)
 
         print('enqueued recsets: {}'.format(recsets_enqueued))
+        if recsets_enqueued:
+            notify_workers()
@@ -9,6 +9,7 @@ from django.utils import timezone
 from monetate_monitoring import log
 
 from monetate_recommendations.active import is_strategy_active
+from monetate_recommendations.precompute_wakeup import notify_workers
 
 log.configure_script_log('enqueue_stale_recsets')
 
@@ -17,6 +18,9 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--hours', default=24, dest='hours', nargs='+',
                             help='Number of hours before a recset is considered stale', type=int)
+        parser.add_argument('--noncollab-combined-queue', action='store_true', dest='noncollab_combined_queue',
+                            help='Enqueue noncollab recsets to the combined queue (PrecomputeQueue) instead of '
+                                 'RecommendationsPrecompute, so recsets sharing metric tables are processed together')
 
     def get_account(self, recset, account=None):
         # anytime a recset has a market, account_id should be None
@@ -28,7 +32,7 @@ class Command(BaseCommand):
         # if not market but retailer level, return the account_id of current account
         return account
 
-    def enqueue_precompute_collab(self, recset, account=None):
+    def enqueue_precompute_queue(self, recset, account=None):
         try:
             _, created = recs_models.PrecomputeQueue.objects.get_or_create(
                 account=self.get_account(recset, account),
@@ -51,6 +55,19 @@ class Command(BaseCommand):
         except MultipleObjectsReturned:
             log.log_exception('Multiple objects returned for recset {}'.format(recset.id))
 
+    def enqueue_recset_queue_entries(self, recset, feature):
+        """Enqueue the PrecomputeQueue entries of a recset and return the number created."""
+        # if retailer level and not market, need to create a queue entry for each account
+        if recset.is_retailer_tenanted and not recset.is_market_or_retailer_driven_ds:
+            account_ids = \
+                retailer_models.Account.objects.filter(retailer_id=recset.retailer_id,
+                                                       accountfeature__feature_flag__name=feature,
+                                                       archived=False)
+            created = [self.enqueue_precompute_queue(recset, account_id) for account_id in account_ids]
+        else:
+            created = [self.enqueue_precompute_queue(recset)]
+        return len([entry for entry in created if entry])
+
     def handle(self, *args, **options):
         hours = options.get('hours', 24)
         stale_time = datetime.datetime.now() - datetime.timedelta(hours=hours)
@@ -70,10 +87,14 @@ class Command(BaseCommand):
 
         updated_recsets = []
         created_recsets = []
+        created_noncollab_queue_entries = 0
         for recset in precompute_recsets:
             if not is_strategy_active(recset):
                 log.log_info('skip inactive strategy {}'.format(recset.id))
                 continue
+            if options.get('noncollab_combined_queue'):
+                created_noncollab_queue_entries += self.enqueue_recset_queue_entries(recset, precompute_feature)
+                continue
             precompute_recsets_status = recs_models.RecommendationsPrecompute.objects.filter(recset=recset).defer('status_log')
             heartbeat_threshold = 300
             heartbeat_old_time = timezone.now() - datetime.timedelta(seconds=heartbeat_threshold)
@@ -107,6 +128,9 @@ class Command(BaseCommand):
                 created_recsets.append(precompute_recset_status.recset.id)
         log.log_info('stale precompute entries updated: {}'.format(updated_recsets))
         log.log_info('new precompute entries created: {}'.format(created_recsets))
+        if options.get('noncollab_combined_queue'):
+            log.log_info('Number of noncollab precompute combined queue entries created: {}'.format(
+                created_noncollab_queue_entries))
 
         # enqueue precompute collab
         precompute_collab_feature = retailer_models.ACCOUNT_FEATURES.ENABLE_COLLAB_RECS_PRECOMPUTE_MODELING
@@ -128,18 +152,7 @@ class Command(BaseCommand):
             if not is_strategy_active(recset):
                 log.log_info('skip inactive strategy {}'.format(recset.id))
                 continue
-            # if retailer level and not market, need to create a queue entry for each account
-            if recset.is_retailer_tenanted and not recset.is_market_or_retailer_driven_ds:
-                account_ids = \
-                    retailer_models.Account.objects.filter(retailer_id=recset.retailer_id,
-                                                           accountfeature__feature_flag__name=precompute_collab_feature,
-                                                           archived=False)
-                for account_id in account_ids:
-                    created = self.enqueue_precompute_collab(recset, account_id)
-                    created_collab_queue_entries += 1 if created else 0
-            else:
-                created = self.enqueue_precompute_collab(recset)
-                created_collab_queue_entries += 1 if created else 0
+            created_collab_queue_entries += self.enqueue_recset_queue_entries(recset, precompute_collab_feature)
         log.log_info('Number of precompute combined queue entries created: {}'.format(created_collab_queue_entries))
         # updating entries for precompute combined queue
         updated_recsets_groups = recs_models.PrecomputeQueue.objects.filter(
@@ -155,3 +168,7 @@ class Command(BaseCommand):
         )
         if updated_recsets_groups:
             log.log_info("stale precompute combined queue entries updated {}".format(updated_recsets_groups))
+
+        if (updated_recsets or created_recsets or created_noncollab_queue_entries or created_collab_queue_entries or
+                updated_recsets_groups):
+            notify_workers()
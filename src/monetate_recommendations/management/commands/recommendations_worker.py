@@ -8,13 +8,24 @@ log.configure_script_log('recommendations_worker')
 
 class Command(BaseCommand):
     worker_kw_args = ('poll_interval', 'max_tries', 'heartbeat_interval', 'heartbeat_threshold', 'worker_max_time',
-                      'use_combined_queue')
+                      'use_combined_queue', 'job_max_time', 'slots', 'claim_order', 'priority_window',
+                      'isolation', 'max_poll_interval', 'warehouse_sessions', 'contended_poll_interval')
 
     def add_arguments(self, parser):
         parser.add_argument('--poll-interval',
                             type=int,
                             help='Time (seconds) to wait in between looking for jobs',
                             default=DEFAULTS.poll_interval)
+        parser.add_argument('--max-poll-interval',
+                            type=int,
+                            help=('Max time (seconds) to wait in between looking for jobs, as the wait backs off '
+                                  'while no jobs are found'),
+                            default=DEFAULTS.max_poll_interval)
+        parser.add_argument('--contended-poll-interval',
+                            type=int,
+                            help=('Time (seconds) to wait before looking for jobs again after other workers claimed '
+                                  'every job found'),
+                            default=DEFAULTS.contended_poll_interval)
         parser.add_argument('--max-tries',
                             type=int,
                             help='Maximum number of times to try loading a file',
@@ -32,11 +43,42 @@ class Command(BaseCommand):
                             help=('Max time (seconds) that a worker can run. After this, it will exit instead of '
                                   'getting more work.'),
                             default=DEFAULTS.worker_max_time)
+        parser.add_argument('--job-max-time',
+                            type=int,
+                            help='Max time (seconds) that a single job can run before it is marked as timed out',
+                            default=DEFAULTS.job_max_time)
+        parser.add_argument('--slots',
+                            type=int,
+                            help=('Number of claimed jobs to keep running at once. Each job runs on its own thread '
+                                  'and warehouse connection.'),
+                            default=DEFAULTS.slots)
+        parser.add_argument('--isolation',
+                            choices=['thread', 'process'],
+                            help=('Run each job on a thread of the worker, or in a reusable child process. Jobs in a '
+                                  'child process that pass --job-max-time have their warehouse queries cancelled and '
+                                  'their process killed, and the worker keeps running.'),
+                            default=DEFAULTS.isolation)
+        parser.add_argument('--warehouse-sessions',
+                            choices=['reuse', 'per-job'],
+                            help=('Keep warehouse connections open between jobs, dropping each job\'s temp tables '
+                                  'when it finishes, or open a new connection for every job'),
+                            default=DEFAULTS.warehouse_sessions)
+        parser.add_argument('--claim-order',
+                            choices=['priority', 'id'],
+                            help=('Order in which eligible jobs are claimed: by the configured priority score '
+                                  '(staleness, experience traffic, retries and cost) or by id'),
+                            default=DEFAULTS.claim_order)
+        parser.add_argument('--priority-window',
+                            type=int,
+                            help=('Number of the stalest eligible jobs, and of the stalest eligible jobs behind live '
+                                  'traffic, scored when looking for work'),
+                            default=DEFAULTS.priority_window)
         parser.add_argument('--use-combined-queue',
                             type=bool,
-                            help='Use a combined queue to process the recommendations. '
-                                 'This flag is to only process collaborative algorithms for now, '
-                                 'will eventually expand to non-collaborative',
+                            help='Process the combined queue (PrecomputeQueue) instead of RecommendationsPrecompute. '
+                                 'Collaborative and non-collaborative entries are both processed; each entry runs '
+                                 'all recsets of its account/market/retailer, algorithm, lookback and purchase data '
+                                 'source together.',
                             default=False)
 
     def handle(self, *args, **options):
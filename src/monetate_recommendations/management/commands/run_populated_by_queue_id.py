@@ -4,6 +4,7 @@ django.setup()
 from django.core.management.base import BaseCommand
 import monetate_recommendations.precompute_collab_algo_map as precompute_collab_algo_map
 from monetate_recommendations.precompute_collab_algo_map import initialize_collab_algorithm
+from monetate_recommendations.warehouse_session import WarehouseSessionPool, use_warehouse_sessions
 
 
 class Command(BaseCommand):
@@ -17,7 +18,13 @@ class Command(BaseCommand):
 
         queue_entry_ids = options.get('queue_entry_ids')
         queue_by_algorithm = precompute_collab_algo_map.sort_recommendation_algo(queue_entry_ids)
-        for algorithm in queue_by_algorithm.keys():
-            print('Processing {} recsets...'.format(algorithm))
-            initialize_collab_algorithm(queue_by_algorithm[algorithm], algorithm)
+        # reuse one warehouse session across algorithms, so they share purchase tables
+        pool = WarehouseSessionPool()
+        try:
+            with use_warehouse_sessions(pool):
+                for algorithm in queue_by_algorithm.keys():
+                    print('Processing {} recsets...'.format(algorithm))
+                    initialize_collab_algorithm(queue_by_algorithm[algorithm], algorithm)
+        finally:
+            pool.close()
         print('Finished processing {}'.format(queue_entry_ids))
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrecomputeJobHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_key', models.CharField(max_length=255)),
+                ('algorithm', models.CharField(max_length=64)),
+                ('lookback_days', models.IntegerField(null=True)),
+                ('purchase_data_source', models.CharField(max_length=32, null=True)),
+                ('status', models.CharField(max_length=32)),
+                ('worker_id', models.CharField(blank=True, default='', max_length=255)),
+                ('start_time', models.DateTimeField(null=True)),
+                ('end_time', models.DateTimeField()),
+                ('processing_time_seconds', models.IntegerField()),
+                ('products_returned', models.IntegerField(default=0)),
+                ('stage_timings', models.TextField(blank=True, default='{}')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='precomputejobhistory',
+            index_together=set([('job_key', 'end_time')]),
+        ),
+    ]
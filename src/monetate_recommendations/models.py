@@ -0,0 +1,27 @@
+from django.db import models
+
+
+class PrecomputeJobHistory(models.Model):
+    """
+    One finished run of a precompute job.
+
+    RecommendationsPrecompute and PrecomputeQueue rows only keep the outcome of their latest run; this keeps the
+    history so the cost of the next run can be estimated (see precompute_history.estimate_jobs).
+    job_key identifies the work independently of the queue row: the recset, or the queue entry's
+    (account, market, retailer), plus algorithm, lookback and purchase data source.
+    """
+    job_key = models.CharField(max_length=255)
+    algorithm = models.CharField(max_length=64)
+    lookback_days = models.IntegerField(null=True)
+    purchase_data_source = models.CharField(max_length=32, null=True)
+    status = models.CharField(max_length=32)
+    worker_id = models.CharField(max_length=255, blank=True, default='')
+    start_time = models.DateTimeField(null=True)
+    end_time = models.DateTimeField()
+    processing_time_seconds = models.IntegerField()
+    products_returned = models.IntegerField(default=0)
+    # JSON object of stage name to seconds spent in it, e.g. {"metric": 12.3, "rank": 4.5, "unload": 1.2}
+    stage_timings = models.TextField(blank=True, default='{}')
+
+    class Meta:
+        index_together = [('job_key', 'end_time')]
@@ -0,0 +1,171 @@
+"""
+In-Process Pair Counts
+======================
+
+Ranks the pid pairs of small collab jobs in the worker, instead of self joining their device products and ranking
+the pairs in the warehouse.
+
+  - The job builds its per device product table in the warehouse as before (last_purchase_per_mid_and_pid or
+    earliest_view_per_mid_and_pid). If it has at most IN_PROCESS_MAX_ROWS rows (RECS_IN_PROCESS_PAIRS_MAX_ROWS), the
+    rows are streamed into the worker in batches of FETCH_BATCH_SIZE as a sparse device x product matrix X, and the
+    pair counts are X'X: for every two products of an account, the number of devices having both.
+  - Pairs are kept by the thresholds of the queries they replace (the job's minimum count for purchase_also_purchase
+    and bought_together, more than one device for view_also_view), and are scored, ordered and normalized as
+    PID_RANKS_BY_COLLAB_RECSET does. The pid ranks table is written back with one INSERT per LOAD_BATCH_SIZE rows.
+  - numpy and scipy are optional (the "sparse" extra). Without them, with IN_PROCESS_MAX_ROWS at 0 (the default), for
+    bigger jobs, and for subsequently_purchased, whose pairs depend on the order of the purchases, the warehouse
+    queries are used.
+
+Usage
+-----
+    if not rank_pairs_in_process(warehouse_conn, algorithm, device_products_table, pid_ranks_table, minimum_count):
+        warehouse_conn.execute(...)  # pair query, then PID_RANKS_BY_COLLAB_RECSET
+"""
+
+import collections
+import decimal
+import json
+import os
+
+from django.conf import settings
+from monetate_monitoring import log
+from sqlalchemy.sql import text
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = sparse = None
+
+IN_PROCESS_MAX_ROWS = int(getattr(settings, 'RECS_IN_PROCESS_PAIRS_MAX_ROWS',
+                                  os.environ.get('RECS_IN_PROCESS_PAIRS_MAX_ROWS', 0)))
+FETCH_BATCH_SIZE = 10000
+LOAD_BATCH_SIZE = 50000
+
+# algorithm: minimum device count of a pair, None for the minimum count of the job
+ALGORITHM_MINIMUM_COUNTS = {
+    'purchase_also_purchase': None,
+    'bought_together': None,
+    'view_also_view': 2,
+}
+
+# score normalization of PID_RANKS_BY_COLLAB_RECSET
+MIN_TARGET = decimal.Decimal('0.01')
+MAX_TARGET = decimal.Decimal('1000')
+
+DEVICE_PRODUCTS = """
+SELECT account_id, mid_epoch, mid_ts, mid_rnd, product_id
+FROM {table}
+"""
+
+CREATE_PID_RANKS = """
+CREATE TEMPORARY TABLE IF NOT EXISTS {table} (
+    account_id NUMBER,
+    lookup_key VARCHAR,
+    product_id VARCHAR,
+    score NUMBER,
+    ordinal NUMBER,
+    normalized_score NUMBER(38, 2)
+)
+"""
+
+LOAD_PID_RANKS = """
+INSERT INTO {table} (account_id, lookup_key, product_id, score, ordinal, normalized_score)
+SELECT value[0]::number, value[1]::varchar, value[2]::varchar, value[3]::number, value[4]::number,
+    value[5]::number(38, 2)
+FROM TABLE(FLATTEN(input => PARSE_JSON(:rows)))
+"""
+
+
+def supports(algorithm):
+    return sparse is not None and algorithm in ALGORITHM_MINIMUM_COUNTS
+
+
+def count_pairs(batches, minimum_count=1):
+    """
+    Count the devices having both products of every pair of products of an account.
+
+    :param batches: Iterable of lists of (account_id, mid_epoch, mid_ts, mid_rnd, product_id) rows.
+    :param minimum_count: Pairs of fewer devices are dropped.
+    :return: list of (account_id, pid1, pid2, devices), both orders of every pair
+    """
+    devices, products = {}, {}
+    device_indexes, product_indexes = [], []
+    for batch in batches:
+        for account_id, mid_epoch, mid_ts, mid_rnd, product_id in batch:
+            device_indexes.append(devices.setdefault((account_id, mid_epoch, mid_ts, mid_rnd), len(devices)))
+            # products of different accounts are different columns, so pairs never span accounts
+            product_indexes.append(products.setdefault((account_id, product_id), len(products)))
+    if not device_indexes:
+        return []
+
+    device_products = sparse.csr_matrix(
+        (numpy.ones(len(device_indexes), dtype=numpy.int64), (device_indexes, product_indexes)),
+        shape=(len(devices), len(products)))
+    # a product counts once per device
+    device_products.data[:] = 1
+    pair_counts = device_products.T.dot(device_products).tocoo()
+    keep = (pair_counts.row != pair_counts.col) & (pair_counts.data >= minimum_count)
+
+    product_keys = [None] * len(products)
+    for key, index in products.items():
+        product_keys[index] = key
+    return [(product_keys[pid1][0], product_keys[pid1][1], product_keys[pid2][1], int(count))
+            for pid1, pid2, count in zip(pair_counts.row[keep], pair_counts.col[keep], pair_counts.data[keep])]
+
+
+def rank_pairs(pairs, candidate_limit=None):
+    """
+    Rank pairs as PID_RANKS_BY_COLLAB_RECSET does: ordinal by score and pid2, descending, per account and pid1, and
+    the score mapped from the range of all scores to [0.01, 1000], rounded to 2 places.
+
+    :param pairs: list of (account_id, pid1, pid2, score)
+    :param candidate_limit: Most ranks kept per account and pid1, None for all
+    :return: list of (account_id, lookup_key, product_id, score, ordinal, normalized_score)
+    """
+    if not pairs:
+        return []
+    min_score = min(score for _, _, _, score in pairs)
+    # avoid division by 0 in edge case of all identical scores
+    score_range = max(max(score for _, _, _, score in pairs) - min_score, 1)
+
+    lookups = collections.defaultdict(list)
+    for account_id, pid1, pid2, score in pairs:
+        lookups[(account_id, pid1)].append((score, pid2))
+    ranks = []
+    for (account_id, pid1), recommendations in lookups.items():
+        recommendations = sorted(recommendations, reverse=True)[:candidate_limit]
+        for ordinal, (score, pid2) in enumerate(recommendations, 1):
+            normalized_score = (decimal.Decimal(score - min_score) / score_range * (MAX_TARGET - MIN_TARGET) +
+                                MIN_TARGET).quantize(decimal.Decimal('0.01'), rounding=decimal.ROUND_HALF_UP)
+            ranks.append((account_id, pid1, pid2, score, ordinal, normalized_score))
+    return ranks
+
+
+def rank_pairs_in_process(conn, algorithm, device_products_table, pid_ranks_table, minimum_count=1,
+                          candidate_limit=None):
+    """
+    Build pid_ranks_table from device_products_table in the worker, if the algorithm is supported and the table is
+    small enough. candidate_limit is the most ranks kept per lookup key, as for get_pid_ranks_query.
+
+    :return: whether the pid ranks were built; if not, the warehouse queries have to be run
+    """
+    if not IN_PROCESS_MAX_ROWS or not supports(algorithm):
+        return False
+    rows = conn.execute(text('SELECT COUNT(*) FROM {}'.format(device_products_table))).scalar()
+    if rows > IN_PROCESS_MAX_ROWS:
+        return False
+
+    log.log_info('Ranking {} pairs of {} device products in process'.format(algorithm, rows))
+    result = conn.execute(text(DEVICE_PRODUCTS.format(table=device_products_table)))
+    pairs = count_pairs(iter(lambda: result.fetchmany(FETCH_BATCH_SIZE), []),
+                        ALGORITHM_MINIMUM_COUNTS[algorithm] or minimum_count)
+    ranks = rank_pairs(pairs, candidate_limit)
+    conn.execute(text(CREATE_PID_RANKS.format(table=pid_ranks_table)))
+    for start in range(0, len(ranks), LOAD_BATCH_SIZE):
+        conn.execute(text(LOAD_PID_RANKS.format(table=pid_ranks_table)),
+                     rows=json.dumps([[account_id, pid1, pid2, score, ordinal, str(normalized_score)]
+                                      for account_id, pid1, pid2, score, ordinal, normalized_score
+                                      in ranks[start:start + LOAD_BATCH_SIZE]]))
+    log.log_info('Loaded {} pid ranks into {}'.format(len(ranks), pid_ranks_table))
+    return True
@@ -1,6 +1,9 @@
 from collections import defaultdict
 from monetate.recs.models import RecommendationSet
+from monetate_monitoring import log
 
+from . import precompute_utils
+from .active import is_strategy_active
 from .precompute_purchase import precompute_purchase_algorithm
 from .precompute_purchase_value import precompute_purchase_value_algorithm
 from .precompute_trending import precompute_trending_algorithm
@@ -25,3 +28,31 @@ def sort_recsets_by_algorithm(recset_ids):
     for recset in recsets:
         recsets_by_algorithm[recset.algorithm].append(recset)
     return recsets_by_algorithm
+
+
+def get_noncollab_recsets(queue_entry):
+    """
+    Return the active recsets a noncollab PrecomputeQueue entry stands for. All of them share the entry's metric
+    tables, so they are processed together on one warehouse connection.
+    """
+    active_recsets = []
+    for recset in precompute_utils.get_recset_ids(queue_entry):
+        if is_strategy_active(recset):
+            active_recsets.append(recset)
+        else:
+            log.log_info('skip inactive strategy {}'.format(recset.id))
+    return active_recsets
+
+
+def process_noncollab_queue_entry(queue_entry):
+    """
+    Process all recsets of a noncollab PrecomputeQueue entry in one algorithm call.
+
+    :return: list of products returned, one per recset and account
+    """
+    recsets = get_noncollab_recsets(queue_entry)
+    log.log_info('processing queue entry {}: recsets {}'.format(queue_entry.id, [recset.id for recset in recsets]))
+    # retailer level recsets are enqueued once per account; only process the entry's account
+    account_ids = [queue_entry.account.id] if queue_entry.account else None
+    result_counts = FUNC_MAP[queue_entry.algorithm](recsets, account_ids=account_ids)
+    return [count for recset_counts in result_counts for count in recset_counts]
@@ -7,6 +7,7 @@ from sqlalchemy.sql import text
 
 from . import precompute_utils
 from . import supported_weights_expression
+from .precompute_history import job_stage
 
 # Retrieving the products only if they are available in stock for the given retailer
 GET_RETAILER_PRODUCT_CATALOG = """
@@ -69,21 +70,22 @@ def process_catalog_collab_algorithm(conn, queue_entry):
     dataset_id = dio_models.DefaultAccountCatalog.objects.get(account=queue_entry.account.id).schema.id
     # TODO: availability is Adidas specific, need to change in the future to support all clients
     availability = "In Stock"
-    conn.execute(text(GET_RETAILER_PRODUCT_CATALOG.format(account_id=account, market_id=market,
-                                                          retailer_id=retailer, lookback_days=lookback_days)),
-                 retailer_id=retailer_id, dataset_id=dataset_id, availability=availability)
+    with job_stage('metric'):
+        conn.execute(text(GET_RETAILER_PRODUCT_CATALOG.format(account_id=account, market_id=market,
+                                                              retailer_id=retailer, lookback_days=lookback_days)),
+                     retailer_id=retailer_id, dataset_id=dataset_id, availability=availability)
 
-    weights_sql, selected_attributes = get_similar_products_weights(account, market, retailer, lookback_days)
-    conn.execute(text(QUERY_DISPATCH[algorithm].format(algorithm=algorithm, account_id=account, market_id=market,
-                                                       retailer_id=retailer, lookback_days=lookback_days,
-                                                       weights=weights_sql, selected_attributes=selected_attributes,
-                                                       purchase_data_source="online")))
+        weights_sql, selected_attributes = get_similar_products_weights(account, market, retailer, lookback_days)
+        conn.execute(text(QUERY_DISPATCH[algorithm].format(algorithm=algorithm, account_id=account, market_id=market,
+                                                           retailer_id=retailer, lookback_days=lookback_days,
+                                                           weights=weights_sql, selected_attributes=selected_attributes,
+                                                           purchase_data_source="online")))
 
     # normalize score
-    conn.execute(text(precompute_utils.PID_RANKS_BY_COLLAB_RECSET.format(algorithm=algorithm, account_id=account,
-                                                                         lookback_days=lookback_days, market_id=market,
-                                                                         retailer_id=retailer,
-                                                                         purchase_data_source="online")))
+    with job_stage('pid_rank'):
+        conn.execute(text(precompute_utils.get_pid_ranks_query(
+            algorithm, account, market, retailer, lookback_days, "online",
+            candidate_limit=precompute_utils.get_pid_candidate_limit(queue_entry))))
 
     result_counts = precompute_utils.process_collab_recsets(conn, queue_entry, account, market, retailer)
 
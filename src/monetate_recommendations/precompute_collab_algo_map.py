@@ -1,16 +1,15 @@
-import contextlib
 import os
 from collections import defaultdict
 from django.conf import settings
 from monetate.common import job_timing
 from monetate.recs.models import PrecomputeQueue
 from monetate_monitoring import log
-from sqlalchemy import create_engine
-from sqlalchemy.pool import NullPool
 
+from . import purchase_tables
 from .precompute_catalog_associated_pids import process_catalog_collab_algorithm
 from .precompute_purchase_associated_pids import process_purchase_collab_algorithm
 from .precompute_view_associated_pids import process_view_collab_algorithm
+from .warehouse_session import warehouse_connection
 
 FUNC_MAP = {
     'purchase_also_purchase': process_purchase_collab_algorithm,
@@ -22,14 +21,12 @@ FUNC_MAP = {
 
 def initialize_collab_algorithm(queue_entries, algorithm):
     result_counts = []
-    # Disable pooling so temp tables do not persist on connections returned to pool
-    engine = create_engine(settings.SNOWFLAKE_QUERY_DSN, poolclass=NullPool)
-    with job_timing.job_timer('precompute_{}_algorithm'.format(algorithm)),\
-            contextlib.closing(engine.connect()) as warehouse_conn:
-        warehouse_conn.execute("use warehouse {}".format(
-            getattr(settings, 'RECS_COLLAB_QUERY_WH', os.environ.get('RECS_COLLAB_QUERY_WH', 'QUERY4_WH'))))
-        for queue_entry in queue_entries:
-            if queue_entry and queue_entry.algorithm == algorithm:
+    with job_timing.job_timer('precompute_{}_algorithm'.format(algorithm)), warehouse_connection(
+            getattr(settings, 'RECS_COLLAB_QUERY_WH', os.environ.get('RECS_COLLAB_QUERY_WH', 'QUERY4_WH'))) as \
+            warehouse_conn:
+        # entries with the same inputs run one after another and share their purchase tables
+        for queue_entry in sorted(filter(None, queue_entries), key=purchase_tables.get_input_fingerprint):
+            if queue_entry.algorithm == algorithm:
                 log.log_info('processing queue entry {}'.format(queue_entry.id))
                 result_counts.append(
                     FUNC_MAP[algorithm](warehouse_conn, queue_entry))
@@ -0,0 +1,63 @@
+"""
+Precompute Worker Heartbeats and Status Logs
+============================================
+
+Keeps the worker's writes to the queue tables small and infrequent:
+  - write_heartbeats() updates only heartbeat_time, for every in-flight job of a worker, in a single
+    UPDATE ... WHERE id IN (...).
+  - StatusLogBuffer collects status log lines in memory and writes them in one update when flushed. The worker
+    flushes at stage boundaries (claim, start, finish) rather than on every message. The buffer is a bounded ring of
+    the most recent lines, so status_log no longer grows with the length of a job.
+"""
+
+import collections
+
+from django.utils import timezone
+
+
+def write_heartbeats(model, recommendations):
+    """
+    Set heartbeat_time to now for all of the recommendations with a single column-scoped update.
+
+    :param model: RecommendationsPrecompute or PrecomputeQueue
+    :param recommendations: The in-flight recommendations of one worker
+    :return: The heartbeat time written, or None if there was nothing to heartbeat
+    """
+    if not recommendations:
+        return None
+    hb_time = timezone.now()
+    model.objects.filter(id__in=[rec.id for rec in recommendations]).update(heartbeat_time=hb_time)
+    for rec in recommendations:
+        rec.heartbeat_time = hb_time
+    return hb_time
+
+
+class StatusLogBuffer(object):
+    """
+    Bounded, buffered status log for one recommendation.
+
+    :param recommendation: The recommendation whose status_log is buffered. Its existing status_log seeds the ring.
+    :param max_lines: Number of most recent lines kept in status_log.
+    """
+
+    def __init__(self, recommendation, max_lines):
+        self.recommendation = recommendation
+        self.lines = collections.deque((recommendation.status_log or '').splitlines(True), maxlen=max_lines)
+        self.pending = 0
+
+    def append(self, line):
+        self.lines.append(line)
+        self.pending += 1
+
+    @property
+    def status_log(self):
+        return ''.join(self.lines)
+
+    def flush(self, model):
+        """Write the buffered status log with a single update of the status_log column, if anything is pending."""
+        if not self.pending:
+            return
+        status_log = self.status_log
+        model.objects.filter(id=self.recommendation.id).update(status_log=status_log)
+        self.recommendation.status_log = status_log
+        self.pending = 0
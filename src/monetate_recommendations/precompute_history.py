@@ -0,0 +1,184 @@
+"""
+Precompute Job History
+======================
+
+Records every finished precompute job in PrecomputeJobHistory and estimates the cost of the next run from it.
+
+  - The work threads run under a StageTimer. The precompute functions mark their stages with job_stage(), e.g.
+    building the metric table, ranking and unloading, and the time spent in each is recorded with the job.
+  - record_job() is called by the worker when it finalizes a job.
+  - estimate_jobs() predicts runtime and products returned for a batch of queue rows from the median of their
+    recent completed runs, with one query for the whole batch.
+
+Usage
+-----
+    timer = StageTimer()
+    with timer.activate():
+        with job_stage('rank'):
+            ...
+    record_job(recommendation, timer.timings)
+
+    estimates = estimate_jobs(recommendations)
+    estimates[recommendation.id].runtime_seconds
+"""
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+import monetate.recs.precompute_constants as precompute_constants
+from django.conf import settings
+from monetate.recs.models import PrecomputeQueue
+
+from .models import PrecomputeJobHistory
+
+# completed runs an estimate is based on
+HISTORY_SAMPLES = int(getattr(settings, 'RECS_PRECOMPUTE_HISTORY_SAMPLES',
+                              os.environ.get('RECS_PRECOMPUTE_HISTORY_SAMPLES', 10)))
+# runs kept per job; older ones are deleted as new runs are recorded, which also bounds what estimate_jobs reads
+HISTORY_MAX_RUNS = int(getattr(settings, 'RECS_PRECOMPUTE_HISTORY_MAX_RUNS',
+                               os.environ.get('RECS_PRECOMPUTE_HISTORY_MAX_RUNS', 20)))
+
+JobEstimate = collections.namedtuple('JobEstimate', ['runtime_seconds', 'products_returned', 'samples'])
+
+_local = threading.local()
+
+
+class StageTimer(object):
+    """
+    Accumulates the seconds spent in each job_stage() run on the threads it is active on. A job's pipeline threads
+    (see account_pipelines) share its timer, so add() is locked.
+    """
+
+    def __init__(self):
+        self.timings = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def activate(self):
+        _local.stage_timer = self
+        try:
+            yield self
+        finally:
+            _local.stage_timer = None
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.timings[name] = self.timings.get(name, 0) + seconds
+
+
+def current_stage_timer():
+    """Return the StageTimer active on this thread, if any."""
+    return getattr(_local, 'stage_timer', None)
+
+
+@contextlib.contextmanager
+def job_stage(name):
+    """Time a stage of the current job. A no-op when no StageTimer is active on this thread."""
+    timer = current_stage_timer()
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        if timer is not None:
+            timer.add(name, time.time() - start_time)
+
+
+def get_job_key(recommendation):
+    """
+    Identify the work a RecommendationsPrecompute or PrecomputeQueue row stands for, so history carries over between
+    rows for the same work.
+    """
+    if isinstance(recommendation, PrecomputeQueue):
+        return 'queue:{}:{}:{}:{}:{}:{}'.format(
+            recommendation.account_id, recommendation.market_id, recommendation.retailer_id,
+            recommendation.algorithm, recommendation.lookback_days, recommendation.purchase_data_source)
+    recset = recommendation.recset
+    return 'recset:{}:{}:{}:{}'.format(recset.id, recset.algorithm, recset.lookback_days,
+                                       recset.purchase_data_source)
+
+
+def get_job_params(recommendation):
+    """Return (algorithm, lookback_days, purchase_data_source) of a queue row."""
+    source = recommendation if isinstance(recommendation, PrecomputeQueue) else recommendation.recset
+    return source.algorithm, source.lookback_days, source.purchase_data_source
+
+
+def record_job(recommendation, stage_timings=None, worker_id=''):
+    """
+    Save a finished run of a recommendation and drop all but the HISTORY_MAX_RUNS most recent runs of the job.
+
+    :param recommendation: The finalized RecommendationsPrecompute or PrecomputeQueue row
+    :param stage_timings: Dict of stage name to seconds, as collected by a StageTimer
+    :param worker_id: The worker that ran the job
+    :return: PrecomputeJobHistory
+    """
+    job_key = get_job_key(recommendation)
+    algorithm, lookback_days, purchase_data_source = get_job_params(recommendation)
+    history = PrecomputeJobHistory.objects.create(
+        job_key=job_key,
+        algorithm=algorithm,
+        lookback_days=lookback_days,
+        purchase_data_source=purchase_data_source,
+        status=recommendation.status,
+        worker_id=worker_id,
+        start_time=recommendation.precompute_start_time,
+        end_time=recommendation.precompute_end_time,
+        processing_time_seconds=recommendation.processing_time_seconds,
+        products_returned=recommendation.products_returned or 0,
+        stage_timings=json.dumps({name: round(seconds, 3) for name, seconds in (stage_timings or {}).items()}),
+    )
+    job_history = PrecomputeJobHistory.objects.filter(job_key=job_key)
+    expired_ids = list(job_history.order_by('-end_time', '-id').values_list('id', flat=True)[HISTORY_MAX_RUNS:])
+    if expired_ids:
+        job_history.filter(id__in=expired_ids).delete()
+    return history
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def estimate_jobs(recommendations, samples=HISTORY_SAMPLES):
+    """
+    Predict the next run of each recommendation from the median of its last samples completed runs.
+
+    Recommendations without completed history fall back to their own last run, if they have one, with samples=0.
+    Runtime and products returned are None when nothing is known.
+
+    :param recommendations: RecommendationsPrecompute or PrecomputeQueue rows
+    :return: dict of recommendation id to JobEstimate
+    """
+    job_keys = {rec.id: get_job_key(rec) for rec in recommendations}
+    runs = collections.defaultdict(list)
+    if job_keys:
+        history = PrecomputeJobHistory.objects.filter(
+            job_key__in=set(job_keys.values()),
+            status=precompute_constants.STATUS_COMPLETE,
+        ).order_by('-end_time').values_list('job_key', 'processing_time_seconds', 'products_returned')
+        for job_key, processing_time_seconds, products_returned in history:
+            if len(runs[job_key]) < samples:
+                runs[job_key].append((processing_time_seconds, products_returned))
+
+    estimates = {}
+    for rec in recommendations:
+        job_runs = runs.get(job_keys[rec.id])
+        if job_runs:
+            estimates[rec.id] = JobEstimate(_median([run[0] for run in job_runs]),
+                                            _median([run[1] for run in job_runs]), len(job_runs))
+        else:
+            last_run = rec.processing_time_seconds
+            estimates[rec.id] = JobEstimate(last_run, rec.products_returned if last_run is not None else None, 0)
+    return estimates
+
+
+def estimate_job(recommendation, samples=HISTORY_SAMPLES):
+    """Predict the next run of a single recommendation. See estimate_jobs."""
+    return estimate_jobs([recommendation], samples)[recommendation.id]
@@ -0,0 +1,155 @@
+"""
+Precompute Queue Priority
+=========================
+
+Decides the order in which a worker claims eligible RecommendationsPrecompute / PrecomputeQueue rows, so that under
+a backlog the recsets behind live traffic are refreshed before cold ones.
+
+The default PriorityScorer scores a row as
+
+    staleness_hours * traffic_weight / (1 + attempts) / sqrt(1 + estimated_cost_minutes)
+
+  - staleness_hours: time since precompute_end_time (rows that have never completed count as NEVER_RUN_STALENESS).
+  - traffic_weight: 1 for strategies is_strategy_active would skip, otherwise grows with the number of recent
+    experience inputs referencing the strategy (see active.get_recent_input_count).
+  - attempts: rows that keep failing fall behind fresh work.
+  - estimated_cost_minutes: the runtime predicted from the job history (see precompute_history.estimate_jobs);
+    cheap jobs are preferred over expensive ones that are equally stale.
+
+Higher scores are claimed first. Only a window of the stalest eligible rows is scored; traffic_filter adds the
+stalest rows behind the TRAFFIC_FILTER_RECSETS strategies with the most experience inputs, so that traffic can lift a
+row that is not among the stalest. The scorer is pluggable: point settings.RECS_PRECOMPUTE_PRIORITY_SCORER at the
+dotted path of a PriorityScorer subclass to change the ordering.
+"""
+
+import math
+import os
+import time
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from monetate.recs.models import PrecomputeQueue, RecommendationSet
+
+from . import precompute_utils
+from .active import get_recent_input_count, get_recent_input_counts, is_strategy_active
+from .precompute_history import estimate_jobs
+
+DEFAULT_PRIORITY_SCORER = 'monetate_recommendations.precompute_priority.PriorityScorer'
+# treat rows that have never completed as a week stale
+NEVER_RUN_STALENESS = 7 * 24 * 3600
+# weight for strategies is_strategy_active keeps only because they were recently created or updated
+ACTIVE_WEIGHT = 2.0
+# cost assumed for rows without any history
+DEFAULT_COST_SECONDS = 300
+# how long a row's traffic weight is cached; it costs config queries to compute
+TRAFFIC_WEIGHT_TTL = 600
+# how many of the strategies with the most experience inputs traffic_filter selects the rows of
+TRAFFIC_FILTER_RECSETS = 200
+
+
+class PriorityScorer(object):
+    """
+    Scores eligible precompute rows; rows with higher scores are claimed first.
+    """
+
+    def __init__(self):
+        self._traffic_weights = {}
+        self._traffic_filters = {}
+        self.estimates = {}
+
+    def order(self, recommendations):
+        """Return the recommendations sorted by descending priority. Ties keep the given order."""
+        now = timezone.now()
+        self.estimates = estimate_jobs(recommendations)
+        scores = {rec.id: self.score(rec, now) for rec in recommendations}
+        return sorted(recommendations, key=lambda rec: -scores[rec.id])
+
+    def score(self, recommendation, now):
+        staleness_hours = self.staleness_seconds(recommendation, now) / 3600.0
+        cost_minutes = self.estimated_cost_seconds(recommendation) / 60.0
+        return (staleness_hours * self.traffic_weight(recommendation) /
+                (1 + recommendation.attempts) / math.sqrt(1 + cost_minutes))
+
+    def staleness_seconds(self, recommendation, now):
+        end_time = recommendation.precompute_end_time
+        if end_time is None:
+            return NEVER_RUN_STALENESS
+        return max(0, (now - end_time).total_seconds())
+
+    def estimated_cost_seconds(self, recommendation):
+        estimate = self.estimates.get(recommendation.id)
+        if estimate is not None and estimate.runtime_seconds is not None:
+            return estimate.runtime_seconds
+        return recommendation.processing_time_seconds or DEFAULT_COST_SECONDS
+
+    def traffic_weight(self, recommendation):
+        key = (type(recommendation).__name__, recommendation.id)
+        cached = self._traffic_weights.get(key)
+        if cached is None or cached[0] < time.time():
+            cached = (time.time() + TRAFFIC_WEIGHT_TTL, self._traffic_weight(self.get_recsets(recommendation)))
+            self._traffic_weights[key] = cached
+        return cached[1]
+
+    def traffic_filter(self, model):
+        """
+        Return a Q selecting the rows of model (RecommendationsPrecompute or PrecomputeQueue) behind the
+        TRAFFIC_FILTER_RECSETS strategies with the most recent experience inputs, or None if there are none.
+        Cached for TRAFFIC_WEIGHT_TTL.
+        """
+        cached = self._traffic_filters.get(model.__name__)
+        if cached is None or cached[0] < time.time():
+            recset_ids = list(get_recent_input_counts(TRAFFIC_FILTER_RECSETS))
+            if not recset_ids:
+                traffic_filter = None
+            elif issubclass(model, PrecomputeQueue):
+                traffic_filter = Q()
+                for recset in RecommendationSet.objects.filter(id__in=recset_ids, archived=False):
+                    traffic_filter |= self.get_queue_filter(recset)
+                traffic_filter = traffic_filter or None
+            else:
+                traffic_filter = Q(recset_id__in=recset_ids)
+            cached = (time.time() + TRAFFIC_WEIGHT_TTL, traffic_filter)
+            self._traffic_filters[model.__name__] = cached
+        return cached[1]
+
+    @staticmethod
+    def get_queue_filter(recset):
+        """Q of the PrecomputeQueue entries the enqueue commands create for a recset."""
+        queue_filter = Q(market_id=recset.market_id,
+                         retailer_id=recset.retailer_id if recset.retailer_market_scope else None,
+                         algorithm=recset.algorithm, lookback_days=recset.lookback_days,
+                         purchase_data_source=recset.purchase_data_source)
+        if recset.is_market_or_retailer_driven_ds:
+            return queue_filter & Q(account=None)
+        if not recset.is_retailer_tenanted:
+            return queue_filter & Q(account_id=recset.account_id)
+        # retailer level recsets are enqueued for each account of the retailer
+        return queue_filter & Q(account__retailer_id=recset.retailer_id)
+
+    def get_recsets(self, recommendation):
+        if isinstance(recommendation, PrecomputeQueue):
+            return list(precompute_utils.get_recset_ids(recommendation))
+        return [recommendation.recset]
+
+    @staticmethod
+    def _traffic_weight(recsets):
+        weight = 1.0
+        for recset in recsets:
+            if recset.is_component_recset:
+                weight = max(weight, ACTIVE_WEIGHT)
+                continue
+            input_count = get_recent_input_count(recset)
+            if input_count:
+                weight = max(weight, ACTIVE_WEIGHT * (1 + math.log1p(input_count)))
+            elif is_strategy_active(recset):
+                weight = max(weight, ACTIVE_WEIGHT)
+        return weight
+
+
+def get_priority_scorer():
+    """Instantiate the configured PriorityScorer."""
+    scorer_path = getattr(settings, 'RECS_PRECOMPUTE_PRIORITY_SCORER',
+                          os.environ.get('RECS_PRECOMPUTE_PRIORITY_SCORER', DEFAULT_PRIORITY_SCORER))
+    return import_string(scorer_path)()
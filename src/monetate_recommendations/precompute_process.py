@@ -0,0 +1,304 @@
+"""
+Process Isolated Precompute Jobs
+================================
+
+Runs precompute jobs in long lived child processes instead of threads of the worker, so a job that overruns its
+deadline can actually be stopped:
+  - Every job is sent to an idle child of a JobProcessPool (a new child is forked when none is idle). Children are
+    reused between jobs; a job with an affinity key prefers the idle child that last ran a job with the same key, and
+    that key is passed on to the child's warehouse sessions (see warehouse_session).
+  - The child tags every warehouse session it opens with the job's query tag. With reuse_warehouse_sessions the child
+    keeps its warehouse connections between jobs (see warehouse_session).
+  - On the parent side a ProcessJob thread waits for the child's result, so the worker treats it like any other work
+    thread: is_alive(), result, exception, message, traceback, stage_timer and connector.
+  - ProcessJob.connector.cleanup() cancels the job: the job's running warehouse statements are looked up by query
+    tag and cancelled by query id, then the child is terminated, and killed if it has not exited after
+    TERMINATE_TIMEOUT. The pool replaces it on the next job.
+
+Usage
+-----
+    pool = JobProcessPool(RecommendationsPrecompute, PrecomputeThread, worker_id)
+    job = pool.job(recommendation, affinity)
+    job.start()
+    job.join(job_max_time)
+    if job.is_alive():
+        job.connector.cleanup()
+    pool.close()
+"""
+
+import contextlib
+import multiprocessing
+import os
+import re
+import signal
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from monetate_monitoring import log
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql import text
+
+from .precompute_history import StageTimer
+from .warehouse_session import WarehouseSessionPool
+
+# how long the parent waits for a terminated child to exit before killing it
+TERMINATE_TIMEOUT = 10
+
+RUNNING_QUERIES_BY_TAG = """
+SELECT query_id
+FROM TABLE(information_schema.query_history_by_user(RESULT_LIMIT => 10000))
+WHERE query_tag = :query_tag
+AND execution_status IN ('RUNNING', 'QUEUED', 'BLOCKED', 'RESUMING_WAREHOUSE')
+"""
+
+CANCEL_QUERY = """
+SELECT SYSTEM$CANCEL_QUERY(:query_id)
+"""
+
+
+class JobProcessError(Exception):
+    """Raised in place of an exception a job process could not send back, or when the process died."""
+    pass
+
+
+def get_query_tag(worker_id, recommendation):
+    """Query tag for the warehouse statements of one attempt at a job. Only [a-zA-Z0-9_:.-] characters are used."""
+    return re.sub(r'[^a-zA-Z0-9_:.-]', '_', 'recs_precompute:{}:{}:{}:{}'.format(
+        worker_id, type(recommendation).__name__, recommendation.id, recommendation.attempts))
+
+
+def cancel_queries(query_tag):
+    """
+    Cancel the running warehouse statements tagged with query_tag.
+
+    :return: the cancelled query ids
+    """
+    engine = create_engine(settings.SNOWFLAKE_QUERY_DSN, poolclass=NullPool)
+    with contextlib.closing(engine.connect()) as warehouse_conn:
+        warehouse_conn.execute("use warehouse {}".format(
+            getattr(settings, 'RECS_QUERY_WH', os.environ.get('RECS_QUERY_WH', 'QUERY4_WH'))))
+        query_ids = [row[0] for row in warehouse_conn.execute(text(RUNNING_QUERIES_BY_TAG), query_tag=query_tag)]
+        for query_id in query_ids:
+            warehouse_conn.execute(text(CANCEL_QUERY), query_id=query_id)
+    return query_ids
+
+
+def run_job_process(conn, model, thread_class, reuse_warehouse_sessions=False):
+    """
+    Main loop of a job process: receive (recommendation id, query tag, affinity), run the job with thread_class in
+    this process and send back its outcome, until None is received or the parent goes away.
+    """
+    query_tag = [None]
+    warehouse_sessions = WarehouseSessionPool() if reuse_warehouse_sessions else None
+
+    def set_query_tag(warehouse_conn, branch):
+        if not branch and query_tag[0] and warehouse_conn.dialect.name == 'snowflake':
+            warehouse_conn.execute("alter session set query_tag = '{}'".format(query_tag[0]))
+
+    event.listen(Engine, 'engine_connect', set_query_tag)
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        rec_id, query_tag[0], affinity = job
+        outcome = {'result': None, 'message': None, 'error': None, 'traceback': '', 'stage_timings': {}}
+        try:
+            thread = thread_class(model.objects.get(id=rec_id))
+            thread.warehouse_sessions = warehouse_sessions
+            thread.query_tag = query_tag[0]
+            thread.session_affinity = affinity
+            # run the job in this process; the thread is never started
+            thread.run()
+            outcome.update(result=thread.result, message=thread.message, traceback=thread.traceback,
+                           stage_timings=dict(thread.stage_timer.timings))
+            if thread.exception is not None:
+                outcome['error'] = '{}: {}'.format(type(thread.exception).__name__, thread.exception)
+        except Exception as e:
+            outcome['error'] = '{}: {}'.format(type(e).__name__, e)
+        finally:
+            connections.close_all()
+        conn.send(outcome)
+    if warehouse_sessions is not None:
+        warehouse_sessions.close()
+    conn.close()
+
+
+class JobProcess(object):
+    """A child process that runs jobs sent to it over a pipe, one at a time."""
+
+    def __init__(self, model, thread_class, reuse_warehouse_sessions=False):
+        self.conn, child_conn = multiprocessing.Pipe()
+        # the child must not share the parent's config db connections
+        connections.close_all()
+        self.process = multiprocessing.Process(target=run_job_process, args=(child_conn, model, thread_class,
+                                                                              reuse_warehouse_sessions))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        # affinity key of the last job sent to the process
+        self.affinity = None
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def stop(self):
+        """Ask the process to exit after its current job."""
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.conn.close()
+
+    def terminate(self):
+        """Terminate the process, and kill it if it has not exited after TERMINATE_TIMEOUT."""
+        self.process.terminate()
+        self.process.join(TERMINATE_TIMEOUT)
+        if self.process.is_alive():
+            log.log_info('Killing job process {}'.format(self.process.pid))
+            try:
+                os.kill(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self.process.join(TERMINATE_TIMEOUT)
+        self.conn.close()
+
+
+class JobCanceller(object):
+    """The connector of a ProcessJob. cleanup() cancels the job's warehouse statements and kills its process."""
+
+    def __init__(self, job):
+        self.job = job
+
+    def cleanup(self):
+        self.job.cancelled = True
+        try:
+            query_ids = cancel_queries(self.job.query_tag)
+            log.log_info('Cancelled queries {} tagged {}'.format(query_ids, self.job.query_tag))
+        except Exception as e:
+            log.log_exception('Failed to cancel queries tagged {}: {}'.format(self.job.query_tag, e))
+        self.job.process.terminate()
+
+
+class ProcessJob(threading.Thread):
+    """
+    Parent side of a job running in a JobProcess. The thread is alive until the process sends the job's outcome,
+    dies, or is cancelled.
+    """
+
+    def __init__(self, pool, process, recommendation, query_tag, affinity=None):
+        super(ProcessJob, self).__init__()
+        self.daemon = True
+        self.pool = pool
+        self.process = process
+        self.recommendation = recommendation
+        self.query_tag = query_tag
+        self.affinity = affinity
+        self.result = None
+        self.exception = None
+        self.message = None
+        self.traceback = ""
+        self.connector = JobCanceller(self)
+        self.done_event = None
+        self.stage_timer = StageTimer()
+        self.cancelled = False
+
+    def run(self):
+        outcome = None
+        try:
+            if self.affinity is not None:
+                self.process.affinity = self.affinity
+            self.process.conn.send((self.recommendation.id, self.query_tag, self.affinity))
+            outcome = self.wait_for_outcome()
+            if outcome is None:
+                self.exception = JobProcessError('job process for {} exited without a result{}'.format(
+                    self.recommendation.id, ' (cancelled)' if self.cancelled else ''))
+            else:
+                self.result = outcome['result']
+                self.message = outcome['message']
+                self.traceback = outcome['traceback']
+                self.stage_timer.timings.update(outcome['stage_timings'])
+                if outcome['error'] is not None:
+                    self.exception = JobProcessError(outcome['error'])
+        except Exception as e:
+            self.exception = JobProcessError('{}: {}'.format(type(e).__name__, e))
+        finally:
+            # a process that was cancelled or died is never reused
+            if outcome is not None and not self.cancelled:
+                self.pool.release(self.process)
+            if self.done_event is not None:
+                self.done_event.set()
+
+    def wait_for_outcome(self):
+        """Return the outcome sent by the process, or None if it died first."""
+        while True:
+            try:
+                if self.process.conn.poll(1):
+                    return self.process.conn.recv()
+            except (EOFError, IOError, OSError):
+                return None
+            if not self.process.is_alive():
+                return None
+
+
+class JobProcessPool(object):
+    """
+    Child processes of one worker. Idle processes are reused for the next job; processes that die or are cancelled
+    are dropped and replaced on demand.
+
+    :param model: RecommendationsPrecompute or PrecomputeQueue; the child loads the job's row from it.
+    :param thread_class: PrecomputeThread or PrecomputeCombinedThread; the child runs the job with it.
+    :param worker_id: Included in the query tag of every job.
+    :param reuse_warehouse_sessions: Whether each child keeps its warehouse connections open between jobs.
+    """
+
+    def __init__(self, model, thread_class, worker_id, reuse_warehouse_sessions=False):
+        self.model = model
+        self.thread_class = thread_class
+        self.worker_id = worker_id
+        self.reuse_warehouse_sessions = reuse_warehouse_sessions
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def job(self, recommendation, affinity=None):
+        """
+        Return an unstarted ProcessJob for the recommendation on an idle (or new) process, preferring the one that
+        last ran a job with the same affinity.
+        """
+        process = None
+        with self.lock:
+            self.idle = [idle for idle in self.idle if idle.is_alive()]
+            for i in range(len(self.idle) - 1, -1, -1):
+                if self.idle[i].affinity == affinity:
+                    process = self.idle.pop(i)
+                    break
+            if process is None and self.idle:
+                process = self.idle.pop()
+        if process is None:
+            process = JobProcess(self.model, self.thread_class, self.reuse_warehouse_sessions)
+        return ProcessJob(self, process, recommendation, get_query_tag(self.worker_id, recommendation), affinity)
+
+    def release(self, process):
+        """Make the process of a finished job available for the next one."""
+        if process.is_alive():
+            with self.lock:
+                self.idle.append(process)
+
+    def close(self):
+        """Stop the idle processes. Processes still running a job are daemonic and die with the worker."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for process in idle:
+            process.stop()
+        deadline = time.time() + TERMINATE_TIMEOUT
+        for process in idle:
+            process.process.join(max(0, deadline - time.time()))
+        for process in idle:
+            if process.is_alive():
+                process.terminate()
@@ -1,10 +1,16 @@
+import datetime
+
 import monetate.retailer.models as retailer_models
 from monetate.recs.models import AccountRecommendationSetting
 from monetate_monitoring import log
 from sqlalchemy.sql import text
 
 from . import offline
+from . import pair_counts
+from . import precompute_rollups
 from . import precompute_utils
+from . import purchase_tables
+from .precompute_history import job_stage
 
 MIN_PURCHASE_THRESHOLD = 3
 
@@ -12,14 +18,18 @@ MIN_PURCHASE_THRESHOLD = 3
 # example  6814_None_None
 GET_ONLINE_LAST_PURCHASE_PER_MID_AND_PID = """
 CREATE TEMPORARY TABLE IF NOT EXISTS scratch.last_purchase_per_mid_and_pid_{account_id}_{market_id}_{retailer_id}_{lookback_days} AS
+{device_products}
+"""
+
+# the rows of GET_ONLINE_LAST_PURCHASE_PER_MID_AND_PID read from the facts, see precompute_rollups for the rollups
+ONLINE_LAST_PURCHASE_PER_MID_AND_PID = """
 SELECT account_id, mid_epoch, mid_ts, mid_rnd, product_id, max(fact_time) as fact_time
 FROM m_dedup_purchase_line
 WHERE account_id in (:account_ids)
     AND fact_time >= :begin_fact_time
     /* exclude empty string to prevent empty lookup keys, filter out common invalid values to reduce join size */
     AND product_id NOT IN ('', 'null', 'NULL')
-GROUP BY 1, 2, 3, 4, 5
-"""
+GROUP BY 1, 2, 3, 4, 5"""
 
 
 ONLINE_OFFLINE_PAP_QUERY = """
@@ -207,27 +217,56 @@ SOURCE_DATA_DISPATCH = {
 }
 
 
-def run_purchase_queries(account, account_ids, market, retailer, lookback_days, algorithm,
-                                    purchase_data_source, begin_fact_time, account_ids_dataset_ids, min_count, conn):
-    if purchase_data_source == "online_offline":
-        # execute both online and offline helper queries and aggregated final papa query
-        conn.execute(text(GET_ONLINE_LAST_PURCHASE_PER_MID_AND_PID.format(account_id=account, market_id=market,
-                                                          retailer_id=retailer, lookback_days=lookback_days)),
-                                                          account_ids=account_ids, begin_fact_time=begin_fact_time)
-        conn.execute(text(offline.GET_OFFLINE_PURCHASE_PER_CUSTOMER_AND_PID.format(account_id=account, market_id=market,
-                                                           retailer_id=retailer, lookback_days=lookback_days)),
-                     account_ids=account_ids, begin_fact_time=begin_fact_time, aids_dids=account_ids_dataset_ids)
-        conn.execute(text(QUERY_DISPATCH[algorithm][purchase_data_source].
-                          format(algorithm=algorithm, account_id=account, market_id=market, retailer_id=retailer,
-                                 lookback_days=lookback_days, purchase_data_source=purchase_data_source)),
-                     minimum_count=min_count)
-    # offline only or online only
+def create_online_purchase_table(conn, algorithm, table_params, account_ids, begin_fact_time, end_fact_time):
+    if precompute_rollups.uses_pair_rollups(algorithm):
+        precompute_rollups.create_device_table_from_rollups(
+            conn, algorithm, GET_ONLINE_LAST_PURCHASE_PER_MID_AND_PID, table_params, account_ids, begin_fact_time,
+            end_fact_time)
     else:
-        conn.execute(text(SOURCE_DATA_DISPATCH[purchase_data_source].
-                          format(account_id=account, market_id=market, retailer_id=retailer, lookback_days=lookback_days)),
-                     begin_fact_time=begin_fact_time, account_ids=account_ids, aids_dids=account_ids_dataset_ids)
-        conn.execute(text(QUERY_DISPATCH[algorithm][purchase_data_source].format(algorithm=algorithm, account_id=account,
-                     market_id=market, retailer_id=retailer, lookback_days=lookback_days)), minimum_count=min_count)
+        conn.execute(text(GET_ONLINE_LAST_PURCHASE_PER_MID_AND_PID.format(
+            device_products=ONLINE_LAST_PURCHASE_PER_MID_AND_PID, **table_params)),
+            account_ids=account_ids, begin_fact_time=begin_fact_time)
+
+
+def run_purchase_queries(account, account_ids, market, retailer, lookback_days, algorithm,
+                                    purchase_data_source, begin_fact_time, account_ids_dataset_ids, min_count, conn,
+                                    candidate_limit=None, end_fact_time=None):
+    """Build the pair table of the job, or its pid ranks if they were counted in process; return whether the latter."""
+    table_params = dict(account_id=account, market_id=market, retailer_id=retailer, lookback_days=lookback_days)
+    if end_fact_time is None:
+        end_fact_time = begin_fact_time + datetime.timedelta(days=lookback_days)
+    # purchase events and pairs read by entries with the same inputs are built once per session
+    offline_version = purchase_tables.get_events_version(begin_fact_time, account_ids, account_ids_dataset_ids)
+    events_version = offline_version + (precompute_rollups.uses_pair_rollups(algorithm),)
+    if purchase_data_source in ("online", "online_offline"):
+        purchase_tables.ensure_table(
+            conn, 'scratch.last_purchase_per_mid_and_pid_{account_id}_{market_id}_{retailer_id}_{lookback_days}'
+            .format(**table_params), events_version,
+            lambda: create_online_purchase_table(conn, algorithm, table_params, account_ids, begin_fact_time,
+                                                 end_fact_time))
+    if purchase_data_source in ("offline", "online_offline"):
+        purchase_tables.ensure_table(
+            conn, 'scratch.offline_purchase_per_customer_and_pid_{account_id}_{market_id}_{retailer_id}_{lookback_days}'
+            .format(**table_params), offline_version,
+            lambda: conn.execute(text(offline.GET_OFFLINE_PURCHASE_PER_CUSTOMER_AND_PID.format(**table_params)),
+                                 account_ids=account_ids, begin_fact_time=begin_fact_time,
+                                 aids_dids=account_ids_dataset_ids))
+    if purchase_data_source == 'online' and pair_counts.rank_pairs_in_process(
+            conn, algorithm,
+            'scratch.last_purchase_per_mid_and_pid_{account_id}_{market_id}_{retailer_id}_{lookback_days}'
+            .format(**table_params),
+            'scratch.pid_ranks_{}_{account_id}_{market_id}_{retailer_id}_{lookback_days}'
+            .format(algorithm, **table_params),
+            minimum_count=min_count, candidate_limit=candidate_limit):
+        return True
+    pair_algorithm = purchase_tables.get_pair_algorithm(algorithm)
+    purchase_tables.ensure_table(
+        conn, 'scratch.{}_{account_id}_{market_id}_{retailer_id}_{lookback_days}_{}'
+        .format(pair_algorithm, purchase_data_source, **table_params), events_version + (min_count,),
+        lambda: conn.execute(text(QUERY_DISPATCH[pair_algorithm][purchase_data_source].format(
+            algorithm=pair_algorithm, purchase_data_source=purchase_data_source, **table_params)),
+            minimum_count=min_count))
+    return False
 
 
 def process_purchase_collab_algorithm(conn, queue_entry):
@@ -258,12 +297,21 @@ def process_purchase_collab_algorithm(conn, queue_entry):
     # we only want to run online if the account has no pos datasets
     if not account_ids_dataset_ids and queue_entry.purchase_data_source in ["online_offline", "offline"]:
         purchase_data_source = "online"
-    run_purchase_queries(account, account_ids, market, retailer, lookback_days, algorithm,
-                                    purchase_data_source, begin_fact_time, account_ids_dataset_ids, min_count, conn)
+    pair_algorithm = purchase_tables.get_pair_algorithm(algorithm)
+    candidate_limit = precompute_utils.get_pid_candidate_limit(queue_entry)
+    log.log_info('Keeping {} candidates per lookup key'.format(candidate_limit or 'all'))
+    with job_stage('metric'):
+        ranked_in_process = run_purchase_queries(account, account_ids, market, retailer, lookback_days, algorithm,
+                                                 purchase_data_source, begin_fact_time, account_ids_dataset_ids,
+                                                 min_count, conn, candidate_limit=candidate_limit,
+                                                 end_fact_time=end_fact_time)
     # normalize score
-    conn.execute(text(precompute_utils.PID_RANKS_BY_COLLAB_RECSET.format(algorithm=algorithm, account_id=account,
-                                                 lookback_days=lookback_days, market_id=market, retailer_id=retailer,
-                                                 purchase_data_source=purchase_data_source)))
+    if not ranked_in_process:
+        with job_stage('pid_rank'):
+            conn.execute(text(precompute_utils.get_pid_ranks_query(algorithm, account, market, retailer, lookback_days,
+                                                                   purchase_data_source,
+                                                                   pair_algorithm=pair_algorithm,
+                                                                   candidate_limit=candidate_limit)))
     result_counts = precompute_utils.process_collab_recsets(conn, queue_entry, account, market, retailer)
 
     log.log_info('Completed processing queue entry {}'.format(queue_entry.id))
@@ -1,12 +1,11 @@
-import contextlib
 import os
 from django.conf import settings
 from monetate.common import job_timing
 from monetate_monitoring import log
-from sqlalchemy import create_engine
-from sqlalchemy.pool import NullPool
 
+from . import catalog_snapshots
 from . import precompute_utils
+from .warehouse_session import warehouse_connection
 
 log.configure_script_log('precompute_purchase_value_algorithm')
 
@@ -104,20 +103,23 @@ FROM (
 GROUP BY 1, 2, 3, 4
 """
 
-def precompute_purchase_value_algorithm(recsets):
+def precompute_purchase_value_algorithm(recsets, account_ids=None):
     result_counts = []
-    # Disable pooling so temp tables do not persist on connections returned to pool
-    engine = create_engine(settings.SNOWFLAKE_QUERY_DSN, poolclass=NullPool)
-    with job_timing.job_timer('precompute_purchase_value_algorithm'), contextlib.closing(engine.connect()) as \
-            warehouse_conn:
-        warehouse_conn.execute("use warehouse {}".format(
-            getattr(settings, 'RECS_QUERY_WH', os.environ.get('RECS_QUERY_WH', 'QUERY2_WH'))))
+    # recsets processed on the connection share the metric tables built for their keys
+    metric_tables = precompute_utils.MetricTableBatch()
+    with job_timing.job_timer('precompute_purchase_value_algorithm'), warehouse_connection(
+            getattr(settings, 'RECS_QUERY_WH', os.environ.get('RECS_QUERY_WH', 'QUERY2_WH'))) as warehouse_conn:
         for recset in recsets:
             if recset and recset.algorithm == 'purchase_value':
                 log.log_info('processing recset {}'.format(recset.id))
                 result_counts.append(precompute_utils.process_noncollab_algorithm(warehouse_conn, recset,
                                                                                   ONLINE_PURCHASE_VALUE,
                                                                                   OFFLINE_PURCHASE_VALUE,
-                                                                                  ONLINE_OFFLINE_PURCHASE_VALUE))
+                                                                                  ONLINE_OFFLINE_PURCHASE_VALUE,
+                                                                                  account_ids=account_ids,
+                                                                                  metric_tables=metric_tables))
+        log.log_info('reduced catalog cache hits: {}, misses: {}'.format(
+            *catalog_snapshots.pop_reduced_catalog_stats(warehouse_conn)))
+    log.log_info('metric table scans saved: {}'.format(metric_tables.scans_saved))
     log.log_info('ending precompute_purchase_value_algorithm process')
     return result_counts
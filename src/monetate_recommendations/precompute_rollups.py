@@ -0,0 +1,481 @@
+"""
+Daily Metric Rollups
+====================
+
+Builds the online metric tables of the noncollab algorithms from persistent daily rollups instead of scanning the
+whole lookback window of fact_product_view / m_dedup_purchase_line (joined to m_session_first_geo) on every run.
+
+  - Two rollup tables hold per (account, day, product_id, country_code, region) aggregates: product views, and
+    purchased quantity and value (in the account's currency, at the exchange rate of the purchase day).
+  - Before a metric table is built, the closed days (before today) of its window that are not rolled up yet for its
+    accounts are loaded; recs_metric_rollup_days records which (rollup, account, day) are loaded and when. Usually
+    that is only the last ROLLUP_SETTLE_DAYS, so a 30 day metric table costs a couple of days of fact scanning. Loads
+    are MERGEs, so a day loaded again (e.g. by two workers at once) is not counted twice.
+  - Facts (and sessions) arrive late, so a day only counts as loaded once it was loaded more than ROLLUP_SETTLE_DAYS
+    after it ended. Until then it is loaded again on every run, picking up the facts that arrived since.
+  - The metric table is then the sum of the rollups over the window of get_fact_time, with the same columns as the
+    query it replaces.
+  - Rollup rows older than ROLLUP_RETENTION_DAYS are deleted when new days are loaded.
+
+Facts are attributed to the geo of their session as before; a day's facts are joined to the sessions within the
+session time bounds of that day. Facts that arrive more than ROLLUP_SETTLE_DAYS after their day are not picked
+up.
+
+Enabled with RECS_METRIC_ROLLUPS=true. The tables are created in RECS_METRIC_ROLLUP_SCHEMA.
+
+Device Rollups
+--------------
+The collab algorithms (purchase_also_purchase, bought_together, subsequently_purchased and view_also_view) join the
+products of each device over the whole lookback window. Enabled separately with RECS_COLLAB_PAIR_ROLLUPS=true, the
+per device tables they join (last_purchase_per_mid_and_pid and the device views of earliest_view_per_mid_and_pid) are
+built from daily device rollups instead of scanning the window of facts.
+
+  - A device rollup holds, per (account, day, device, product), the last purchase (or first view) of that day. It is
+    loaded like the metric rollups, so a run only scans the days that have not settled.
+  - The device table takes the max (or min) over the days of the window, plus today's facts, before the pairs are
+    joined, so pairs and scores are the same as from the facts: pairs bought or viewed on different days are kept,
+    subsequently_purchased compares the last purchases of the window, and each device counts once per pair. The bot
+    filter and device view cap of view_also_view apply to the window as before.
+  - Online purchases are rolled up for online and online_offline recsets; offline purchases are read as before.
+
+Scope: these are device rollups, not pair counts. There are no maintained per-day pair count tables, and
+PID_RANKS_BY_COLLAB_RECSET does not read maintained counts. ONLINE_PAP_QUERY, ONLINE_SUBS_PURCH_QUERY and
+VIEW_ALSO_VIEW still self-join the device table of the whole lookback window on every run, so the pair join costs
+as much as before; only the fact scan shrinks to the unsettled days. Per-day pair counts that add new days and
+subtract expired ones are not exact here: a device that has both products on different days (or on several days)
+counts once per pair over the window, and subsequently_purchased compares the last purchases of the window, so
+neither can be summed from days.
+"""
+
+import collections
+import datetime
+import os
+
+from django.conf import settings
+from monetate.common.warehouse import sqlalchemy_warehouse
+from monetate_monitoring import log
+from sqlalchemy.sql import text
+
+from .precompute_history import job_stage
+
+METRIC_ROLLUPS = getattr(settings, 'RECS_METRIC_ROLLUPS',
+                         os.environ.get('RECS_METRIC_ROLLUPS', 'false').lower() == 'true')
+ROLLUP_SCHEMA = getattr(settings, 'RECS_METRIC_ROLLUP_SCHEMA', os.environ.get('RECS_METRIC_ROLLUP_SCHEMA', 'scratch'))
+COLLAB_PAIR_ROLLUPS = getattr(settings, 'RECS_COLLAB_PAIR_ROLLUPS',
+                              os.environ.get('RECS_COLLAB_PAIR_ROLLUPS', 'false').lower() == 'true')
+# days after which a day's facts are complete; days loaded earlier are loaded again
+ROLLUP_SETTLE_DAYS = int(getattr(settings, 'RECS_METRIC_ROLLUP_SETTLE_DAYS',
+                                 os.environ.get('RECS_METRIC_ROLLUP_SETTLE_DAYS', 2)))
+ROLLUP_RETENTION_DAYS = int(getattr(settings, 'RECS_METRIC_ROLLUP_RETENTION_DAYS',
+                                    os.environ.get('RECS_METRIC_ROLLUP_RETENTION_DAYS', 400)))
+
+CREATE_ROLLUP_DAYS = """
+CREATE TABLE IF NOT EXISTS {schema}.recs_metric_rollup_days (
+    rollup VARCHAR NOT NULL,
+    account_id NUMBER NOT NULL,
+    fact_date DATE NOT NULL,
+    loaded_time TIMESTAMP_NTZ NOT NULL
+)
+"""
+
+CREATE_PRODUCT_VIEW_DAILY = """
+CREATE TABLE IF NOT EXISTS {schema}.recs_product_view_daily (
+    account_id NUMBER NOT NULL,
+    fact_date DATE NOT NULL,
+    product_id VARCHAR NOT NULL,
+    country_code VARCHAR NOT NULL,
+    region VARCHAR NOT NULL,
+    views NUMBER NOT NULL
+)
+CLUSTER BY (fact_date, account_id)
+"""
+
+CREATE_PRODUCT_PURCHASE_DAILY = """
+CREATE TABLE IF NOT EXISTS {schema}.recs_product_purchase_daily (
+    account_id NUMBER NOT NULL,
+    fact_date DATE NOT NULL,
+    product_id VARCHAR NOT NULL,
+    country_code VARCHAR NOT NULL,
+    region VARCHAR NOT NULL,
+    quantity NUMBER NOT NULL,
+    account_value FLOAT
+)
+CLUSTER BY (fact_date, account_id)
+"""
+
+LOADED_ROLLUP_DAYS = """
+SELECT account_id, fact_date
+FROM {schema}.recs_metric_rollup_days
+WHERE rollup = :rollup
+    AND account_id IN (:account_ids)
+    AND fact_date >= :begin_fact_date
+    AND fact_date < :end_fact_date
+    /* days loaded before they settled are loaded again */
+    AND loaded_time >= DATEADD(day, 1 + :settle_days, fact_date)
+"""
+
+LOAD_PRODUCT_VIEW_DAILY = """
+MERGE INTO {schema}.recs_product_view_daily t
+USING (
+    SELECT
+        fpv.account_id,
+        fpv.fact_time::date fact_date,
+        fpv.product_id,
+        COALESCE(s.country_code, '') country_code,
+        COALESCE(s.region, '') region,
+        COUNT(*) views
+    FROM m_session_first_geo s
+    JOIN fact_product_view fpv
+        ON fpv.account_id = s.account_id
+        AND fpv.fact_time BETWEEN s.start_time and s.end_time
+        AND fpv.mid_ts = s.mid_ts
+        AND fpv.mid_rnd = s.mid_rnd
+        AND fpv.fact_time >= :begin_fact_time
+        AND fpv.fact_time < :end_fact_time
+    WHERE s.account_id IN (:account_ids)
+        AND s.start_time >= :begin_session_time
+        AND s.start_time < :end_session_time
+        AND fpv.product_id IS NOT NULL
+    GROUP BY 1, 2, 3, 4, 5
+) d
+ON t.fact_date >= :begin_fact_date
+    AND t.fact_date < :end_fact_date
+    AND t.account_id = d.account_id
+    AND t.fact_date = d.fact_date
+    AND t.product_id = d.product_id
+    AND t.country_code = d.country_code
+    AND t.region = d.region
+WHEN MATCHED THEN UPDATE SET views = d.views
+WHEN NOT MATCHED THEN INSERT (account_id, fact_date, product_id, country_code, region, views)
+    VALUES (d.account_id, d.fact_date, d.product_id, d.country_code, d.region, d.views)
+"""
+
+LOAD_PRODUCT_PURCHASE_DAILY = """
+MERGE INTO {schema}.recs_product_purchase_daily t
+USING (
+    SELECT
+        fpl.account_id,
+        fpl.fact_time::date fact_date,
+        fpl.product_id,
+        COALESCE(s.country_code, '') country_code,
+        COALESCE(s.region, '') region,
+        SUM(fpl.quantity) quantity,
+        SUM(fpl.quantity * fpl.currency_unit_price * ex.rate) account_value
+    FROM m_session_first_geo s
+    JOIN m_dedup_purchase_line fpl
+        ON fpl.account_id = s.account_id
+        AND fpl.fact_time BETWEEN s.start_time and s.end_time
+        AND fpl.mid_ts = s.mid_ts
+        AND fpl.mid_rnd = s.mid_rnd
+        AND fpl.fact_time >= :begin_fact_time
+        AND fpl.fact_time < :end_fact_time
+        AND fpl.product_id is NOT NULL
+    LEFT JOIN config_account a
+        ON a.account_id = fpl.account_id
+    LEFT JOIN exchange_rate ex
+        ON ex.effective_date::date = fpl.fact_time::date
+        AND ex.from_currency_code = fpl.currency
+        AND ex.to_currency_code = a.currency
+    WHERE s.account_id IN (:account_ids)
+        AND s.start_time >= :begin_session_time
+        AND s.start_time < :end_session_time
+    GROUP BY 1, 2, 3, 4, 5
+) d
+ON t.fact_date >= :begin_fact_date
+    AND t.fact_date < :end_fact_date
+    AND t.account_id = d.account_id
+    AND t.fact_date = d.fact_date
+    AND t.product_id = d.product_id
+    AND t.country_code = d.country_code
+    AND t.region = d.region
+WHEN MATCHED THEN UPDATE SET quantity = d.quantity, account_value = d.account_value
+WHEN NOT MATCHED THEN INSERT (account_id, fact_date, product_id, country_code, region, quantity, account_value)
+    VALUES (d.account_id, d.fact_date, d.product_id, d.country_code, d.region, d.quantity, d.account_value)
+"""
+
+CREATE_DEVICE_PRODUCT_DAILY = """
+CREATE TABLE IF NOT EXISTS {{schema}}.{table} (
+    account_id NUMBER NOT NULL,
+    fact_date DATE NOT NULL,
+    mid_epoch NUMBER NOT NULL,
+    mid_ts NUMBER NOT NULL,
+    mid_rnd NUMBER NOT NULL,
+    product_id VARCHAR NOT NULL,
+    fact_time TIMESTAMP_NTZ NOT NULL
+)
+CLUSTER BY (fact_date, account_id)
+"""
+
+# merges the {aggregate} fact_time per (account, day, device, product) of {fact_table} into {table}
+LOAD_DEVICE_PRODUCT_DAILY = """
+MERGE INTO {{schema}}.{table} t
+USING (
+    SELECT
+        account_id, fact_time::date fact_date, mid_epoch, mid_ts, mid_rnd, product_id, {aggregate}(fact_time) fact_time
+    FROM {fact_table}
+    WHERE account_id IN (:account_ids)
+        AND fact_time >= :begin_fact_time
+        AND fact_time < :end_fact_time
+        /* exclude empty string to prevent empty lookup keys, filter out common invalid values */
+        AND product_id NOT IN ('', 'null', 'NULL')
+    GROUP BY 1, 2, 3, 4, 5, 6
+) d
+ON t.fact_date >= :begin_fact_date
+    AND t.fact_date < :end_fact_date
+    AND t.account_id = d.account_id
+    AND t.fact_date = d.fact_date
+    AND t.mid_epoch = d.mid_epoch
+    AND t.mid_ts = d.mid_ts
+    AND t.mid_rnd = d.mid_rnd
+    AND t.product_id = d.product_id
+WHEN MATCHED THEN UPDATE SET fact_time = d.fact_time
+WHEN NOT MATCHED THEN INSERT (account_id, fact_date, mid_epoch, mid_ts, mid_rnd, product_id, fact_time)
+    VALUES (d.account_id, d.fact_date, d.mid_epoch, d.mid_ts, d.mid_rnd, d.product_id, d.fact_time)
+"""
+
+MARK_ROLLUP_DAYS = """
+MERGE INTO {schema}.recs_metric_rollup_days t
+USING (
+    SELECT a.value::number account_id, DATEADD(day, d.value::number, :begin_fact_date::date) fact_date
+    FROM TABLE(FLATTEN(input => PARSE_JSON(:account_ids_json))) a,
+        TABLE(FLATTEN(input => ARRAY_GENERATE_RANGE(0, :days))) d
+) l
+ON t.rollup = :rollup
+    AND t.account_id = l.account_id
+    AND t.fact_date = l.fact_date
+WHEN MATCHED THEN UPDATE SET loaded_time = CURRENT_TIMESTAMP()::timestamp_ntz
+WHEN NOT MATCHED THEN INSERT (rollup, account_id, fact_date, loaded_time)
+    VALUES (:rollup, l.account_id, l.fact_date, CURRENT_TIMESTAMP()::timestamp_ntz)
+"""
+
+EXPIRE_ROLLUP = """
+DELETE FROM {schema}.{table}
+WHERE fact_date < :expire_fact_date
+"""
+
+EXPIRE_ROLLUP_DAYS = """
+DELETE FROM {schema}.recs_metric_rollup_days
+WHERE rollup = :rollup
+    AND fact_date < :expire_fact_date
+"""
+
+# The online metric tables, summed from the rollups. Columns match the queries they replace.
+ROLLUP_METRIC = """
+CREATE TEMPORARY TABLE IF NOT EXISTS scratch.{algorithm}_{account_id}_{lookback}_{market_id}_{retailer_scope}_online AS
+/* Recs metrics: {algorithm}, account {account_id}, {lookback} day,_{market_id} market, {retailer_scope} retailer_scope rollups */
+SELECT
+    account_id,
+    product_id,
+    country_code,
+    region,
+    SUM({measure}) as subtotal
+FROM {schema}.{table}
+WHERE account_id IN (:account_ids)
+    AND fact_date >= :begin_fact_date
+    AND fact_date < :end_fact_date
+GROUP BY 1, 2, 3, 4
+HAVING SUM({measure}) IS NOT NULL
+"""
+
+ROLLUP_TRENDING_METRIC = """
+CREATE TEMPORARY TABLE IF NOT EXISTS scratch.{algorithm}_{account_id}_7_{market_id}_{retailer_scope}_online AS
+WITH purchase_line as (
+SELECT
+    account_id,
+    product_id,
+    country_code,
+    region,
+    SUM(quantity) as subtotal_30,
+    SUM(IFF(fact_date >= :begin_fact_date, quantity, 0)) as subtotal_7
+FROM {schema}.recs_product_purchase_daily
+WHERE account_id IN (:account_ids)
+    AND fact_date >= :begin_30_day_fact_date
+    AND fact_date < :end_30_day_fact_date
+GROUP BY 1, 2, 3, 4
+)
+SELECT account_id,
+    product_id,
+    country_code,
+    region,
+    subtotal_7/subtotal_30 as subtotal
+FROM purchase_line
+WHERE subtotal_7 >= 5
+"""
+
+# The {aggregate} fact_time per (account, device, product) over the window of a collab algorithm: the closed days from
+# the rollup, the open day (since end_fact_time) from the facts. Columns match the device tables the pairs are joined
+# from.
+ROLLUP_DEVICE_PRODUCTS = """
+    SELECT account_id, mid_epoch, mid_ts, mid_rnd, product_id, {aggregate}(fact_time) fact_time
+    FROM (
+        SELECT account_id, mid_epoch, mid_ts, mid_rnd, product_id, fact_time
+        FROM {{schema}}.{table}
+        WHERE account_id IN (:account_ids)
+            AND fact_date >= :begin_fact_date
+            AND fact_date < :end_fact_date
+        UNION ALL
+        SELECT account_id, mid_epoch, mid_ts, mid_rnd, product_id, fact_time
+        FROM {fact_table}
+        WHERE account_id IN (:account_ids)
+            AND fact_time >= :end_fact_time
+            AND product_id NOT IN ('', 'null', 'NULL')
+    )
+    GROUP BY 1, 2, 3, 4, 5"""
+
+Rollup = collections.namedtuple('Rollup', ['name', 'table', 'create_sql', 'load_sql'])
+# a device product rollup, with the query of its window (see ROLLUP_DEVICE_PRODUCTS)
+DeviceRollup = collections.namedtuple('DeviceRollup', Rollup._fields + ('window_sql',))
+
+VIEW_ROLLUP = Rollup('product_view', 'recs_product_view_daily', CREATE_PRODUCT_VIEW_DAILY, LOAD_PRODUCT_VIEW_DAILY)
+PURCHASE_ROLLUP = Rollup('product_purchase', 'recs_product_purchase_daily', CREATE_PRODUCT_PURCHASE_DAILY,
+                         LOAD_PRODUCT_PURCHASE_DAILY)
+
+
+def get_device_rollup(name, table, fact_table, aggregate):
+    params = dict(table=table, fact_table=fact_table, aggregate=aggregate)
+    return DeviceRollup(name, table, CREATE_DEVICE_PRODUCT_DAILY.format(**params),
+                        LOAD_DEVICE_PRODUCT_DAILY.format(**params), ROLLUP_DEVICE_PRODUCTS.format(**params))
+
+
+# last purchase of a product by a device, as in last_purchase_per_mid_and_pid
+DEVICE_PURCHASE_ROLLUP = get_device_rollup('device_purchase', 'recs_device_purchase_daily', 'm_dedup_purchase_line',
+                                           'MAX')
+# first view of a product by a device, as in earliest_view_per_mid_and_pid
+DEVICE_VIEW_ROLLUP = get_device_rollup('device_view', 'recs_device_view_daily', 'fact_product_view', 'MIN')
+
+# algorithm: (rollup, measure summed into subtotal)
+ALGORITHM_ROLLUPS = {
+    'view': (VIEW_ROLLUP, 'views'),
+    'most_popular': (VIEW_ROLLUP, 'views'),
+    'purchase': (PURCHASE_ROLLUP, 'quantity'),
+    'purchase_value': (PURCHASE_ROLLUP, 'account_value'),
+    'trending': (PURCHASE_ROLLUP, 'quantity'),
+}
+
+# collab algorithm: device product rollup
+ALGORITHM_DEVICE_ROLLUPS = {
+    'purchase_also_purchase': DEVICE_PURCHASE_ROLLUP,
+    'bought_together': DEVICE_PURCHASE_ROLLUP,
+    'subsequently_purchased': DEVICE_PURCHASE_ROLLUP,
+    'view_also_view': DEVICE_VIEW_ROLLUP,
+}
+
+
+def uses_rollups(algorithm):
+    return METRIC_ROLLUPS and algorithm in ALGORITHM_ROLLUPS
+
+
+def uses_pair_rollups(algorithm):
+    return COLLAB_PAIR_ROLLUPS and algorithm in ALGORITHM_DEVICE_ROLLUPS
+
+
+def get_missing_day_ranges(account_ids, loaded_days, begin_fact_date, end_fact_date):
+    """
+    Return the days in [begin_fact_date, end_fact_date) not in loaded_days (a set of (account_id, date)) as a list of
+    (account_ids, begin date, end date), so accounts missing the same days are loaded together.
+    """
+    missing = collections.OrderedDict()
+    day = begin_fact_date
+    while day < end_fact_date:
+        accounts = tuple(sorted(account_id for account_id in set(account_ids) if (account_id, day) not in loaded_days))
+        if accounts:
+            missing.setdefault(accounts, []).append(day)
+        day += datetime.timedelta(days=1)
+
+    ranges = []
+    for accounts, days in missing.items():
+        begin = end = days[0]
+        for day in days:
+            if day != end:
+                ranges.append((list(accounts), begin, end))
+                begin = day
+            end = day + datetime.timedelta(days=1)
+        ranges.append((list(accounts), begin, end))
+    return ranges
+
+
+def ensure_rollups(conn, rollup, account_ids, begin_fact_date, end_fact_date):
+    """
+    Load the days of [begin_fact_date, end_fact_date) that are not rolled up yet for the accounts, or were rolled up
+    before they settled.
+
+    :return: the number of days loaded, summed over the accounts
+    """
+    schema = ROLLUP_SCHEMA
+    conn.execute(text(CREATE_ROLLUP_DAYS.format(schema=schema)))
+    conn.execute(text(rollup.create_sql.format(schema=schema)))
+    loaded_days = set(
+        (account_id, fact_date) for account_id, fact_date in conn.execute(
+            text(LOADED_ROLLUP_DAYS.format(schema=schema)), rollup=rollup.name, account_ids=account_ids,
+            begin_fact_date=begin_fact_date, end_fact_date=end_fact_date, settle_days=ROLLUP_SETTLE_DAYS))
+
+    days_loaded = 0
+    for range_account_ids, begin_date, end_date in get_missing_day_ranges(account_ids, loaded_days,
+                                                                          begin_fact_date, end_fact_date):
+        log.log_info('Rolling up {} for accounts {} from {} to {}'.format(rollup.name, range_account_ids,
+                                                                          begin_date, end_date))
+        begin_fact_time = datetime.datetime.combine(begin_date, datetime.time())
+        end_fact_time = datetime.datetime.combine(end_date, datetime.time())
+        begin_session_time, end_session_time = sqlalchemy_warehouse.get_session_time_bounds(begin_fact_time,
+                                                                                             end_fact_time)
+        conn.execute(text(rollup.load_sql.format(schema=schema)), account_ids=range_account_ids,
+                     begin_fact_time=begin_fact_time, end_fact_time=end_fact_time,
+                     begin_session_time=begin_session_time, end_session_time=end_session_time,
+                     begin_fact_date=begin_date, end_fact_date=end_date)
+        days = (end_date - begin_date).days
+        conn.execute(text(MARK_ROLLUP_DAYS.format(schema=schema)), rollup=rollup.name,
+                     account_ids_json='[{}]'.format(','.join(str(int(account_id)) for account_id in range_account_ids)),
+                     begin_fact_date=begin_date, days=days)
+        days_loaded += days * len(range_account_ids)
+
+    if days_loaded:
+        expire_fact_date = datetime.date.today() - datetime.timedelta(days=ROLLUP_RETENTION_DAYS)
+        conn.execute(text(EXPIRE_ROLLUP.format(schema=schema, table=rollup.table)), expire_fact_date=expire_fact_date)
+        conn.execute(text(EXPIRE_ROLLUP_DAYS.format(schema=schema)), rollup=rollup.name,
+                     expire_fact_date=expire_fact_date)
+    return days_loaded
+
+
+def create_metric_table_from_rollups(conn, algorithm, account_ids, table_params, begin_fact_time, end_fact_time,
+                                     begin_30_day_fact_time=None, end_30_day_fact_time=None):
+    """
+    Build the online metric table of an algorithm (named by table_params, as for its fact query) from the rollups,
+    loading the days of its window that are missing first.
+    """
+    rollup, measure = ALGORITHM_ROLLUPS[algorithm]
+    begin_fact_date, end_fact_date = begin_fact_time.date(), end_fact_time.date()
+    params = dict(account_ids=account_ids, begin_fact_date=begin_fact_date, end_fact_date=end_fact_date)
+    if algorithm == 'trending':
+        params.update(begin_30_day_fact_date=begin_30_day_fact_time.date(),
+                      end_30_day_fact_date=end_30_day_fact_time.date())
+        query = ROLLUP_TRENDING_METRIC
+    else:
+        query = ROLLUP_METRIC
+    with job_stage('rollup'):
+        days_loaded = ensure_rollups(conn, rollup, account_ids,
+                                     min(begin_fact_date, params.get('begin_30_day_fact_date', begin_fact_date)),
+                                     end_fact_date)
+    log.log_info('Rolled up {} account days of {} for {}'.format(days_loaded, rollup.name, algorithm))
+    conn.execute(text(query.format(schema=ROLLUP_SCHEMA, table=rollup.table, measure=measure, algorithm=algorithm,
+                                   **table_params)),
+                 **params)
+
+
+def create_device_table_from_rollups(conn, algorithm, query, table_params, account_ids, begin_fact_time,
+                                     end_fact_time, **params):
+    """
+    Create the device product table of a collab algorithm from the rollups, loading the days of its window that are
+    missing first.
+
+    :param query: The CREATE of the table, formatted with table_params and the rows per (account, device, product)
+        of the window as {device_products}
+    :param params: The other parameters of query
+    """
+    rollup = ALGORITHM_DEVICE_ROLLUPS[algorithm]
+    begin_fact_date, end_fact_date = begin_fact_time.date(), end_fact_time.date()
+    with job_stage('rollup'):
+        days_loaded = ensure_rollups(conn, rollup, account_ids, begin_fact_date, end_fact_date)
+    log.log_info('Rolled up {} account days of {} for {}'.format(days_loaded, rollup.name, algorithm))
+    conn.execute(text(query.format(device_products=rollup.window_sql.format(schema=ROLLUP_SCHEMA), **table_params)),
+                 account_ids=account_ids, begin_fact_date=begin_fact_date, end_fact_date=end_fact_date,
+                 end_fact_time=end_fact_time, **params)
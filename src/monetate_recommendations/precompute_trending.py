@@ -1,24 +1,26 @@
-import contextlib
 import os
 from django.conf import settings
 from monetate.common import job_timing
 from monetate_monitoring import log
-from sqlalchemy import create_engine
-from sqlalchemy.pool import NullPool
 
+from . import catalog_snapshots
 from . import precompute_utils
+from .warehouse_session import warehouse_connection
 
 log.configure_script_log('precompute_trending_algorithm')
 
+# Both windows come from one scan of the last 30 days: the 30 day subtotal sums every line, the 7 day (lookback)
+# subtotal only the lines since :begin_7_day_fact_time.
 ONLINE_TRENDING = """
 CREATE TEMPORARY TABLE IF NOT EXISTS scratch.{algorithm}_{account_id}_7_{market_id}_{retailer_scope}_online AS
-WITH purchase_line_30 as (
+WITH purchase_line as (
 SELECT
     s.account_id,
     fpl.product_id,
     COALESCE(s.country_code, '') country_code,
     COALESCE(s.region, '') region,
-    SUM(fpl.quantity) as subtotal
+    SUM(fpl.quantity) as subtotal_30,
+    SUM(IFF(fpl.fact_time >= :begin_7_day_fact_time, fpl.quantity, 0)) as subtotal_7
 FROM m_session_first_geo s
 JOIN m_dedup_purchase_line fpl
 ON fpl.account_id = s.account_id
@@ -31,77 +33,41 @@ ON fpl.account_id = s.account_id
 WHERE s.start_time >= :begin_30_day_session_time
     AND s.start_time < :end_30_day_session_time
     AND s.account_id IN (:account_ids)
-GROUP BY 1, 2, 3, 4),
-purchase_line_7 as (
-SELECT
-    s.account_id,
-    fpl.product_id,
-    COALESCE(s.country_code, '') country_code,
-    COALESCE(s.region, '') region,
-    SUM(fpl.quantity) as subtotal
-FROM m_session_first_geo s
-JOIN m_dedup_purchase_line fpl
-ON fpl.account_id = s.account_id
-    AND fpl.fact_time BETWEEN s.start_time and s.end_time
-    AND fpl.mid_ts = s.mid_ts
-    AND fpl.mid_rnd = s.mid_rnd
-    AND fpl.fact_time >= :begin_7_day_fact_time
-    AND fpl.fact_time < :end_7_day_fact_time
-    AND fpl.product_id is NOT NULL
-WHERE s.start_time >= :begin_7_day_session_time
-    AND s.start_time < :end_7_day_session_time
-    AND s.account_id IN (:account_ids)
 GROUP BY 1, 2, 3, 4
-HAVING sum(fpl.quantity) >= 5
 )
-SELECT pl30.account_id,
-    pl30.product_id,
-    pl30.country_code,
-    pl30.region,
-    pl7.subtotal/pl30.subtotal as subtotal
-FROM purchase_line_30 as pl30
-JOIN purchase_line_7 as pl7
-ON pl30.product_id = pl7.product_id
-AND pl30.country_code = pl7.country_code
-AND pl30.region = pl7.region
+SELECT account_id,
+    product_id,
+    country_code,
+    region,
+    subtotal_7/subtotal_30 as subtotal
+FROM purchase_line
+WHERE subtotal_7 >= 5
 """
 
 OFFLINE_TRENDING = """
 CREATE TEMPORARY TABLE IF NOT EXISTS scratch.{algorithm}_{account_id}_{lookback_days}_{market_id}_{retailer_scope}_offline AS
-WITH purchase_line_30 as (
+WITH purchase_line as (
 SELECT
     p1.account_id,
     '' as country_code,
     '' as region,
     p1.product_id,
-    SUM(p1.quantity) as subtotal
+    SUM(p1.quantity) as subtotal_30,
+    SUM(IFF(p1.fact_time >= :begin_7_day_session_time, p1.quantity, 0)) as subtotal_7,
+    COUNT_IF(p1.fact_time >= :begin_7_day_session_time) as lines_7
 FROM scratch.offline_purchase_per_customer_and_pid_{account_id}_{market_id}_{retailer_id}_{lookback_days} p1
 WHERE
     p1.account_id = :account_id
     AND p1.fact_time >= :begin_30_day_session_time
     AND p1.fact_time < :end_30_day_session_time
-GROUP BY 1, 2, 3, 4),
-purchase_line_7 as (
-SELECT
-    p1.account_id,
-    '' as country_code,
-    '' as region,
-    p1.product_id,
-    SUM(p1.quantity) as subtotal
-FROM scratch.offline_purchase_per_customer_and_pid_{account_id}_{market_id}_{retailer_id}_{lookback_days} p1
-WHERE
-    p1.account_id = :account_id
-    AND p1.fact_time >= :begin_7_day_session_time
-    AND p1.fact_time < :end_7_day_session_time
 GROUP BY 1, 2, 3, 4)
-SELECT pl30.account_id,
-    pl30.country_code,
-    pl30.region,
-    pl30.product_id,
-    pl7.subtotal/pl30.subtotal as subtotal
-FROM purchase_line_30 as pl30
-JOIN purchase_line_7 as pl7
-ON pl30.product_id = pl7.product_id
+SELECT account_id,
+    country_code,
+    region,
+    product_id,
+    subtotal_7/subtotal_30 as subtotal
+FROM purchase_line
+WHERE lines_7 > 0
 """
 
 ONLINE_OFFLINE_TRENDING = """
@@ -132,14 +98,12 @@ ONLINE_OFFLINE_TRENDING = """
     GROUP BY 1, 2, 3, 4
 """
 
-def precompute_trending_algorithm(recsets):
+def precompute_trending_algorithm(recsets, account_ids=None):
     result_counts = []
-    # Disable pooling so temp tables do not persist on connections returned to pool
-    engine = create_engine(settings.SNOWFLAKE_QUERY_DSN, poolclass=NullPool)
-    with job_timing.job_timer('precompute_trending_algorithm'), contextlib.closing(engine.connect()) as \
-            warehouse_conn:
-        warehouse_conn.execute("use warehouse {}".format(
-            getattr(settings, 'RECS_QUERY_WH', os.environ.get('RECS_QUERY_WH', 'QUERY2_WH'))))
+    # recsets processed on the connection share the metric tables built for their keys
+    metric_tables = precompute_utils.MetricTableBatch()
+    with job_timing.job_timer('precompute_trending_algorithm'), warehouse_connection(
+            getattr(settings, 'RECS_QUERY_WH', os.environ.get('RECS_QUERY_WH', 'QUERY2_WH'))) as warehouse_conn:
         for recset in recsets:
             if recset and recset.algorithm == 'trending':
                 log.log_info('processing recset {}'.format(recset.id))
@@ -147,6 +111,11 @@ def precompute_trending_algorithm(recsets):
                 result_counts.append(precompute_utils.process_noncollab_algorithm(warehouse_conn, recset,
                                                                                   ONLINE_TRENDING,
                                                                                   OFFLINE_TRENDING,
-                                                                                  ONLINE_OFFLINE_TRENDING))
+                                                                                  ONLINE_OFFLINE_TRENDING,
+                                                                                  account_ids=account_ids,
+                                                                                  metric_tables=metric_tables))
+        log.log_info('reduced catalog cache hits: {}, misses: {}'.format(
+            *catalog_snapshots.pop_reduced_catalog_stats(warehouse_conn)))
+    log.log_info('metric table scans saved: {}'.format(metric_tables.scans_saved))
     log.log_info('ending precompute_trending_algorithm process')
     return result_counts
@@ -1,6 +1,8 @@
 import binascii
 import bisect
+import collections
 import datetime
+import functools
 import json
 import monetate.dio.models as dio_models
 import monetate.retailer.models as retailer_models
@@ -17,10 +19,15 @@ from monetate_profile.sqlalchemy_session import CLUSTER_MAX
 from sqlalchemy.sql import text
 
 from . import offline
+from . import precompute_rollups
+from . import purchase_tables
 from . import supported_prefilter_expression
 from . import supported_prefilter_expression_v2 as filters
 from . import supported_prefilter_expression_v3 as new_filters
+from .account_pipelines import run_account_pipelines
 from .active import is_strategy_active
+from .catalog_snapshots import get_catalog_snapshot, get_reduced_catalog
+from .precompute_history import job_stage
 from .precompute_constants import UNSUPPORTED_PREFILTER_FIELDS, SUPPORTED_DATA_TYPES, SUPPORTED_PREFILTER_FIELDS, \
     DATA_TYPE_TO_SNOWFLAKE_TYPE
 from .supported_prefilter_expression_v3 import FILTER_MAP
@@ -28,7 +35,26 @@ from .supported_prefilter_expression_v3 import FILTER_MAP
 DATA_JURISDICTION = 'recs_global'
 DATA_JURISDICTION_PID_PID = 'recs_global_pid_pid'
 SESSION_SHARDS = 8
+# 'single' unloads each document set to one gzip file, 'partitioned' to up to UNLOAD_PARTITIONS files written in
+# parallel plus a manifest (see execute_unload)
+UNLOAD_MODE = getattr(settings, 'RECS_PRECOMPUTE_UNLOAD_MODE', os.environ.get('RECS_PRECOMPUTE_UNLOAD_MODE', 'single'))
+UNLOAD_PARTITIONS = int(getattr(settings, 'RECS_PRECOMPUTE_UNLOAD_PARTITIONS',
+                                os.environ.get('RECS_PRECOMPUTE_UNLOAD_PARTITIONS', 16)))
+UNLOAD_MAX_FILE_SIZE = int(getattr(settings, 'RECS_PRECOMPUTE_UNLOAD_MAX_FILE_SIZE',
+                                   os.environ.get('RECS_PRECOMPUTE_UNLOAD_MAX_FILE_SIZE', 256 * 1024 * 1024)))
+# rank retailer level noncollab recsets for all of their accounts in one statement
+CROSS_ACCOUNT_RANKING = getattr(settings, 'RECS_NONCOLLAB_CROSS_ACCOUNT_RANKING',
+                                os.environ.get('RECS_NONCOLLAB_CROSS_ACCOUNT_RANKING', 'true').lower() == 'true')
 MIN_PURCHASE_THRESHOLD = 3
+# collab algorithms with symmetric scores, whose pair tables hold each pair once, as pid1 < pid2
+HALF_PAIR_ALGORITHMS = {'view_also_view'}
+# most candidates kept per lookup key in the pid ranks of a collab job (see get_pid_candidate_limit), 0 for all. The
+# collab recsets rank at most 50 skus per lookup key; the margin covers candidates missing from the catalog.
+PID_CANDIDATE_LIMIT = int(getattr(settings, 'RECS_PID_RANKS_CANDIDATE_LIMIT',
+                                  os.environ.get('RECS_PID_RANKS_CANDIDATE_LIMIT', 1000)))
+# the limit for jobs with filtered recsets, whose filters can drop most candidates; the pid pid feed keeps 10000
+PID_FILTERED_CANDIDATE_LIMIT = int(getattr(settings, 'RECS_PID_RANKS_FILTERED_CANDIDATE_LIMIT',
+                                           os.environ.get('RECS_PID_RANKS_FILTERED_CANDIDATE_LIMIT', 10000)))
 CONTEXT_ATTRIBUTES_ALREADY_ADDED_TO_QUERY = ['item_group_id']
 RECOMMENDATION_ATTRIBUTES_ALREADY_ADDED_TO_QUERY = ['item_group_id', 'id', 'color', 'image_link']
 RECOMMENDATION_ATTRIBUTES_ALREADY_ADDED_TO_GROUP_BY = ['item_group_id', 'color', 'image_link']
@@ -37,6 +63,29 @@ GEO_TARGET_COLUMNS = {
     'region': ["country_code", "region"]
 }
 
+SINGLE_FILE_UNLOAD_OPTIONS = """FILE_FORMAT = (TYPE = JSON, compression='gzip')
+SINGLE=TRUE
+MAX_FILE_SIZE=1000000000"""
+
+# files are named <target prefix>part=<partition>/data_<query id>_<n>_<n>_<n>.json.gz
+PARTITIONED_UNLOAD_OPTIONS = """PARTITION BY ('part=' || LPAD(TO_VARCHAR(ABS(HASH({partition_key})) % {partitions}), 4, '0'))
+FILE_FORMAT = (TYPE = JSON, compression='gzip')
+MAX_FILE_SIZE={max_file_size}
+DETAILED_OUTPUT=TRUE"""
+
+UNLOAD_MANIFEST = """
+COPY
+INTO :target
+FROM (SELECT PARSE_JSON(:manifest))
+FILE_FORMAT = (TYPE = JSON, compression='gzip')
+SINGLE=TRUE
+OVERWRITE=TRUE
+"""
+
+# partition keys of the unload templates: documents keyed by lookup key, or by pushdown filter without one
+LOOKUP_KEY_PARTITION = '$1:document:lookup_key'
+PUSHDOWN_FILTER_PARTITION = '$1:document:pushdown_filter_hash'
+
 SNOWFLAKE_UNLOAD = """
 COPY
 INTO :target
@@ -59,15 +108,41 @@ FROM (
             'id', :recset_id
         )
     )
-    FROM scratch.recset_{account_id}_{recset_id}_ranks
+    FROM {ranks_table}
     {group_by}
 )
-FILE_FORMAT = (TYPE = JSON, compression='gzip')
-SINGLE=TRUE
-MAX_FILE_SIZE=1000000000
+{unload_options}
+"""
+
+SNOWFLAKE_UNLOAD_COLLAB = """
+COPY
+INTO :target
+FROM (
+    SELECT object_construct(
+    'shard_key', :shard_key,
+    'document', object_construct(
+            'lookup_key', lookup_key,
+            'data', (
+                array_agg(object_construct('id', id,  'normalized_score', normalized_score,'rank', rank))
+                WITHIN GROUP (ORDER BY rank ASC)
+            )
+        ),
+        'sent_time', :sent_time,
+        'account', object_construct(
+            'id', :account_id
+        ),
+        'schema', object_construct(
+            'feed_type', 'RECSET_COLLAB_RECS',
+            'id', :recset_id
+        )
+    )
+    FROM scratch.recset_{account_id}_{recset_id}_ranks
+    GROUP BY lookup_key
+)
+{unload_options}
 """
 
-SNOWFLAKE_UNLOAD_2 = """
+SNOWFLAKE_UNLOAD_COLLAB_2 = """
 COPY
 INTO :target
 FROM (
@@ -75,10 +150,10 @@ FROM (
         'shard_key', :shard_key,
         'document', object_construct(
             'pushdown_filter_hash', sha1(LOWER(TO_JSON(object_construct({pushdown_filter_str})))),
-            'lookup_key', '',
+            'lookup_key', lookup_key,
             'pushdown_filter_json', LOWER(TO_JSON(object_construct({pushdown_filter_str}))),
             'data', (
-                array_agg(object_construct('id', id, 'normalized_score', score, 'rank', rank))
+                array_agg(object_construct('id', id, 'normalized_score', normalized_score, 'rank', rank))
                 WITHIN GROUP (ORDER BY rank ASC)
             )
         ),
@@ -92,58 +167,73 @@ FROM (
         )
     )
     FROM scratch.recset_{account_id}_{recset_id}_ranks
-    {group_by}
+    GROUP BY {group_by}
 )
-FILE_FORMAT = (TYPE = JSON, compression='gzip')
-SINGLE=TRUE
-MAX_FILE_SIZE=1000000000
+{unload_options}
+"""
+
+# UNIFIED_PRECOMPUTE accounts get every document in both the legacy and the RECSET_RECS format. The documents are
+# aggregated from the ranks table once into a *_documents table, and both formats are unloaded from it.
+NONCOLLAB_DOCUMENTS = """
+CREATE TEMPORARY TABLE IF NOT EXISTS scratch.recset_{account_id}_{recset_id}_documents AS
+SELECT
+    '' AS lookup_key,
+    sha1(LOWER(CONCAT('product_type=', {dynamic_product_type} {geo_hash_sql}))) AS legacy_pushdown_filter_hash,
+    sha1(LOWER(TO_JSON(object_construct({pushdown_filter_str})))) AS pushdown_filter_hash,
+    LOWER(TO_JSON(object_construct({pushdown_filter_str}))) AS pushdown_filter_json,
+    array_agg(object_construct('id', id, 'normalized_score', score, 'rank', rank))
+        WITHIN GROUP (ORDER BY rank ASC) AS data
+FROM {ranks_table}
+{group_by}
+"""
 
+COLLAB_DOCUMENTS = """
+CREATE TEMPORARY TABLE IF NOT EXISTS scratch.recset_{account_id}_{recset_id}_documents AS
+SELECT
+    lookup_key,
+    sha1(LOWER(TO_JSON(object_construct({pushdown_filter_str})))) AS pushdown_filter_hash,
+    LOWER(TO_JSON(object_construct({pushdown_filter_str}))) AS pushdown_filter_json,
+    array_agg(object_construct('id', id, 'normalized_score', normalized_score, 'rank', rank))
+        WITHIN GROUP (ORDER BY rank ASC) AS data
+FROM scratch.recset_{account_id}_{recset_id}_ranks
+GROUP BY lookup_key
 """
 
-SNOWFLAKE_UNLOAD_COLLAB = """
+SNOWFLAKE_UNLOAD_DOCUMENTS = """
 COPY
 INTO :target
 FROM (
     SELECT object_construct(
-    'shard_key', :shard_key,
-    'document', object_construct(
-            'lookup_key', lookup_key,
-            'data', (
-                array_agg(object_construct('id', id,  'normalized_score', normalized_score,'rank', rank))
-                WITHIN GROUP (ORDER BY rank ASC)
-            )
+        'shard_key', :shard_key,
+        'document', object_construct(
+            {legacy_document_key},
+            'data', data
         ),
         'sent_time', :sent_time,
         'account', object_construct(
             'id', :account_id
         ),
         'schema', object_construct(
-            'feed_type', 'RECSET_COLLAB_RECS',
+            'feed_type', '{feed_type}',
             'id', :recset_id
         )
     )
-    FROM scratch.recset_{account_id}_{recset_id}_ranks
-    GROUP BY lookup_key
+    FROM scratch.recset_{account_id}_{recset_id}_documents
 )
-FILE_FORMAT = (TYPE = JSON, compression='gzip')
-SINGLE=TRUE
-MAX_FILE_SIZE=1000000000
+{unload_options}
 """
 
-SNOWFLAKE_UNLOAD_COLLAB_2 = """
+SNOWFLAKE_UNLOAD_DOCUMENTS_2 = """
 COPY
 INTO :target
 FROM (
     SELECT object_construct(
         'shard_key', :shard_key,
         'document', object_construct(
-            'pushdown_filter_hash', sha1(LOWER(TO_JSON(object_construct({pushdown_filter_str})))),
+            'pushdown_filter_hash', pushdown_filter_hash,
             'lookup_key', lookup_key,
-            'pushdown_filter_json', LOWER(TO_JSON(object_construct({pushdown_filter_str}))),
-            'data', (
-                array_agg(object_construct('id', id, 'normalized_score', normalized_score, 'rank', rank))
-                WITHIN GROUP (ORDER BY rank ASC)
-            )
+            'pushdown_filter_json', pushdown_filter_json,
+            'data', data
         ),
         'sent_time', :sent_time,
         'account', object_construct(
@@ -154,12 +244,9 @@ FROM (
             'id', :recset_id
         )
     )
-    FROM scratch.recset_{account_id}_{recset_id}_ranks
-    GROUP BY {group_by}
+    FROM scratch.recset_{account_id}_{recset_id}_documents
 )
-FILE_FORMAT = (TYPE = JSON, compression='gzip')
-SINGLE=TRUE
-MAX_FILE_SIZE=1000000000
+{unload_options}
 """
 
 SNOWFLAKE_UNLOAD_PID_PID = """
@@ -188,9 +275,7 @@ FROM (
     WHERE ordinal <= 10000
     GROUP BY lookup_key
 )
-FILE_FORMAT = (TYPE = JSON, compression='gzip')
-SINGLE=TRUE
-MAX_FILE_SIZE=1000000000
+{unload_options}
 """
 
 DYNAMIC_FILTER_RANKS = """
@@ -207,11 +292,6 @@ SELECT filtered_scored_records.*,
 FROM filtered_scored_records
 """
 
-RESULT_COUNT = """
-SELECT COUNT(*)
-FROM scratch.recset_{account_id}_{recset_id}_ranks
-"""
-
 # SKU ranking query used by view, purchase, and purchase_value algorithms
 SKU_RANKS_BY_RECSET = """
 CREATE TEMPORARY TABLE IF NOT EXISTS scratch.recset_{account_id}_{recset_id}_ranks AS
@@ -233,45 +313,12 @@ pid_algo AS (
     GROUP BY product_id, max_score, score {geo_columns}
 ),
 latest_catalog AS (
- SELECT pc.* FROM product_catalog as pc
-    JOIN config_dataset_data_expiration e
-     ON pc.dataset_id = e.dataset_id
- WHERE pc.retailer_id=:retailer_id AND pc.dataset_id = :catalog_id
-    AND pc.update_time >= e.cutoff_time
-),
-filtered_catalog AS (
-SELECT *
-FROM latest_catalog as lc
-{early_filter}
+ /* snapshot of the catalog's latest rows, see catalog_snapshots */
+ SELECT * FROM {latest_catalog}
 ),
 reduced_catalog AS (
-    /*
-        Reduce catalog to representative visually distinct items by (image link, color) per item group
-        Limit to at most 50 representative items per item group for later post filtering.
-    */
-    SELECT
-        item_group_id,
-        id
-    FROM (
-        SELECT
-            item_group_id,
-            id,
-            ROW_NUMBER() OVER (PARTITION by item_group_id ORDER BY id DESC) AS ordinal
-        FROM (
-            SELECT
-                c.item_group_id,
-                c.image_link,
-                c.color,
-                /* Flatten, trim extra spaces, and convert back to string for filtering */
-                array_to_string(array_agg(TRIM(split_product_type.value::string, ' ')), ',') as product_type,
-                MAX(c.id) AS id
-            FROM filtered_catalog as c,
-            LATERAL FLATTEN(input=>split(c.product_type, ',')) split_product_type
-            GROUP BY 1, 2, 3
-        )
-        {late_filter}
-    )
-    WHERE ordinal <= 50
+    /* representative skus of the item groups passing the recset's filters, see catalog_snapshots */
+    SELECT item_group_id, id FROM {reduced_catalog}
 ),
 sku_algo AS (
     /* Explode recommended product ids into recommended representative skus */
@@ -286,11 +333,84 @@ sku_algo AS (
 filtered_scored_records AS (
     SELECT pc.id, pc.product_type, sa.score
       {geo_columns}
-    FROM product_catalog as pc
+    FROM latest_catalog as pc
     JOIN sku_algo as sa
         ON pc.id = sa.id
-    WHERE pc.retailer_id = :retailer_id
-        AND pc.dataset_id = :catalog_id
+), ranked_records AS (
+    {rank_query}
+)
+SELECT *
+FROM ranked_records
+WHERE rank <= 1000
+"""
+
+# One account's metrics in SKU_RANKS_BY_RECSET_ACCOUNTS
+ACCOUNT_METRIC_BY_RECSET = """
+    SELECT
+        {recs_account_id} AS recs_account_id,
+        product_id,
+        SUM(subtotal) AS score
+        {geo_columns}
+    FROM scratch.{algorithm}_{recs_account_id}_{lookback}_{market_id}_{retailer_scope}_{purchase_data_source}
+    GROUP BY product_id
+    {geo_columns}"""
+
+# SKU_RANKS_BY_RECSET for all accounts of a retailer level recset at once. Every account keeps its own metric table,
+# catalog and filters; rows carry the account as recs_account_id and ranks are partitioned by it.
+SKU_RANKS_BY_RECSET_ACCOUNTS = """
+CREATE TEMPORARY TABLE IF NOT EXISTS scratch.recset_{recset_id}_{ranks_group}_account_ranks AS
+WITH
+account_catalogs AS (
+    SELECT column1 AS recs_account_id, column2 AS catalog_id
+    FROM VALUES {account_catalogs}
+),
+pid_algo_raw AS (
+    /* Aggregates per product_id for each account at appropriate geo_rollup level */
+    {account_metrics}
+),
+pid_max_score AS (
+    SELECT recs_account_id AS max_score_account_id, MAX(score) as max_score
+    FROM pid_algo_raw
+    GROUP BY recs_account_id
+),
+pid_algo AS (
+    SELECT recs_account_id, product_id, ceil((score / max_score) * 1000, 2) AS score {geo_columns}
+    FROM pid_algo_raw
+    JOIN pid_max_score
+        ON max_score_account_id = recs_account_id
+    GROUP BY recs_account_id, product_id, max_score, score {geo_columns}
+),
+latest_catalog AS (
+ /* snapshots of the accounts' catalogs, see catalog_snapshots */
+ SELECT ac.recs_account_id, pc.* FROM (
+    {catalog_snapshots}
+ ) as pc
+    JOIN account_catalogs ac
+     ON pc.dataset_id = ac.catalog_id
+),
+reduced_catalog AS (
+    /* representative skus of each account's item groups passing its filters, see catalog_snapshots */
+    {reduced_catalogs}
+),
+sku_algo AS (
+    /* Explode recommended product ids into recommended representative skus */
+    SELECT
+        pid_algo.recs_account_id,
+        c.id,
+        pid_algo.score
+        {geo_columns}
+    FROM pid_algo
+    JOIN reduced_catalog c
+    ON c.recs_account_id = pid_algo.recs_account_id
+        AND c.item_group_id = pid_algo.product_id
+),
+filtered_scored_records AS (
+    SELECT sa.recs_account_id, pc.id, pc.product_type, sa.score
+      {geo_columns}
+    FROM latest_catalog as pc
+    JOIN sku_algo as sa
+        ON pc.id = sa.id
+        AND sa.recs_account_id = pc.recs_account_id
 ), ranked_records AS (
     {rank_query}
 )
@@ -301,6 +421,7 @@ WHERE rank <= 1000
 
 # account_id , market_id and retailer_id create a unique key only one variable will have a value and rest will be None
 # example  6814_None_None
+# see get_pid_ranks_query
 PID_RANKS_BY_COLLAB_RECSET = """
 CREATE TEMPORARY TABLE IF NOT EXISTS scratch.pid_ranks_{algorithm}_{account_id}_{market_id}_{retailer_id}_{lookback_days}
 AS WITH
@@ -313,7 +434,7 @@ score_scaling AS (
         0.01 as min_target,
         1000 as max_target,
         max_target - min_target as target_range
-        FROM scratch.{algorithm}_{account_id}_{market_id}_{retailer_id}_{lookback_days}_{purchase_data_source}
+        FROM {pair_table}
 )
     SELECT
         account_id,
@@ -330,10 +451,30 @@ score_scaling AS (
             SELECT
                 account_id, pid1, pid2, score,
                 ROW_NUMBER() OVER (PARTITION by account_id, pid1 ORDER BY score DESC, pid2 DESC) AS ordinal
-            FROM scratch.{algorithm}_{account_id}_{market_id}_{retailer_id}_{lookback_days}_{purchase_data_source}
+            FROM {pairs}
+            {candidate_limit}
         )
 JOIN score_scaling"""
 
+# both directions of the pairs of a half pair table, expanded while they are ranked instead of stored
+HALF_PAIRS = """(
+                SELECT account_id, pid1, pid2, score FROM {pair_table}
+                UNION ALL
+                SELECT account_id, pid2 AS pid1, pid1 AS pid2, score FROM {pair_table}
+            )"""
+
+# HALF_PAIRS with a candidate limit: the top candidates of a lookup key are among its top candidates as pid1 and as
+# pid2, so each direction is cut to those before the union and only the small result is ranked
+LIMITED_HALF_PAIRS = """(
+                SELECT account_id, pid1, pid2, score FROM {pair_table}
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY account_id, pid1 ORDER BY score DESC, pid2 DESC) <= {limit}
+                UNION ALL
+                SELECT account_id, pid2 AS pid1, pid1 AS pid2, score FROM (
+                    SELECT account_id, pid1, pid2, score FROM {pair_table}
+                    QUALIFY ROW_NUMBER() OVER (PARTITION BY account_id, pid2 ORDER BY score DESC, pid1 DESC) <= {limit}
+                )
+            )"""
+
 COLLAB_STATIC_FILTER_RANKS = """
 SELECT
         lookup_key,
@@ -377,11 +518,8 @@ SKU_RANKS_BY_COLLAB_RECSET = """
 CREATE TEMPORARY TABLE scratch.recset_{account_id}_{recset_id}_ranks AS
 WITH
     latest_catalog as (
-    SELECT pc.* FROM product_catalog as pc
-    JOIN config_dataset_data_expiration e
-    ON pc.dataset_id = e.dataset_id
-    WHERE pc.retailer_id=:retailer_id AND pc.dataset_id = :catalog_dataset_id
-    AND pc.update_time >= e.cutoff_time
+    /* snapshot of the catalog's latest rows, see catalog_snapshots */
+    SELECT * FROM {latest_catalog}
     ),
     filtered_catalog as (
     SELECT *
@@ -563,6 +701,66 @@ def get_static_and_dynamic_filter(recset_filter, global_filter, catalog_fields):
     return ('WHERE ' + static_filter_sql), static_filter_variables, dynamic_filter_sql, context_attributes, recommendation_attributes, recommendation_attributes_group_by, has_hashable_dynamic_product_type_filter
 
 
+def get_pid_ranks_query(algorithm, account_id, market_id, retailer_id, lookback_days, purchase_data_source,
+                        pair_algorithm=None, candidate_limit=None):
+    """
+    Return PID_RANKS_BY_COLLAB_RECSET for the pid ranks of algorithm.
+
+    :param pair_algorithm: The algorithm whose pair table is ranked, algorithm by default (see
+        purchase_tables.get_pair_algorithm). The pairs of HALF_PAIR_ALGORITHMS are ranked in both directions; with a
+        candidate_limit each direction is cut to its top candidates first.
+    :param candidate_limit: Most candidates kept per lookup key, None for all (see get_pid_candidate_limit)
+    """
+    pair_algorithm = pair_algorithm or algorithm
+    pair_table = 'scratch.{}_{}_{}_{}_{}_{}'.format(pair_algorithm, account_id, market_id, retailer_id, lookback_days,
+                                                    purchase_data_source)
+    pairs = pair_table
+    if pair_algorithm in HALF_PAIR_ALGORITHMS:
+        pairs = (LIMITED_HALF_PAIRS.format(pair_table=pair_table, limit=int(candidate_limit)) if candidate_limit else
+                 HALF_PAIRS.format(pair_table=pair_table))
+    return PID_RANKS_BY_COLLAB_RECSET.format(
+        algorithm=algorithm, account_id=account_id, market_id=market_id, retailer_id=retailer_id,
+        lookback_days=lookback_days, pair_table=pair_table, pairs=pairs,
+        candidate_limit='QUALIFY ordinal <= {}'.format(int(candidate_limit)) if candidate_limit else '')
+
+
+def get_filter_candidate_limit(filter_jsons):
+    """
+    Return how many candidates per lookup key the pid ranks must keep for a collab recset with these filters to still
+    rank 50 skus per lookup key, None for all of them.
+    """
+    filters = [f for filter_json in filter_jsons if filter_json for f in json.loads(filter_json).get('filters', [])]
+    if any(f['left'].get('field') == 'product_type' and f['right']['type'] == 'function' and
+           f['right'].get('value') != 'items_from_base_recommendation_on' for f in filters):
+        # ranked per product type of the candidates, so any number of candidates can be needed
+        return None
+    return PID_FILTERED_CANDIDATE_LIMIT if filters else PID_CANDIDATE_LIMIT
+
+
+def get_pid_candidate_limit(queue_entry):
+    """
+    Return the most candidates per lookup key the pid ranks of a collab queue entry need, None for all. The limit
+    follows the filters of the entry's recsets (with their algo filter and the global filters of their accounts): the
+    more a recset can filter out, the more candidates it needs.
+    """
+    if not PID_CANDIDATE_LIMIT:
+        return None
+    limits = [PID_CANDIDATE_LIMIT]
+    for recset in get_recset_ids(queue_entry):
+        if not is_strategy_active(recset):
+            continue
+        account_ids = [account.id for account in get_account_ids_for_catalog_join_and_output(recset,
+                                                                                             queue_entry.account)]
+        global_filter_jsons = AccountRecommendationSetting.objects.filter(account_id__in=account_ids)\
+            .values_list('filter_json', flat=True)
+        limit = get_filter_candidate_limit([recset.filter_json, json.dumps(get_algo_filter_dict(recset.algorithm))] +
+                                           list(global_filter_jsons))
+        if limit is None:
+            return None
+        limits.append(limit)
+    return max(limits)
+
+
 def get_fact_time(lookback):
     begin_fact_time = datetime.datetime.today().replace(
         hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=lookback)
@@ -575,10 +773,10 @@ def create_metric_table(conn, account_ids, algorithm, query, begin_fact_time, en
                         begin_30_day_session_time, end_30_day_session_time):
 
     if algorithm == 'trending':
+        # one scan of the 30 day window; the lookback window is a condition of that scan
         conn.execute(query, account_ids=account_ids, begin_7_day_fact_time=begin_fact_time,
-                     end_7_day_fact_time=end_fact_time, begin_7_day_session_time=begin_session_time,
-                     end_7_day_session_time=end_session_time, begin_30_day_fact_time=begin_30_day_fact_time,
-                     end_30_day_fact_time=end_30_day_fact_time, begin_30_day_session_time=begin_30_day_session_time,
+                     begin_30_day_fact_time=begin_30_day_fact_time, end_30_day_fact_time=end_30_day_fact_time,
+                     begin_30_day_session_time=begin_30_day_session_time,
                      end_30_day_session_time=end_30_day_session_time)
 
     else:
@@ -623,7 +821,7 @@ def get_recset_account_ids(recset):
     return account_ids
 
 
-def get_unload_sql(geo_target, has_dynamic_filter):
+def get_unload_sql(geo_target, has_dynamic_filter, rank_partition_columns=None):
     """
     gets the SQL snippets for geo partitioning of precompute non-contextual models as well as sql snippets for
     dynamic product type filters. If a geo_target or dynamic filter is not specified, then all snippets will simply
@@ -644,12 +842,18 @@ def get_unload_sql(geo_target, has_dynamic_filter):
     }
     geo_hash_sql becomes one part of the push-down filter hash. each part of the filter is separated by a '/', which is
     the reason for the prepended slash before country_code and region.
+    rank_partition_columns are prepended to the rank_query partition, e.g. ['recs_account_id'] for
+    SKU_RANKS_BY_RECSET_ACCOUNTS.
     """
     geo_cols = GEO_TARGET_COLUMNS.get(geo_target, None)
     geo_str = ",".join(geo_cols) if geo_cols else ""
     dynamic_filter_delimiter = "," if geo_cols else ""
     dynamic_filter_str = dynamic_filter_delimiter + "split_product_type" if has_dynamic_filter else ""
     partition_by = "PARTITION BY " + geo_str + dynamic_filter_str if geo_cols or has_dynamic_filter else ""
+    if rank_partition_columns:
+        # rank each of these (e.g. the account of a cross account ranking) separately too
+        partition_by = "PARTITION BY " + ",".join(
+            list(rank_partition_columns) + [col for col in partition_by[len("PARTITION BY "):].split(",") if col])
     rank_query = DYNAMIC_FILTER_RANKS if has_dynamic_filter else STATIC_FILTER_RANKS
     return {
         'geo_columns': "," + ",".join(geo_cols) if geo_cols else "",
@@ -733,6 +937,63 @@ def unload_target_pid_path(account_id, market_id, retailer_id, algorithm, lookba
     return os.path.join(stage, path), bucket_time
 
 
+def get_unload_options(partition_key):
+    """
+    Return the {unload_options} of an unload template for the configured UNLOAD_MODE.
+
+    :param partition_key: Expression on the unloaded document ($1) that partitioned unloads hash to pick a file
+    """
+    if UNLOAD_MODE != 'partitioned':
+        return SINGLE_FILE_UNLOAD_OPTIONS
+    return PARTITIONED_UNLOAD_OPTIONS.format(partition_key=partition_key, partitions=UNLOAD_PARTITIONS,
+                                             max_file_size=UNLOAD_MAX_FILE_SIZE)
+
+
+def get_partitioned_unload_paths(target):
+    """
+    Return (file prefix, manifest path) of a partitioned unload to a path from create_unload_target_path or
+    unload_target_pid_path. Both keep the path's name, so the jurisdiction, bucket time and vshard range can be read
+    from them as before:
+        .../recs_global-20200819T163500.000Z_PT1M-0-100-precompute_1_2.json.gz becomes
+        .../recs_global-20200819T163500.000Z_PT1M-0-100-precompute_1_2/part=0003/data_<...>.json.gz and
+        .../recs_global-20200819T163500.000Z_PT1M-0-100-precompute_1_2.manifest.json.gz
+    """
+    base = target[:-len('.json.gz')] if target.endswith('.json.gz') else target
+    return base + '/', base + '.manifest.json.gz'
+
+
+def execute_unload(conn, statement, target, **params):
+    """
+    Run an unload template whose {unload_options} came from get_unload_options.
+
+    In partitioned mode the files are written under the target's prefix, and a manifest listing every file with its
+    row count, size and md5 is written next to them, so the importer can load the files in parallel:
+        {"files": [{"path": "part=0003/data_<...>.json.gz", "rows": 10, "size": 1024, "md5": "..."}], "rows": 10}
+
+    :return: the number of documents unloaded, taken from the COPY result (rows_unloaded), so that callers do not
+        have to count the unloaded table separately
+    """
+    if UNLOAD_MODE != 'partitioned':
+        # rows_unloaded, input_bytes, output_bytes
+        return get_single_value_query(conn.execute(statement, target=target, **params), 0)
+
+    prefix, manifest_target = get_partitioned_unload_paths(target)
+    # DETAILED_OUTPUT: one (file_name, file_size, row_count) row per file, named relative to the prefix
+    unloaded = conn.execute(statement, target=prefix, **params).fetchall()
+    checksums = {}
+    for row in conn.execute(text("LIST '{}'".format(prefix))).fetchall():
+        # name, size, md5, last_modified
+        checksums[row[0]] = row[2]
+    files = []
+    for file_name, file_size, row_count in unloaded:
+        md5 = next((md5 for name, md5 in checksums.items() if name.endswith('/' + file_name)), None)
+        files.append({'path': file_name, 'rows': row_count, 'size': file_size, 'md5': md5})
+    manifest = {'files': files, 'rows': sum(f['rows'] for f in files)}
+    conn.execute(text(UNLOAD_MANIFEST), target=manifest_target, manifest=json.dumps(manifest))
+    log.log_info('Unloaded {} rows to {} files under {}'.format(manifest['rows'], len(files), prefix))
+    return manifest['rows']
+
+
 def get_account_ids_for_market_driven_recsets(recset, account_id):
     if recset.retailer_market_scope is True:
         account_ids = [account.id for account in recset.retailer.account_set.all()]
@@ -832,71 +1093,77 @@ def get_algo_filter_dict(algorithm):
 
     return algo_dict
 
-def process_noncollab_algorithm(conn, recset, metric_table_query, offline_query=None, online_offline_query=None):
+
+def get_metric_table_key(recset, account_id):
     """
-    Example JSON shape unloaded to s3:
-    {
-        "account":
-        {
-            "id": 1
-        },
-        "document":
-        {
-            "data": [...records],
-            "pushdown_filter_hash": "d27aaa6c61c21f9dc9e99ddceb7a7ac1ba1d6ad3"
-        },
-        "schema":
-        {
-            "feed_type": "RECSET_NONCOLLAB_RECS",
-            'id': 1001
-        },
-        "sent_time": "2020-08-19 16:35:00",
-        "shard_key": 847799
-    }
+    Identify the metric table, and the offline tables it is built from, that process_noncollab_algorithm ranks a
+    recset's account from. Recsets and accounts with the same key scan the same data into the same tables.
     """
-    result_counts = []
+    return (recset.algorithm,
+            None if recset.is_market_or_retailer_driven_ds else account_id,
+            recset.lookback_days,
+            recset.market.id if recset.market else None,
+            recset.retailer.id if recset.retailer else None,
+            recset.retailer_market_scope,
+            recset.purchase_data_source)
 
-    for account_id in get_recset_account_ids(recset):
-        log.log_info('Querying results for recset {}, account {}'.format(recset.id, account_id))
-        recommendation_settings = AccountRecommendationSetting.objects.filter(account_id=account_id)
-        if len(recommendation_settings) is 1:
-            global_filter_json = recommendation_settings[0].filter_json
-        else:
-            log.log_debug("Account has no recommendation settings, using default of empty filter_json")
-            global_filter_json = u'{"type": "or", "filters": []}'
-        try:
-            catalog_id = recset.product_catalog.id if recset.product_catalog else \
-                dio_models.DefaultAccountCatalog.objects.get(account=account_id).schema.id
-            catalog_fields = dio_models.Schema.objects.get(id=catalog_id).active_field_set.values("name", "data_type")
-        except:
-            log.log_info("Skipping account id {}, no catalog set".format(account_id))
-            continue
-        early_filter_exp, late_filter_exp, has_dynamic_filter = parse_non_collab_filters(recset.filter_json,
-                                                                                         catalog_fields)
-        global_early_filter_exp, global_late_filter_exp, global_has_dynamic_filter = \
-            parse_non_collab_filters(global_filter_json, catalog_fields)
-        has_dynamic_filter = has_dynamic_filter or global_has_dynamic_filter
-        early_filter_sql, late_filter_sql, filter_variables = new_filters.get_query_and_variables_non_collab(
-            early_filter_exp, late_filter_exp, global_early_filter_exp, global_late_filter_exp, catalog_fields)
-        account_ids = get_account_ids_for_market_driven_recsets(recset, account_id)
-        account = None if recset.is_market_or_retailer_driven_ds else account_id
-        market = recset.market.id if recset.market else None
-        retailer = recset.retailer.id if recset.retailer else None
-        begin_fact_time, end_fact_time = get_fact_time(recset.lookback_days)
-        begin_session_time, end_session_time = sqlalchemy_warehouse.get_session_time_bounds(
-            begin_fact_time, end_fact_time)
-
-        begin_30_day_fact_time, end_30_day_fact_time = get_fact_time(30)
-        begin_30_day_session_time, end_30_day_session_time = None, None
-        if recset.algorithm == "trending":
-            begin_30_day_session_time, end_30_day_session_time = sqlalchemy_warehouse.get_session_time_bounds(
-                begin_30_day_fact_time, end_30_day_fact_time
-            )
-        account_ids_dataset_ids = offline.get_dataset_ids_for_pos(account_ids)
-        create_helper_query_for_non_collab_algorithm(recset, account, market, retailer,
-                                                       begin_fact_time, account_ids_dataset_ids, conn)
 
-        if recset.purchase_data_source in ["online", "online_offline"]:
+class MetricTableBatch(object):
+    """
+    The metric tables built on one warehouse connection by a batch of process_noncollab_algorithm calls.
+    Every key is materialized once; later recsets and accounts with that key only rank and unload.
+    """
+
+    def __init__(self):
+        self.built = set()
+        self.scans_saved = 0
+
+    def is_built(self, key):
+        if key in self.built:
+            self.scans_saved += 1
+            return True
+        return False
+
+    def add(self, key):
+        self.built.add(key)
+
+
+def create_noncollab_metric_tables(conn, recset, account_id, account_ids, account_ids_dataset_ids, metric_table_query,
+                                   offline_query=None, online_offline_query=None):
+    """
+    Build the metric table SKU_RANKS_BY_RECSET ranks a recset's account from, with the offline tables it needs.
+    Only runs warehouse queries, so it can run in an account pipeline.
+
+    :param account_ids: get_account_ids_for_market_driven_recsets of the recset's account
+    :param account_ids_dataset_ids: offline.get_dataset_ids_for_pos of account_ids
+    """
+    account = None if recset.is_market_or_retailer_driven_ds else account_id
+    market = recset.market.id if recset.market else None
+    retailer = recset.retailer.id if recset.retailer else None
+    begin_fact_time, end_fact_time = get_fact_time(recset.lookback_days)
+    begin_session_time, end_session_time = sqlalchemy_warehouse.get_session_time_bounds(
+        begin_fact_time, end_fact_time)
+
+    begin_30_day_fact_time, end_30_day_fact_time = get_fact_time(30)
+    begin_30_day_session_time, end_30_day_session_time = None, None
+    if recset.algorithm == "trending":
+        begin_30_day_session_time, end_30_day_session_time = sqlalchemy_warehouse.get_session_time_bounds(
+            begin_30_day_fact_time, end_30_day_fact_time
+        )
+    with job_stage('metric'):
+        create_helper_query_for_non_collab_algorithm(recset, account, market, retailer,
+                                                       begin_fact_time, account_ids_dataset_ids, conn,
+                                                       account_ids=account_ids)
+
+        if recset.purchase_data_source in ["online", "online_offline"] and \
+                precompute_rollups.uses_rollups(recset.algorithm):
+            # online metrics summed from the daily rollups
+            precompute_rollups.create_metric_table_from_rollups(
+                conn, recset.algorithm, account_ids,
+                dict(account_id=account, lookback=recset.lookback_days, market_id=market,
+                     retailer_scope=recset.retailer_market_scope),
+                begin_fact_time, end_fact_time, begin_30_day_fact_time, end_30_day_fact_time)
+        elif recset.purchase_data_source in ["online", "online_offline"]:
             # online_query
             create_metric_table(conn, account_ids, recset.algorithm,
                                 text(metric_table_query.format(algorithm=recset.algorithm, account_id=account,
@@ -935,63 +1202,309 @@ def process_noncollab_algorithm(conn, recset, metric_table_query, offline_query=
                     begin_7_day_session_time=begin_session_time, end_7_day_session_time=end_session_time,
                     begin_30_day_session_time=begin_30_day_session_time, end_30_day_session_time=end_30_day_session_time)
 
-        unload_path, new_unload_path, send_time = create_unload_target_path(account_id, recset.id)
-        unload_sql = get_unload_sql(recset.geo_target, has_dynamic_filter)
-        pushdown_filter_json = get_pushdown_filter_json(unload_sql, recset.geo_target)
-        pushdown_filter_str = get_pushdown_filter_str(pushdown_filter_json)
 
+AccountRankInputs = collections.namedtuple('AccountRankInputs', ['account_id', 'catalog_id', 'early_filter_sql',
+                                                                 'late_filter_sql', 'filter_variables',
+                                                                 'has_dynamic_filter'])
+
+
+def get_account_rank_inputs(recset, account_id):
+    """
+    Look up the catalog of a recset's account and build the filters it is ranked with.
+
+    :return: AccountRankInputs, or None if the account has no catalog
+    """
+    recommendation_settings = AccountRecommendationSetting.objects.filter(account_id=account_id)
+    if len(recommendation_settings) is 1:
+        global_filter_json = recommendation_settings[0].filter_json
+    else:
+        log.log_debug("Account has no recommendation settings, using default of empty filter_json")
+        global_filter_json = u'{"type": "or", "filters": []}'
+    try:
+        catalog_id = recset.product_catalog.id if recset.product_catalog else \
+            dio_models.DefaultAccountCatalog.objects.get(account=account_id).schema.id
+        catalog_fields = dio_models.Schema.objects.get(id=catalog_id).active_field_set.values("name", "data_type")
+    except:
+        log.log_info("Skipping account id {}, no catalog set".format(account_id))
+        return None
+    early_filter_exp, late_filter_exp, has_dynamic_filter = parse_non_collab_filters(recset.filter_json,
+                                                                                     catalog_fields)
+    global_early_filter_exp, global_late_filter_exp, global_has_dynamic_filter = \
+        parse_non_collab_filters(global_filter_json, catalog_fields)
+    has_dynamic_filter = has_dynamic_filter or global_has_dynamic_filter
+    early_filter_sql, late_filter_sql, filter_variables = new_filters.get_query_and_variables_non_collab(
+        early_filter_exp, late_filter_exp, global_early_filter_exp, global_late_filter_exp, catalog_fields)
+    return AccountRankInputs(account_id, catalog_id, early_filter_sql, late_filter_sql, filter_variables,
+                             has_dynamic_filter)
+
+
+def get_recset_ranks_table(account_id, recset_id):
+    return 'scratch.recset_{account_id}_{recset_id}_ranks'.format(account_id=account_id, recset_id=recset_id)
+
+
+def rank_recset_accounts(conn, recset, accounts_inputs):
+    """
+    Rank a retailer level recset for all of its accounts with one SKU_RANKS_BY_RECSET_ACCOUNTS statement per kind of
+    filter (static or dynamic product type), instead of one SKU_RANKS_BY_RECSET per account.
+
+    :return: list of (account_id, ranks table, unload sql)
+    """
+    groups = collections.OrderedDict()
+    for inputs in accounts_inputs:
+        groups.setdefault(inputs.has_dynamic_filter, []).append(inputs)
+
+    ranked = {}
+    for has_dynamic_filter, group in groups.items():
+        ranks_group = 'dynamic' if has_dynamic_filter else 'static'
+        unload_sql = get_unload_sql(recset.geo_target, has_dynamic_filter, rank_partition_columns=['recs_account_id'])
+        # accounts with the same catalog and filters share a reduced catalog
+        reduced_catalogs = '\n    UNION ALL\n    '.join(
+            'SELECT {} AS recs_account_id, item_group_id, id FROM {}'.format(
+                int(inputs.account_id),
+                get_reduced_catalog(conn, recset.retailer.id, inputs.catalog_id, inputs.early_filter_sql,
+                                    inputs.late_filter_sql, inputs.filter_variables))
+            for inputs in group)
+        account_metrics = '\nUNION ALL\n'.join(
+            ACCOUNT_METRIC_BY_RECSET.format(recs_account_id=int(inputs.account_id),
+                                            algorithm=recset.algorithm,
+                                            lookback=recset.lookback_days,
+                                            market_id=recset.market.id if recset.market else None,
+                                            retailer_scope=recset.retailer_market_scope,
+                                            purchase_data_source=recset.purchase_data_source,
+                                            geo_columns=unload_sql['geo_columns'])
+            for inputs in group)
+        account_catalogs = ', '.join('({}, {})'.format(int(inputs.account_id), int(inputs.catalog_id))
+                                     for inputs in group)
+        catalog_snapshots = '\n    UNION ALL\n    '.join(
+            'SELECT * FROM {}'.format(get_catalog_snapshot(conn, recset.retailer.id, catalog_id))
+            for catalog_id in sorted(set(inputs.catalog_id for inputs in group)))
+        with job_stage('rank'):
+            conn.execute(text(SKU_RANKS_BY_RECSET_ACCOUNTS.format(
+                recset_id=recset.id,
+                ranks_group=ranks_group,
+                account_catalogs=account_catalogs,
+                catalog_snapshots=catalog_snapshots,
+                reduced_catalogs=reduced_catalogs,
+                account_metrics=account_metrics,
+                **unload_sql)))
+        for inputs in group:
+            ranks_table = '(SELECT * FROM scratch.recset_{}_{}_account_ranks WHERE recs_account_id = {})'.format(
+                recset.id, ranks_group, int(inputs.account_id))
+            ranked[inputs.account_id] = (ranks_table, unload_sql)
+    return [(inputs.account_id,) + ranked[inputs.account_id] for inputs in accounts_inputs]
+
+
+def rank_recset_account(conn, recset, inputs):
+    """
+    Rank a recset for one of its accounts with SKU_RANKS_BY_RECSET, reading the account's catalog from its snapshot
+    (see catalog_snapshots).
+
+    :return: (account_id, ranks table, unload sql)
+    """
+    account_id = inputs.account_id
+    unload_sql = get_unload_sql(recset.geo_target, inputs.has_dynamic_filter)
+    latest_catalog = get_catalog_snapshot(conn, recset.retailer.id, inputs.catalog_id)
+    reduced_catalog = get_reduced_catalog(conn, recset.retailer.id, inputs.catalog_id, inputs.early_filter_sql,
+                                          inputs.late_filter_sql, inputs.filter_variables)
+    with job_stage('rank'):
         conn.execute(text(SKU_RANKS_BY_RECSET.format(algorithm=recset.algorithm,
                                                      recset_id=recset.id,
                                                      account_id=account_id,
+                                                     latest_catalog=latest_catalog,
+                                                     reduced_catalog=reduced_catalog,
                                                      metric_table_account_id=None if recset.is_market_or_retailer_driven_ds else account_id,
                                                      lookback=recset.lookback_days,
-                                                     early_filter=early_filter_sql,
-                                                     late_filter=late_filter_sql,
                                                      market_id=recset.market.id if recset.market else None,
                                                      retailer_scope=recset.retailer_market_scope,
                                                      purchase_data_source=recset.purchase_data_source,
-                                                     **unload_sql)),
-                     retailer_id=recset.retailer.id,
-                     catalog_id=catalog_id,
-                     **filter_variables)
-        result_counts.append(get_single_value_query(conn.execute(text(RESULT_COUNT.format(recset_id=recset.id,
-                                                                                          account_id=account_id,
-                                                                                          **unload_sql))), 0))
-        conn.execute(text(SNOWFLAKE_UNLOAD.format(recset_id=recset.id, account_id=account_id, **unload_sql)),
-                     shard_key=get_shard_key(account_id),
-                     account_id=account_id,
-                     recset_id=recset.id,
-                     sent_time=send_time,
-                     target=unload_path)
-
-        # Unload to new path only if feature flag is enabled.
-        precompute_feature = retailer_models.ACCOUNT_FEATURES.UNIFIED_PRECOMPUTE
-        account_obj = retailer_models.Account.objects.get(id=account_id)
-        if account_obj.has_feature(precompute_feature):
-            conn.execute(text(SNOWFLAKE_UNLOAD_2.format(recset_id=recset.id, account_id=account_id,
-            pushdown_filter_str=pushdown_filter_str,
-            **unload_sql)),
-                        shard_key=get_shard_key(account_id),
-                        account_id=account_id,
-                        recset_id=recset.id,
-                        sent_time=send_time,
-                        target=new_unload_path)
-    return result_counts
+                                                     **unload_sql)))
+    return account_id, get_recset_ranks_table(account_id, recset.id), unload_sql
+
+
+def get_unified_precompute_account_ids(account_ids):
+    """
+    Return the ids in account_ids of accounts with the UNIFIED_PRECOMPUTE feature, whose documents are unloaded in
+    the RECSET_RECS format too. Looked up with one query for all of the accounts.
+    """
+    if not account_ids:
+        return set()
+    return set(retailer_models.Account.objects.filter(
+        id__in=set(account_ids),
+        accountfeature__feature_flag__name=retailer_models.ACCOUNT_FEATURES.UNIFIED_PRECOMPUTE,
+    ).values_list('id', flat=True))
+
+
+def unload_documents(conn, documents_sql, account_id, recset_id, unload_paths, legacy_document_key, feed_type,
+                     partition_key):
+    """
+    Aggregate the documents of a ranks table once with documents_sql (NONCOLLAB_DOCUMENTS or COLLAB_DOCUMENTS), then
+    unload them in the legacy format and, unless there were none, in the RECSET_RECS format.
+
+    :return: the number of documents unloaded
+    """
+    unload_path, new_unload_path, send_time = unload_paths
+    params = dict(shard_key=get_shard_key(account_id), account_id=account_id, recset_id=recset_id,
+                  sent_time=send_time)
+    conn.execute(text(documents_sql))
+    result_count = execute_unload(conn, text(SNOWFLAKE_UNLOAD_DOCUMENTS.format(
+        account_id=account_id,
+        recset_id=recset_id,
+        legacy_document_key=legacy_document_key,
+        feed_type=feed_type,
+        unload_options=get_unload_options(partition_key))),
+                                  unload_path,
+                                  **params)
+    if result_count:
+        execute_unload(conn, text(SNOWFLAKE_UNLOAD_DOCUMENTS_2.format(
+            account_id=account_id,
+            recset_id=recset_id,
+            unload_options=get_unload_options(partition_key))),
+                       new_unload_path,
+                       **params)
+    return result_count
+
+
+def unload_recset_account(conn, recset, account_id, ranks_table, unload_sql, unified_precompute=False):
+    """
+    Unload the ranks of a recset's account to s3, also in the RECSET_RECS format for UNIFIED_PRECOMPUTE accounts.
+
+    :return: the number of documents unloaded
+    """
+    unload_paths = create_unload_target_path(account_id, recset.id)
+    with job_stage('unload'):
+        if unified_precompute:
+            pushdown_filter_json = get_pushdown_filter_json(unload_sql, recset.geo_target)
+            return unload_documents(conn,
+                                    NONCOLLAB_DOCUMENTS.format(account_id=account_id,
+                                                               recset_id=recset.id,
+                                                               ranks_table=ranks_table,
+                                                               pushdown_filter_str=get_pushdown_filter_str(
+                                                                   pushdown_filter_json),
+                                                               **unload_sql),
+                                    account_id, recset.id, unload_paths,
+                                    legacy_document_key="'pushdown_filter_hash', legacy_pushdown_filter_hash",
+                                    feed_type='RECSET_NONCOLLAB_RECS',
+                                    partition_key=PUSHDOWN_FILTER_PARTITION)
+
+        unload_path, _, send_time = unload_paths
+        return execute_unload(conn, text(SNOWFLAKE_UNLOAD.format(ranks_table=ranks_table,
+                                                                 unload_options=get_unload_options(
+                                                                     PUSHDOWN_FILTER_PARTITION),
+                                                                 **unload_sql)),
+                              unload_path,
+                              shard_key=get_shard_key(account_id),
+                              account_id=account_id,
+                              recset_id=recset.id,
+                              sent_time=send_time)
+
+
+def rank_and_unload_recset_account(conn, recset, inputs, unified_precompute=False):
+    """
+    Rank a recset for one of its accounts and unload the ranks.
+
+    :return: the number of documents unloaded
+    """
+    account_id, ranks_table, unload_sql = rank_recset_account(conn, recset, inputs)
+    return unload_recset_account(conn, recset, account_id, ranks_table, unload_sql, unified_precompute)
+
+
+def process_noncollab_algorithm(conn, recset, metric_table_query, offline_query=None, online_offline_query=None,
+                                account_ids=None, metric_tables=None):
+    """
+    Rank and unload the recset for each of its accounts, or only for those in account_ids if given (a
+    PrecomputeQueue entry of a retailer level recset covers a single account).
+
+    Pass the same MetricTableBatch with every recset processed on conn to skip building metric tables that an
+    earlier recset or account already built.
+
+    A retailer level recset processed for several accounts is ranked for all of them at once (see
+    rank_recset_accounts) unless RECS_NONCOLLAB_CROSS_ACCOUNT_RANKING is off. Each account is still unloaded to its
+    own path.
+
+    The metric tables, and then the ranking and unloading of each account, are run concurrently up to
+    RECS_PRECOMPUTE_ACCOUNT_CONCURRENCY (see account_pipelines).
+
+    Example JSON shape unloaded to s3:
+    {
+        "account":
+        {
+            "id": 1
+        },
+        "document":
+        {
+            "data": [...records],
+            "pushdown_filter_hash": "d27aaa6c61c21f9dc9e99ddceb7a7ac1ba1d6ad3"
+        },
+        "schema":
+        {
+            "feed_type": "RECSET_NONCOLLAB_RECS",
+            'id': 1001
+        },
+        "sent_time": "2020-08-19 16:35:00",
+        "shard_key": 847799
+    }
+    """
+    recset_account_ids = get_recset_account_ids(recset)
+    if account_ids is not None:
+        recset_account_ids = [account_id for account_id in recset_account_ids if account_id in account_ids]
+
+    accounts_inputs = []
+    metric_table_builds = collections.OrderedDict()
+    for account_id in recset_account_ids:
+        log.log_info('Querying results for recset {}, account {}'.format(recset.id, account_id))
+        inputs = get_account_rank_inputs(recset, account_id)
+        if inputs is None:
+            continue
+        metric_table_key = get_metric_table_key(recset, account_id)
+        if metric_tables is not None and metric_tables.is_built(metric_table_key):
+            log.log_info('Reusing metric table {} for recset {}, account {}'.format(metric_table_key, recset.id,
+                                                                                   account_id))
+        elif metric_table_key not in metric_table_builds:
+            # config db lookups are done here, on the job's thread, the pipelines only query the warehouse
+            metric_account_ids = get_account_ids_for_market_driven_recsets(recset, account_id)
+            metric_table_builds[metric_table_key] = functools.partial(
+                create_noncollab_metric_tables, recset=recset, account_id=account_id, account_ids=metric_account_ids,
+                account_ids_dataset_ids=offline.get_dataset_ids_for_pos(metric_account_ids),
+                metric_table_query=metric_table_query, offline_query=offline_query,
+                online_offline_query=online_offline_query)
+            if metric_tables is not None:
+                metric_tables.add(metric_table_key)
+        accounts_inputs.append(inputs)
+    run_account_pipelines(conn, list(metric_table_builds.values()))
+
+    unified_account_ids = get_unified_precompute_account_ids([inputs.account_id for inputs in accounts_inputs])
+    if (CROSS_ACCOUNT_RANKING and len(accounts_inputs) > 1 and recset.is_retailer_tenanted and
+            not recset.is_market_or_retailer_driven_ds):
+        log.log_info('Ranking recset {} for accounts {} at once'.format(
+            recset.id, [inputs.account_id for inputs in accounts_inputs]))
+        pipelines = [functools.partial(unload_recset_account, recset=recset, account_id=account_id,
+                                       ranks_table=ranks_table, unload_sql=unload_sql,
+                                       unified_precompute=account_id in unified_account_ids)
+                     for account_id, ranks_table, unload_sql in rank_recset_accounts(conn, recset, accounts_inputs)]
+    else:
+        pipelines = [functools.partial(rank_and_unload_recset_account, recset=recset, inputs=inputs,
+                                       unified_precompute=inputs.account_id in unified_account_ids)
+                     for inputs in accounts_inputs]
+    return run_account_pipelines(conn, pipelines)
 
 # TODO: function name here, only running offline query if certain conditions are met
 def create_helper_query_for_non_collab_algorithm(recset, account, market, retailer,
-                                                 begin_fact_time, account_ids_dataset_ids, conn):
+                                                 begin_fact_time, account_ids_dataset_ids, conn, account_ids=()):
     if recset.algorithm in ["purchase", "trending", "purchase_value"]:
         # GET_OFFLINE_PURCHASE_PER_CUSTOMER_AND_PID is required in case of both online_offline and offline
         lookback_days = recset.lookback_days
         if recset.purchase_data_source in ["online_offline", "offline"]:
             if not account_ids_dataset_ids:
                 raise ValueError('Account/s {} has/have no offline purchase datasets'.format(account))
-            conn.execute(text(
-                offline.GET_OFFLINE_PURCHASE_PER_CUSTOMER_AND_PID.format(
-                    account_id=account, market_id=market,
-                    retailer_id=retailer, lookback_days=lookback_days)), begin_fact_time=begin_fact_time,
-                aids_dids=account_ids_dataset_ids)
+            table_params = dict(account_id=account, market_id=market, retailer_id=retailer,
+                                lookback_days=lookback_days)
+            # kept on the session for later jobs with the same inputs, like the purchase collab algorithms do
+            purchase_tables.ensure_table(
+                conn, 'scratch.offline_purchase_per_customer_and_pid_{account_id}_{market_id}_{retailer_id}_'
+                      '{lookback_days}'.format(**table_params),
+                purchase_tables.get_events_version(begin_fact_time, account_ids, account_ids_dataset_ids),
+                lambda: conn.execute(text(offline.GET_OFFLINE_PURCHASE_PER_CUSTOMER_AND_PID.format(**table_params)),
+                                     begin_fact_time=begin_fact_time, aids_dids=account_ids_dataset_ids))
 
 def get_account_ids_for_catalog_join_and_output(recset, queue_account):
     """
@@ -1015,14 +1528,73 @@ def get_account_ids_for_catalog_join_and_output(recset, queue_account):
     return []
 
 
+def rank_and_unload_collab_account(conn, recset, account_id, rank_sql, rank_params, pushdown_filter_str, group_by,
+                                   has_dynamic_product_type_filter, unified_precompute=False):
+    """
+    Rank a collab recset for one of its accounts with rank_sql (SKU_RANKS_BY_COLLAB_RECSET) and unload the ranks.
+
+    :return: the number of documents unloaded
+    """
+    # this query explodes the pid to sku to create a pid-sku relation
+    with job_stage('rank'):
+        conn.execute(text(rank_sql), **rank_params)
+
+    with job_stage('unload'):
+        unload_paths = create_unload_target_path(account_id, recset.id)
+        unload_path, new_unload_path, send_time = unload_paths
+        if unified_precompute and not has_dynamic_product_type_filter:
+            # both formats group the ranks by lookup_key, so the documents are aggregated once
+            result_count = unload_documents(conn,
+                                            COLLAB_DOCUMENTS.format(recset_id=recset.id, account_id=account_id,
+                                                                    pushdown_filter_str=pushdown_filter_str),
+                                            account_id, recset.id, unload_paths,
+                                            legacy_document_key="'lookup_key', lookup_key",
+                                            feed_type='RECSET_COLLAB_RECS',
+                                            partition_key=LOOKUP_KEY_PARTITION)
+        else:
+            # this query write the pid-sku relation to s3
+            result_count = execute_unload(conn, text(SNOWFLAKE_UNLOAD_COLLAB.format(
+                recset_id=recset.id, account_id=account_id,
+                unload_options=get_unload_options(LOOKUP_KEY_PARTITION))),
+                                          unload_path,
+                                          shard_key=get_shard_key(account_id),
+                                          account_id=account_id,
+                                          recset_id=recset.id,
+                                          sent_time=send_time)
+            # the RECSET_RECS format of a dynamic product type filter also groups by product type, so it is
+            # unloaded from the ranks table separately
+            if unified_precompute and result_count:
+                execute_unload(conn, text(SNOWFLAKE_UNLOAD_COLLAB_2.format(
+                    recset_id=recset.id, account_id=account_id,
+                    pushdown_filter_str=pushdown_filter_str, group_by=group_by,
+                    unload_options=get_unload_options(LOOKUP_KEY_PARTITION))),
+                               new_unload_path,
+                               shard_key=get_shard_key(account_id),
+                               account_id=account_id,
+                               recset_id=recset.id,
+                               sent_time=send_time)
+        log.log_info("Finished processing recset id {}, number of rows {} and file path {}".format(
+            recset.id, result_count, unload_path))
+    return result_count
+
+
 def process_collab_recsets(conn, queue_entry, account, market, retailer):
-    result_counts = []
-    recsets = get_recset_ids(queue_entry)
-    for recset in recsets:
+    """
+    Rank and unload the collab recsets of a queue entry for each of their accounts. The accounts are ranked and
+    unloaded concurrently up to RECS_PRECOMPUTE_ACCOUNT_CONCURRENCY (see account_pipelines).
+
+    :return: the number of documents unloaded per account
+    """
+    pipelines = []
+    recset_accounts = []
+    for recset in get_recset_ids(queue_entry):
         if not is_strategy_active(recset):
             log.log_info('skip inactive strategy {}'.format(recset.id))
             continue
-        account_ids = get_account_ids_for_catalog_join_and_output(recset, queue_entry.account)
+        recset_accounts.append((recset, get_account_ids_for_catalog_join_and_output(recset, queue_entry.account)))
+    unified_account_ids = get_unified_precompute_account_ids(
+        [account_id.id for _, account_ids in recset_accounts for account_id in account_ids])
+    for recset, account_ids in recset_accounts:
         for account_id in account_ids:
             log.log_info("Processing recset id {}, account id {} for queue entry {}"
                          .format(recset.id, account_id, queue_entry.id))
@@ -1059,48 +1631,27 @@ def process_collab_recsets(conn, queue_entry, account, market, retailer):
 
             should_sku_ranks_select_product_type = ', recommendation.product_type as product_type' if has_hashable_dynamic_product_type_filter else ''
             should_sku_ranks_group_by_product_type = ', recommendation.product_type' if has_hashable_dynamic_product_type_filter else ''
-            # this query explodes the pid to sku to create a pid-sku relation
-            conn.execute(text(SKU_RANKS_BY_COLLAB_RECSET.format(algorithm=recset.algorithm, recset_id=recset.id,
-                                                                account_id=account_id.id,
-                                                                pid_rank_account_id=account,
-                                                                lookback_days=recset.lookback_days,
-                                                                dynamic_filter=dynamic_filter_sql,
-                                                                market_id=market,
-                                                                retailer_id=retailer,
-                                                                static_filter=static_filter_sql,
-                                                                context_attributes=context_attributes,
-                                                                recommendation_attributes=recommendation_attributes,
-                                                                recommendation_attributes_group_by=recommendation_attributes_group_by,
-                                                                rank_query=collab_rank_query.format(partition_by=partition_by),
-                                                                should_sku_ranks_select_product_type=should_sku_ranks_select_product_type,
-                                                                should_sku_ranks_group_by_product_type=should_sku_ranks_group_by_product_type
-                                                                )),
-                         retailer_id=recset.retailer.id,
-                         catalog_dataset_id=catalog_id,
-                         **static_filter_variables)
-
-            unload_path, new_unload_path, send_time = create_unload_target_path(account_id.id, recset.id)
-            result_counts.append(get_single_value_query(conn.execute(text(
-                RESULT_COUNT.format(recset_id=recset.id,account_id=account_id.id,))), 0))
-            # this query write the pid-sku relation to s3
-            conn.execute(text(SNOWFLAKE_UNLOAD_COLLAB.format(recset_id=recset.id, account_id=account_id.id)),
-                         shard_key=get_shard_key(account_id.id),
-                         account_id=account_id.id,
-                         recset_id=recset.id,
-                         sent_time=send_time,
-                         target=unload_path)
-            # Unload to new path only if feature flag is enabled.
-            precompute_feature = retailer_models.ACCOUNT_FEATURES.UNIFIED_PRECOMPUTE
-            account_obj = retailer_models.Account.objects.get(id=account_id.id)
-            if account_obj.has_feature(precompute_feature):
-                conn.execute(text(SNOWFLAKE_UNLOAD_COLLAB_2.format(recset_id=recset.id, account_id=account_id.id,
-                pushdown_filter_str=pushdown_filter_str, group_by=group_by)),
-                            shard_key=get_shard_key(account_id.id),
-                            account_id=account_id.id,
-                            recset_id=recset.id,
-                            sent_time=send_time,
-                            target=new_unload_path)
-            log.log_info("Finished processing recset id {}, number of rows {} and file path {}".format(
-                recset.id, result_counts[-1], unload_path))
-
-    return result_counts
+            rank_sql = SKU_RANKS_BY_COLLAB_RECSET.format(algorithm=recset.algorithm, recset_id=recset.id,
+                                                         account_id=account_id.id,
+                                                         latest_catalog=get_catalog_snapshot(
+                                                             conn, recset.retailer.id, catalog_id),
+                                                         pid_rank_account_id=account,
+                                                         lookback_days=recset.lookback_days,
+                                                         dynamic_filter=dynamic_filter_sql,
+                                                         market_id=market,
+                                                         retailer_id=retailer,
+                                                         static_filter=static_filter_sql,
+                                                         context_attributes=context_attributes,
+                                                         recommendation_attributes=recommendation_attributes,
+                                                         recommendation_attributes_group_by=recommendation_attributes_group_by,
+                                                         rank_query=collab_rank_query.format(partition_by=partition_by),
+                                                         should_sku_ranks_select_product_type=should_sku_ranks_select_product_type,
+                                                         should_sku_ranks_group_by_product_type=should_sku_ranks_group_by_product_type
+                                                         )
+            pipelines.append(functools.partial(
+                rank_and_unload_collab_account, recset=recset, account_id=account_id.id, rank_sql=rank_sql,
+                rank_params=static_filter_variables, pushdown_filter_str=pushdown_filter_str, group_by=group_by,
+                has_dynamic_product_type_filter=has_hashable_dynamic_product_type_filter,
+                unified_precompute=account_id.id in unified_account_ids))
+
+    return run_account_pipelines(conn, pipelines)
@@ -1,12 +1,11 @@
-import contextlib
 import os
 from django.conf import settings
 from monetate.common import job_timing
 from monetate_monitoring import log
-from sqlalchemy import create_engine
-from sqlalchemy.pool import NullPool
 
+from . import catalog_snapshots
 from . import precompute_utils
+from .warehouse_session import warehouse_connection
 
 log.configure_script_log('precompute_view_algorithm')
 
@@ -33,17 +32,21 @@ GROUP BY 1, 2, 3;
 """
 
 
-def precompute_view_algorithm(recsets):
+def precompute_view_algorithm(recsets, account_ids=None):
     result_counts = []
-    # Disable pooling so temp tables do not persist on connections returned to pool
-    engine = create_engine(settings.SNOWFLAKE_QUERY_DSN, poolclass=NullPool)
-    with job_timing.job_timer('precompute_view_algorithm'), contextlib.closing(engine.connect()) as warehouse_conn:
-        warehouse_conn.execute("use warehouse {}".format(
-            getattr(settings, 'RECS_QUERY_WH', os.environ.get('RECS_QUERY_WH', 'QUERY2_WH'))))
+    # recsets processed on the connection share the metric tables built for their keys
+    metric_tables = precompute_utils.MetricTableBatch()
+    with job_timing.job_timer('precompute_view_algorithm'), warehouse_connection(
+            getattr(settings, 'RECS_QUERY_WH', os.environ.get('RECS_QUERY_WH', 'QUERY2_WH'))) as warehouse_conn:
         for recset in recsets:
             if recset and recset.algorithm in ['view', 'most_popular']:
                 log.log_info('processing recset {}'.format(recset.id))
                 result_counts.append(precompute_utils.process_noncollab_algorithm(warehouse_conn, recset,
-                                                                                  MOSTVIEWED_LOOKBACK))
+                                                                                  MOSTVIEWED_LOOKBACK,
+                                                                                  account_ids=account_ids,
+                                                                                  metric_tables=metric_tables))
+        log.log_info('reduced catalog cache hits: {}, misses: {}'.format(
+            *catalog_snapshots.pop_reduced_catalog_stats(warehouse_conn)))
+    log.log_info('metric table scans saved: {}'.format(metric_tables.scans_saved))
     log.log_info('ending precompute_view_algorithm process')
     return result_counts
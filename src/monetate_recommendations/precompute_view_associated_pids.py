@@ -1,19 +1,50 @@
+import json
+import os
+
 import monetate.retailer.models as retailer_models
+from django.conf import settings
 from monetate_monitoring import log
 from sqlalchemy.sql import text
 
+from . import pair_counts
+from . import precompute_rollups
 from . import precompute_utils
+from .precompute_history import job_stage
 
-GET_EARLIEST_VIEW_PER_MID_AND_PID = """
-CREATE TEMPORARY TABLE IF NOT EXISTS scratch.earliest_view_per_mid_and_pid_{account_id}_{market_id}_{retailer_id}_{lookback_days} AS
-WITH device_earliest_product_view AS (
+# most products a device contributes to view_also_view pairs, 0 for no cap beyond the 1000 products per month that
+# filtered_devices allows. A device with n products yields n * (n - 1) / 2 pairs, so the cap bounds pair generation.
+DEVICE_VIEW_CAP = int(getattr(settings, 'RECS_VAV_DEVICE_VIEW_CAP', os.environ.get('RECS_VAV_DEVICE_VIEW_CAP', 0)))
+# caps of single accounts, overriding DEVICE_VIEW_CAP, e.g. RECS_VAV_DEVICE_VIEW_CAP_BY_ACCOUNT='{"6814": 200}'
+DEVICE_VIEW_CAP_BY_ACCOUNT = {
+    int(account_id): int(cap) for account_id, cap in getattr(
+        settings, 'RECS_VAV_DEVICE_VIEW_CAP_BY_ACCOUNT',
+        json.loads(os.environ.get('RECS_VAV_DEVICE_VIEW_CAP_BY_ACCOUNT', '{}'))).items()
+}
+# which products of a capped device are kept: 'recent' keeps the most recently (first) viewed ones, 'sample' a
+# deterministic pseudo random sample, the same on every run
+DEVICE_VIEW_SAMPLING = getattr(settings, 'RECS_VAV_DEVICE_VIEW_SAMPLING',
+                               os.environ.get('RECS_VAV_DEVICE_VIEW_SAMPLING', 'recent'))
+
+DEVICE_VIEW_ORDER = {
+    'recent': 'p.fact_time DESC, p.product_id',
+    'sample': 'HASH(p.product_id, p.mid_epoch, p.mid_ts, p.mid_rnd), p.product_id',
+}
+
+# the device_earliest_product_view of GET_EARLIEST_VIEW_PER_MID_AND_PID read from the facts, see precompute_rollups for
+# the rollups
+DEVICE_EARLIEST_PRODUCT_VIEW = """
     SELECT account_id, mid_epoch, mid_ts, mid_rnd, product_id, min(fact_time) fact_time
     FROM fact_product_view
     WHERE account_id in (:account_ids)
         AND fact_time >= :begin_fact_time
         /* exclude empty string to prevent empty lookup keys, filter out common invalid values to reduce join size */
         AND product_id NOT IN ('', 'null', 'NULL')
-    GROUP BY 1, 2, 3, 4, 5
+    GROUP BY 1, 2, 3, 4, 5"""
+
+GET_EARLIEST_VIEW_PER_MID_AND_PID = """
+CREATE TEMPORARY TABLE IF NOT EXISTS scratch.earliest_view_per_mid_and_pid_{account_id}_{market_id}_{retailer_id}_{lookback_days} AS
+WITH device_earliest_product_view AS (
+{device_products}
 ),
 filtered_devices AS (
     /* Exclude devices viewing more than 1000 distinct products per month */
@@ -29,6 +60,7 @@ JOIN filtered_devices fd
     AND fd.mid_epoch = p.mid_epoch
     AND fd.mid_ts = p.mid_ts
     AND fd.mid_rnd = p.mid_rnd
+{device_view_limit}
 """
 
 # account_id , market_id and retailer_id create a unique key only one variable will have a value and rest will be None
@@ -36,9 +68,9 @@ JOIN filtered_devices fd
 VIEW_ALSO_VIEW = """
 CREATE TEMPORARY TABLE scratch.{algorithm}_{account_id}_{market_id}_{retailer_id}_{lookback_days}_{purchase_data_source}
 AS
-WITH
-half_scores AS (
     /* Filter out pairs existing seen only on one device. */
+    /* Scores are symmetric, so each pair is kept once (lower triangle) and ranked in both directions */
+    /* by PID_RANKS_BY_COLLAB_RECSET, see HALF_PAIR_ALGORITHMS */
     SELECT
         p1.account_id account_id,
         p1.product_id pid1,
@@ -53,23 +85,6 @@ half_scores AS (
         AND p1.product_id < p2.product_id  /* lower triangle */
     GROUP BY 1, 2, 3
     HAVING count(*) > 1
-)
-    /* create symmetric pairs */
-    /* verify if performance benefit on snowflake */
-    SELECT
-        account_id,
-        pid1,
-        pid2,
-        score
-    FROM half_scores
-    UNION ALL
-    SELECT
-        account_id,
-        pid2 AS pid1,
-        pid1 AS pid2,
-        score
-    FROM half_scores
-
 """
 
 QUERY_DISPATCH = {
@@ -77,6 +92,32 @@ QUERY_DISPATCH = {
 }
 
 
+def get_device_view_limit(account_ids, cap=None, cap_by_account=None, sampling=None):
+    """
+    Return the QUALIFY clause of GET_EARLIEST_VIEW_PER_MID_AND_PID keeping at most the capped number of products per
+    device, or '' if none of the accounts is capped.
+
+    :param cap: Defaults to DEVICE_VIEW_CAP.
+    :param cap_by_account: Defaults to DEVICE_VIEW_CAP_BY_ACCOUNT.
+    :param sampling: 'recent' or 'sample', defaults to DEVICE_VIEW_SAMPLING.
+    """
+    cap = DEVICE_VIEW_CAP if cap is None else cap
+    cap_by_account = DEVICE_VIEW_CAP_BY_ACCOUNT if cap_by_account is None else cap_by_account
+    sampling = DEVICE_VIEW_SAMPLING if sampling is None else sampling
+    caps = {int(account_id): cap_by_account.get(int(account_id), cap) for account_id in account_ids}
+    if not any(caps.values()):
+        return ''
+    # uncapped accounts keep what filtered_devices lets through
+    no_cap = '(:lookback / 30.0 * 1000)'
+    if len(set(caps.values())) == 1:
+        cap_sql = str(int(next(iter(caps.values()))))
+    else:
+        cap_sql = 'CASE p.account_id {} END'.format(' '.join(
+            'WHEN {} THEN {}'.format(account_id, int(caps[account_id]) or no_cap) for account_id in sorted(caps)))
+    return 'QUALIFY ROW_NUMBER() OVER (PARTITION BY p.account_id, p.mid_epoch, p.mid_ts, p.mid_rnd ORDER BY {}) <= {}'\
+        .format(DEVICE_VIEW_ORDER[sampling], cap_sql)
+
+
 def process_view_collab_algorithm(conn, queue_entry):
     result_counts = []
     # since the queue table currently has accounts that do not have the precompute collab feature flag
@@ -96,20 +137,37 @@ def process_view_collab_algorithm(conn, queue_entry):
     account_ids = precompute_utils.get_account_ids_for_processing(queue_entry)
     # this query creates a temp table with all the purchases or views in given lookback period
     begin_fact_time, end_fact_time = precompute_utils.get_fact_time(lookback_days)
-    query = text(GET_EARLIEST_VIEW_PER_MID_AND_PID.format(account_id=account, market_id=market,
-                                                          retailer_id=retailer, lookback_days=lookback_days))
-    conn.execute(query, account_ids=account_ids, begin_fact_time=begin_fact_time,
-                 end_fact_time=end_fact_time, lookback=lookback_days)
+    candidate_limit = precompute_utils.get_pid_candidate_limit(queue_entry)
+    log.log_info('Keeping {} candidates per lookup key'.format(candidate_limit or 'all'))
+    with job_stage('metric'):
+        table_params = dict(account_id=account, market_id=market, retailer_id=retailer, lookback_days=lookback_days,
+                            device_view_limit=get_device_view_limit(account_ids))
+        if precompute_rollups.uses_pair_rollups(algorithm):
+            precompute_rollups.create_device_table_from_rollups(
+                conn, algorithm, GET_EARLIEST_VIEW_PER_MID_AND_PID, table_params, account_ids, begin_fact_time,
+                end_fact_time, lookback=lookback_days)
+        else:
+            conn.execute(text(GET_EARLIEST_VIEW_PER_MID_AND_PID.format(device_products=DEVICE_EARLIEST_PRODUCT_VIEW,
+                                                                       **table_params)),
+                         account_ids=account_ids, begin_fact_time=begin_fact_time, end_fact_time=end_fact_time,
+                         lookback=lookback_days)
 
-    conn.execute(text(QUERY_DISPATCH[algorithm].format(algorithm=algorithm, account_id=account, market_id=market,
-                                                       retailer_id=retailer, lookback_days=lookback_days,
-                                                       purchase_data_source="online")))
+        ranked_in_process = pair_counts.rank_pairs_in_process(
+            conn, algorithm,
+            'scratch.earliest_view_per_mid_and_pid_{}_{}_{}_{}'.format(account, market, retailer, lookback_days),
+            'scratch.pid_ranks_{}_{}_{}_{}_{}'.format(algorithm, account, market, retailer, lookback_days),
+            candidate_limit=candidate_limit)
+        if not ranked_in_process:
+            conn.execute(text(QUERY_DISPATCH[algorithm].format(algorithm=algorithm, account_id=account,
+                                                               market_id=market, retailer_id=retailer,
+                                                               lookback_days=lookback_days,
+                                                               purchase_data_source="online")))
 
     # normalize score
-    conn.execute(text(precompute_utils.PID_RANKS_BY_COLLAB_RECSET.format(algorithm=algorithm, account_id=account,
-                                                                         lookback_days=lookback_days, market_id=market,
-                                                                         retailer_id=retailer,
-                                                                         purchase_data_source="online")))
+    if not ranked_in_process:
+        with job_stage('pid_rank'):
+            conn.execute(text(precompute_utils.get_pid_ranks_query(algorithm, account, market, retailer, lookback_days,
+                                                                   "online", candidate_limit=candidate_limit)))
 
     result_counts = precompute_utils.process_collab_recsets(conn, queue_entry, account, market, retailer)
 
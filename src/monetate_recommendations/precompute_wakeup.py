@@ -0,0 +1,139 @@
+"""
+Precompute Worker Idle Polling
+==============================
+
+Keeps idle workers off the config db while still starting new work promptly:
+  - IdleBackoff grows the wait between empty polls exponentially, from the worker's poll_interval up to
+    max_poll_interval, with jitter so that workers started together do not poll in lockstep.
+  - WakeupChannel lets the enqueue commands wake idle workers as soon as they enqueue work. The channel is a file
+    named by settings.RECS_PRECOMPUTE_WAKEUP_FILE: notify_workers() touches it, and every worker on a host that can
+    see the file notices the new mtime within WAKEUP_CHECK_INTERVAL. Without the setting the channel is disabled and
+    workers only rely on polling.
+
+Usage
+-----
+    # enqueue side
+    notify_workers()
+
+    # worker side
+    channel = get_wakeup_channel(event)
+    channel.start()
+    event.wait(backoff.next_delay())
+    if channel.consume():
+        ...  # new work was enqueued
+"""
+
+import os
+import random
+import threading
+import time
+
+from django.conf import settings
+from monetate_monitoring import log
+
+# how often a worker checks the wake-up file; a stat() of a local file is cheap
+WAKEUP_CHECK_INTERVAL = 1
+# waits are randomized in [(1 - IDLE_JITTER) * delay, delay]
+IDLE_JITTER = 0.5
+
+
+def get_wakeup_file():
+    return getattr(settings, 'RECS_PRECOMPUTE_WAKEUP_FILE', os.environ.get('RECS_PRECOMPUTE_WAKEUP_FILE'))
+
+
+def notify_workers():
+    """
+    Wake up idle workers watching the wake-up file.
+
+    :return: True if the wake-up file is configured and was touched
+    """
+    wakeup_file = get_wakeup_file()
+    if not wakeup_file:
+        return False
+    try:
+        with open(wakeup_file, 'a'):
+            os.utime(wakeup_file, None)
+    except (IOError, OSError) as e:
+        log.log_info('Could not touch precompute wake-up file {}: {}'.format(wakeup_file, e))
+        return False
+    return True
+
+
+class IdleBackoff(object):
+    """
+    Exponential backoff between polls that find no work.
+
+    :param min_delay: The first delay, and the delay again after reset().
+    :param max_delay: Upper bound of the delay.
+    """
+
+    def __init__(self, min_delay, max_delay):
+        self.min_delay = min_delay
+        self.max_delay = max(min_delay, max_delay)
+        self.empty_polls = 0
+
+    def next_delay(self):
+        """Return how long to wait after another empty poll."""
+        delay = min(self.max_delay, self.min_delay * 2 ** min(self.empty_polls, 32))
+        self.empty_polls += 1
+        return delay * (1 - IDLE_JITTER * random.random())
+
+    def reset(self):
+        self.empty_polls = 0
+
+
+class WakeupChannel(object):
+    """
+    Watches the wake-up file from a daemon thread and sets event when it is touched.
+
+    :param wakeup_file: Path of the file notify_workers() touches.
+    :param event: threading.Event the worker waits on while idle.
+    """
+
+    def __init__(self, wakeup_file, event):
+        self.wakeup_file = wakeup_file
+        self.event = event
+        self.notified = False
+        self.last_mtime = self.get_mtime()
+
+    def get_mtime(self):
+        try:
+            return os.stat(self.wakeup_file).st_mtime
+        except OSError:
+            return None
+
+    def start(self):
+        thread = threading.Thread(target=self.watch)
+        thread.daemon = True
+        thread.start()
+
+    def watch(self):
+        while True:
+            time.sleep(WAKEUP_CHECK_INTERVAL)
+            mtime = self.get_mtime()
+            if mtime != self.last_mtime:
+                self.last_mtime = mtime
+                self.notified = True
+                self.event.set()
+
+    def consume(self):
+        """Return True if workers were notified since the last call."""
+        notified, self.notified = self.notified, False
+        return notified
+
+
+class NullWakeupChannel(object):
+    """Stands in for WakeupChannel when no wake-up file is configured."""
+
+    def start(self):
+        pass
+
+    def consume(self):
+        return False
+
+
+def get_wakeup_channel(event):
+    wakeup_file = get_wakeup_file()
+    if not wakeup_file:
+        return NullWakeupChannel()
+    return WakeupChannel(wakeup_file, event)
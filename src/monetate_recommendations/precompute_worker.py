@@ -6,12 +6,38 @@ Polls config for recommendations that it can process and does the following in a
   - Find and claim an eligible recommendation (see docstrings for query_recommendations and claim_recommendation)
   - Fork a thread that does the processing work. Meanwhile, the main thread heartbeats by periodically
     updating the recommendation's heartbeat_time.
-  - Once the thread exits (or times out), update the recommendation's status with the outcome.
+  - Once the thread exits (or times out), update the recommendation's status with the outcome and record the run,
+    with the time spent in each stage, in the job history (see precompute_history).
+
+With slots > 1 the worker keeps up to that many claimed recommendations in flight at once. Each one runs on its own
+thread (and so on its own warehouse connection) and is heartbeated, timed out and finalized independently.
+
+When a poll finds no work the worker backs off exponentially, from poll_interval up to max_poll_interval. A poll
+that found eligible work but lost all of it to other workers is not idle: the worker polls again after
+contended_poll_interval without backing off. With
+settings.RECS_PRECOMPUTE_WAKEUP_FILE set, idle workers are also woken up as soon as the enqueue commands add work
+(see precompute_wakeup).
+
+With isolation='process' each job runs in a reusable child process instead of a thread (see precompute_process).
+A job that passes job_max_time then has its warehouse statements cancelled and its process killed, and the worker
+carries on with other work instead of exiting.
+
+By default warehouse connections are reused between jobs (see warehouse_session): each job checks a session out of
+the worker's pool (or its child process's pool), tags its statements with the job's query tag, and has its temp
+tables dropped when it finishes. With warehouse_sessions='per-job' every job opens and closes its own connection.
 
 Usage
 -----
     worker = PrecomputeWorker()
     worker.do_work()
+
+    # keep up to 4 jobs running at once
+    worker = PrecomputeWorker(slots=4)
+    worker.do_work()
+
+    # run each job in a child process that is killed after an hour
+    worker = PrecomputeWorker(isolation='process', job_max_time=3600)
+    worker.do_work()
 """
 
 import datetime
@@ -20,23 +46,44 @@ import time
 import threading
 import traceback
 
-from django.utils import timezone
+from django.db import connections, transaction
 from django.db.models import Q
+from django.utils import timezone
 from monetate_monitoring import log
 from monetate.recs.models import RecommendationsPrecompute, PrecomputeQueue
 import monetate.recs.precompute_constants as precompute_constants
 import precompute_algo_map as precompute_algo_map
 import precompute_collab_algo_map as precompute_collab_algo_map
+from . import purchase_tables
+from .precompute_heartbeat import StatusLogBuffer, write_heartbeats
+from .precompute_history import StageTimer, record_job
+from .precompute_priority import get_priority_scorer
+from .precompute_process import JobProcessPool, get_query_tag
+from .precompute_wakeup import IdleBackoff, get_wakeup_channel
+from .warehouse_session import WarehouseSessionPool, use_warehouse_sessions
 
 log.configure_script_log('recommendations_worker')
 
+# config db alias: whether its server is MariaDB
+_mariadb_aliases = {}
+
 
 class DEFAULTS(object):
     poll_interval = 10
+    max_poll_interval = 120
     max_tries = 3
     heartbeat_interval = 60
     heartbeat_threshold = 300
     worker_max_time = 28800
+    job_max_time = None
+    slots = 1
+    status_log_max_lines = 500
+    status_log_flush_lines = 50
+    claim_order = 'priority'
+    priority_window = 50
+    contended_poll_interval = 1
+    isolation = 'thread'
+    warehouse_sessions = 'reuse'
 
 
 def get_hostname():
@@ -45,11 +92,59 @@ def get_hostname():
     return socket.gethostname()
 
 
+def is_mariadb(db_connection):
+    """Whether the mysql database behind db_connection is MariaDB, whose versions (10.x) read as newer than MySQL's."""
+    if db_connection.alias not in _mariadb_aliases:
+        with db_connection.cursor() as cursor:
+            cursor.execute('SELECT VERSION()')
+            _mariadb_aliases[db_connection.alias] = 'mariadb' in cursor.fetchone()[0].lower()
+    return _mariadb_aliases[db_connection.alias]
+
+
+def supports_skip_locked(db_connection):
+    """
+    Whether the database behind db_connection supports SELECT ... FOR UPDATE SKIP LOCKED.
+    Django 1.11 only advertises the feature for postgres; MySQL has supported it since 8.0.1 and MariaDB since 10.6.
+    """
+    if db_connection.features.has_select_for_update_skip_locked:
+        return True
+    if db_connection.vendor != 'mysql':
+        return False
+    if is_mariadb(db_connection):
+        return db_connection.mysql_version >= (10, 6)
+    return db_connection.mysql_version >= (8, 0, 1)
+
+
 class JobTimeoutError(Exception):
     """Raised when a job takes too long to process.  Do not catch this; let it kill the process."""
     pass
 
 
+def finish_thread(thread):
+    """
+    Release the config db connection opened by a work thread and wake up the worker waiting on it.
+    Django connections are per thread, so a long lived multi-slot worker would otherwise leak one per job.
+    """
+    connections.close_all()
+    if thread.done_event is not None:
+        thread.done_event.set()
+
+
+class WorkSlot(object):
+    """
+    A recommendation claimed by a multi-slot worker and the thread processing it.
+
+    :param recommendation: The claimed RecommendationsPrecompute or PrecomputeQueue row.
+    :param thread: The started PrecomputeThread or PrecomputeCombinedThread.
+    """
+
+    def __init__(self, recommendation, thread):
+        self.recommendation = recommendation
+        self.thread = thread
+        self.start_time = time.time()
+        self.timed_out = False
+
+
 class PrecomputeThread(threading.Thread):
 
     def __init__(self, recommendation):
@@ -61,12 +156,19 @@ class PrecomputeThread(threading.Thread):
         super(PrecomputeThread, self).__init__()
         self.daemon = True
         self.connector = None
+        self.done_event = None
+        self.stage_timer = StageTimer()
+        self.warehouse_sessions = None
+        self.query_tag = None
+        self.session_affinity = None
 
     def run(self):
         try:
             algorithm = self.recommendation.recset.algorithm
             if algorithm in precompute_algo_map.FUNC_MAP.keys():
-                self.result = precompute_algo_map.FUNC_MAP[algorithm]([self.recommendation.recset])[0]
+                with self.stage_timer.activate(), use_warehouse_sessions(self.warehouse_sessions, self.query_tag,
+                                                                         self.session_affinity):
+                    self.result = precompute_algo_map.FUNC_MAP[algorithm]([self.recommendation.recset])[0]
             else:
                 self.message = 'invalid precompute algorithm {}'.format(algorithm)
                 self.recommendation.status = precompute_constants.STATUS_SKIPPED
@@ -74,6 +176,8 @@ class PrecomputeThread(threading.Thread):
         except Exception as e:
             self.exception = e
             self.traceback = traceback.format_exc()
+        finally:
+            finish_thread(self)
 
 
 class PrecomputeCombinedThread(threading.Thread):
@@ -88,13 +192,24 @@ class PrecomputeCombinedThread(threading.Thread):
         self.traceback = ""
         self.daemon = True
         self.connector = None
-
+        self.done_event = None
+        self.stage_timer = StageTimer()
+        self.warehouse_sessions = None
+        self.query_tag = None
+        self.session_affinity = None
 
     def run(self):
         try:
             algorithm = self.recset_group.algorithm
             if algorithm in precompute_collab_algo_map.FUNC_MAP.keys():
-                self.result = precompute_collab_algo_map.initialize_collab_algorithm([self.recset_group], algorithm)[0]
+                with self.stage_timer.activate(), use_warehouse_sessions(self.warehouse_sessions, self.query_tag,
+                                                                         self.session_affinity):
+                    self.result = precompute_collab_algo_map.initialize_collab_algorithm([self.recset_group],
+                                                                                         algorithm)[0]
+            elif algorithm in precompute_algo_map.FUNC_MAP.keys():
+                with self.stage_timer.activate(), use_warehouse_sessions(self.warehouse_sessions, self.query_tag,
+                                                                         self.session_affinity):
+                    self.result = precompute_algo_map.process_noncollab_queue_entry(self.recset_group)
             else:
                 self.message = 'invalid precompute algorithm {}'.format(algorithm)
                 self.recset_group.status = precompute_constants.STATUS_SKIPPED
@@ -102,6 +217,8 @@ class PrecomputeCombinedThread(threading.Thread):
         except Exception as e:
             self.exception = e
             self.traceback = traceback.format_exc()
+        finally:
+            finish_thread(self)
 
 
 class PrecomputeWorker(object):
@@ -110,35 +227,97 @@ class PrecomputeWorker(object):
     The worker queries config db, receiving all recs that need to be processed and passes them to a child thread.
     The child thread constructs a snowflake query. The results are passed back to the worker and it updates the db.
 
-    :param poll_interval: How many seconds the Worker should wait before looking for new recs.
+    :param poll_interval: How many seconds the Worker should wait before looking for new recs after finding none.
+    :param max_poll_interval: Upper bound of the wait as it backs off over consecutive polls that find no recs.
     :param max_tries: How many times a worker should attempt to process a rec before marking as erred.
     :param heartbeat_interval: How often to heartbeat while doing work.
     :param heartbeat_threshold: How old a heartbeat needs to be before assuming its worker died.
     :param worker_max_time: Max time that a worker can run: it will exit upon completion of current job.
+    :param job_max_time: Max time (seconds) a single job may run before it is marked as timed out. None for no limit.
+    :param slots: How many claimed jobs the worker keeps running at once.
+    :param status_log_max_lines: How many of the most recent lines to keep in a recommendation's status_log.
+    :param status_log_flush_lines: How many buffered status log lines force a flush between stage boundaries.
+    :param claim_order: 'priority' to claim eligible recs in the order of the configured PriorityScorer,
+        'id' to claim them in primary key order.
+    :param priority_window: How many of the stalest eligible recs, and how many of the stalest eligible recs behind
+        live traffic (see PriorityScorer.traffic_filter), are scored when looking for work.
+    :param contended_poll_interval: How many seconds the Worker waits before looking again after other workers
+        claimed every rec it tried to claim.
+    :param isolation: 'thread' to run jobs on threads of the worker, 'process' to run them in child processes that
+        can be cancelled when they pass job_max_time.
+    :param warehouse_sessions: 'reuse' to run jobs on warehouse connections kept open between jobs, 'per-job' to
+        open a new connection for every job.
     """
 
     def __init__(self, poll_interval=DEFAULTS.poll_interval, max_tries=DEFAULTS.max_tries,
                  heartbeat_interval=DEFAULTS.heartbeat_interval, heartbeat_threshold=DEFAULTS.heartbeat_threshold,
-                 worker_max_time=DEFAULTS.worker_max_time, use_combined_queue=False):
+                 worker_max_time=DEFAULTS.worker_max_time, use_combined_queue=False,
+                 job_max_time=DEFAULTS.job_max_time, slots=DEFAULTS.slots,
+                 status_log_max_lines=DEFAULTS.status_log_max_lines,
+                 status_log_flush_lines=DEFAULTS.status_log_flush_lines,
+                 claim_order=DEFAULTS.claim_order, priority_window=DEFAULTS.priority_window,
+                 isolation=DEFAULTS.isolation, max_poll_interval=DEFAULTS.max_poll_interval,
+                 warehouse_sessions=DEFAULTS.warehouse_sessions,
+                 contended_poll_interval=DEFAULTS.contended_poll_interval):
         self.poll_interval = poll_interval
+        self.contended_poll_interval = contended_poll_interval
         self.max_tries = max_tries
         self.heartbeat_interval = heartbeat_interval
         self.heartbeat_threshold = heartbeat_threshold
         self.worker_max_time = worker_max_time
+        self.job_max_time = job_max_time
+        self.slots = max(1, slots or 1)
         self.worker_start_time = time.time()
         self.worker_id = '{}-{}-{}'.format(get_hostname(), os.getpid(), int(self.worker_start_time))
         self.recommendation = None
         self.attempts = 0
         self.use_combined_queue = use_combined_queue
-
-    def log(self, msg, level=log.LOG_INFO):
-        if self.recommendation is not None:
-            log.get_error_log().log(format('recommendations precompute {}: {}'.format(self.recommendation.id, msg)),
+        self.model = PrecomputeQueue if use_combined_queue else RecommendationsPrecompute
+        self.work_slots = []
+        self.slot_event = threading.Event()
+        self.idle_backoff = IdleBackoff(poll_interval, max_poll_interval)
+        self.wakeup = get_wakeup_channel(self.slot_event)
+        self.status_log_max_lines = status_log_max_lines
+        self.status_log_flush_lines = status_log_flush_lines
+        self.status_logs = {}
+        self.last_heartbeat = 0
+        self.priority_scorer = get_priority_scorer() if claim_order == 'priority' else None
+        self.priority_window = priority_window
+        # whether the last claim found eligible recs but other workers had them all
+        self.claim_contended = False
+        self.process_pool = None
+        self.warehouse_session_pool = None
+        reuse_sessions = warehouse_sessions == 'reuse'
+        if isolation == 'process':
+            thread_class = PrecomputeCombinedThread if use_combined_queue else PrecomputeThread
+            self.process_pool = JobProcessPool(self.model, thread_class, self.worker_id,
+                                               reuse_warehouse_sessions=reuse_sessions)
+        elif reuse_sessions:
+            self.warehouse_session_pool = WarehouseSessionPool()
+
+    def log(self, msg, level=log.LOG_INFO, recommendation=None):
+        recommendation = recommendation if recommendation is not None else self.recommendation
+        if recommendation is not None:
+            log.get_error_log().log(format('recommendations precompute {}: {}'.format(recommendation.id, msg)),
                                     priority=level)
-            self.recommendation.append_to_status_log('{}: worker {}: {}\n'.format(timezone.now(), self.worker_id, msg))
+            status_log = self.status_log_buffer(recommendation)
+            status_log.append('{}: worker {}: {}\n'.format(timezone.now(), self.worker_id, msg))
+            if status_log.pending >= self.status_log_flush_lines:
+                status_log.flush(self.model)
         else:
             log.get_error_log().log(msg, priority=level)
 
+    def status_log_buffer(self, recommendation):
+        """Return the buffer collecting status log lines for a recommendation, creating it if needed."""
+        if recommendation.id not in self.status_logs:
+            self.status_logs[recommendation.id] = StatusLogBuffer(recommendation, self.status_log_max_lines)
+        return self.status_logs[recommendation.id]
+
+    def flush_status_log(self, recommendation):
+        """Write buffered status log lines for a recommendation. Called at stage boundaries."""
+        if recommendation.id in self.status_logs:
+            self.status_logs[recommendation.id].flush(self.model)
+
     def do_work(self):
         """
         Start the worker.
@@ -146,16 +325,84 @@ class PrecomputeWorker(object):
         :return: None
         """
         worker_exit_time = self.worker_start_time + self.worker_max_time
-        self.log('Worker starting; will exit at {}'.format(datetime.datetime.utcfromtimestamp(worker_exit_time)))
+        self.log('Worker starting with {} slot(s); will exit at {}'.format(
+            self.slots, datetime.datetime.utcfromtimestamp(worker_exit_time)))
+        self.wakeup.start()
+        try:
+            if self.slots > 1:
+                self.do_slotted_work(worker_exit_time)
+                return
+            while True:
+                if time.time() > worker_exit_time:
+                    self.log('Worker has been alive longer than {} seconds. Exiting.'.format(self.worker_max_time))
+                    break
+                self.recommendation = None
+                self.poll()
+                if self.recommendation is None and self.claim_contended:
+                    # other workers took the work we found; there may be more behind it
+                    self.wait_for_work(min(self.contended_poll_interval, max(0, worker_exit_time - time.time())))
+                elif self.recommendation is None:
+                    # Didn't find any work to do; wait a bit before looking for more
+                    self.wait_for_work(min(self.idle_backoff.next_delay(), max(0, worker_exit_time - time.time())))
+                else:
+                    self.idle_backoff.reset()
+        finally:
+            if self.process_pool is not None:
+                self.process_pool.close()
+            if self.warehouse_session_pool is not None:
+                self.warehouse_session_pool.close()
+
+    def do_slotted_work(self, worker_exit_time):
+        """
+        Keep up to self.slots jobs in flight until the worker exceeds worker_max_time.
+
+        The main thread claims work into free slots, heartbeats and times out every in-flight job, and finalizes
+        jobs as their threads finish. Unlike the single slot loop, a job that raises does not take the worker down,
+        since that would also abandon every other job in flight. Once worker_max_time passes no new work is claimed,
+        and the worker exits after the jobs it holds have finished.
+        :return: None
+        """
+        next_poll_time = 0
+        accepting_work = True
         while True:
-            if time.time() > worker_exit_time:
-                self.log('Worker has been alive longer than {} seconds. Exiting.'.format(self.worker_max_time))
+            if accepting_work and time.time() > worker_exit_time:
+                self.log('Worker has been alive longer than {} seconds. Waiting for {} in-flight job(s) before '
+                         'exiting.'.format(self.worker_max_time, len(self.work_slots)))
+                accepting_work = False
+            self.slot_event.clear()
+            self.reap_slots()
+            if not accepting_work and not self.work_slots:
+                self.log('Worker exiting.')
                 break
-            self.recommendation = None
-            self.poll()
-            if self.recommendation is None:
-                # Didn't find any work to do; wait a bit before looking for more
-                time.sleep(self.poll_interval)
+            if self.wakeup.consume():
+                next_poll_time = 0
+                self.idle_backoff.reset()
+            if accepting_work and len(self.work_slots) < self.slots and time.time() >= next_poll_time:
+                if self.fill_slots():
+                    self.idle_backoff.reset()
+                elif self.claim_contended:
+                    # other workers took the work we found; there may be more behind it
+                    next_poll_time = time.time() + self.contended_poll_interval
+                else:
+                    # Didn't find any work to do; wait a bit before looking for more
+                    next_poll_time = time.time() + self.idle_backoff.next_delay()
+            self.check_slot_timeouts()
+            self.heartbeat_slots()
+            wait_time = self.heartbeat_interval
+            if accepting_work and len(self.work_slots) < self.slots:
+                wait_time = min(wait_time, max(0, next_poll_time - time.time()))
+            # finished jobs and wake-ups set slot_event and end the wait early
+            self.slot_event.wait(wait_time)
+
+    def wait_for_work(self, timeout):
+        """Wait up to timeout seconds before polling again, or until idle workers are woken up."""
+        self.slot_event.clear()
+        if self.wakeup.consume():
+            self.idle_backoff.reset()
+            return
+        self.slot_event.wait(timeout)
+        if self.wakeup.consume():
+            self.idle_backoff.reset()
 
     def poll(self):
         """
@@ -166,21 +413,44 @@ class PrecomputeWorker(object):
         if not self.claim_recommendation(recs_qs):
             return
         self.log('Claimed rec {}'.format(self.recommendation.id))
+        self.flush_status_log(self.recommendation)
+        thread = None
         try:
             self.recommendation.attempts += 1
             self.recommendation.precompute_start_time = timezone.now()
             thread = self.run_work_thread()  # This thread does the actual work
-            self.handle_thread_result(thread)
+            if self.recommendation.status != precompute_constants.STATUS_TIMEOUT_ERROR:
+                self.handle_thread_result(thread)
         finally:
-            # Once we get here, file should no longer be in processing state
-            # If it is, we messed something up
-            if self.recommendation.status == precompute_constants.STATUS_PROCESSING:
-                self.log('Unexpectedly still in processing', level=log.LOG_ERR)
-                self.recommendation.status = precompute_constants.STATUS_SYS_ERROR
-            self.recommendation.precompute_end_time = timezone.now()
-            self.recommendation.processing_time_seconds = int((self.recommendation.precompute_end_time - self.recommendation.precompute_start_time).total_seconds())
-            self.log('Finished processing recommendation {} -- elapsed time {}'.format(self.recommendation.id, self.recommendation.processing_time_seconds))
-            self.recommendation.save()
+            self.finish_recommendation(self.recommendation, thread)
+
+    def finish_recommendation(self, recommendation, thread=None):
+        """
+        Record the end of processing, save the outcome of the work and add the run to the job history.
+
+        :param thread: The work thread, for its stage timings. None if it is not known.
+        """
+        # Once we get here, file should no longer be in processing state
+        # If it is, we messed something up
+        if recommendation.status == precompute_constants.STATUS_PROCESSING:
+            self.log('Unexpectedly still in processing', level=log.LOG_ERR, recommendation=recommendation)
+            recommendation.status = precompute_constants.STATUS_SYS_ERROR
+        recommendation.precompute_end_time = timezone.now()
+        recommendation.processing_time_seconds = int(
+            (recommendation.precompute_end_time - recommendation.precompute_start_time).total_seconds())
+        self.log('Finished processing recommendation {} -- elapsed time {}'.format(
+            recommendation.id, recommendation.processing_time_seconds), recommendation=recommendation)
+        # the final save writes the buffered status log along with the outcome
+        status_log = self.status_logs.pop(recommendation.id, None)
+        if status_log is not None:
+            recommendation.status_log = status_log.status_log
+        recommendation.save()
+        try:
+            stage_timings = dict(thread.stage_timer.timings) if thread is not None else None
+            record_job(recommendation, stage_timings, self.worker_id)
+        except Exception as e:
+            # the history only informs estimates; never fail a job over it
+            log.log_exception('Failed to record history of recommendation {}: {}'.format(recommendation.id, e))
 
     def query_recommendations(self):
         """
@@ -209,56 +479,166 @@ class PrecomputeWorker(object):
         If successful, set self.recommendation to the claimed recommendation and return True.
         Otherwise, set self.recommendation to None and return False.
 
+        :return: Bool
+        """
+        claimed = self.claim_recommendations(recs_qs, 1)
+        self.recommendation = claimed[0] if claimed else None
+        if self.recommendation is None:
+            self.log('Did not claim any recommendation')
+            return False
+        self.log('Claimed recommendation', log.LOG_DEBUG)
+        return True
+
+    def claim_recommendations(self, recs_qs, count):
+        """
+        Attempt to claim up to count eligible recommendations and return the ones claimed.
+
+        Where the database supports it, the claim is made in a single transaction:
+          - SELECT the ids of the first count eligible recommendations FOR UPDATE SKIP LOCKED. Rows another worker
+            is in the middle of claiming are skipped instead of waited on or fought over, so claim latency stays
+            flat as the number of workers grows.
+          - Set status to PROCESSING and heartbeat_time to now() on all of those ids in one update, then commit.
+        Otherwise, fall back to claiming one row at a time with claim_recommendation_optimistic.
+
+        With a priority scorer, "first" means highest priority (see get_candidates): only the count best candidates
+        are locked, and when some of them are skipped the next best ones are tried in their place, so no more rows
+        are locked than are claimed.
+
+        Sets claim_contended when there were candidates but none could be claimed.
+
+        :return: list of claimed recommendations
+        """
+        self.claim_contended = False
+        db_connection = connections[recs_qs.db]
+        if not supports_skip_locked(db_connection):
+            claimed = []
+            while len(claimed) < count:
+                rec = self.claim_recommendation_optimistic(recs_qs)
+                if rec is None:
+                    break
+                claimed.append(rec)
+            return claimed
+
+        model = recs_qs.model
+        if self.priority_scorer is None:
+            candidate_ids = None
+        else:
+            candidate_ids = [rec.id for rec in self.get_candidates(recs_qs)]
+            if not candidate_ids:
+                return []
+        with transaction.atomic(using=recs_qs.db):
+            if candidate_ids is None:
+                # SKIP LOCKED applies before the LIMIT, so rows other workers hold are replaced by the next ones
+                rec_ids = self.lock_ids(db_connection, recs_qs.order_by('id').values_list('id', flat=True)[:count])
+            else:
+                rec_ids = []
+                pending_ids = candidate_ids
+                while pending_ids and len(rec_ids) < count:
+                    batch_ids, pending_ids = pending_ids[:count - len(rec_ids)], pending_ids[count - len(rec_ids):]
+                    locked_ids = set(self.lock_ids(
+                        db_connection, recs_qs.filter(id__in=batch_ids).values_list('id', flat=True)))
+                    rec_ids.extend(rec_id for rec_id in batch_ids if rec_id in locked_ids)
+                self.claim_contended = not rec_ids
+            if rec_ids:
+                model.objects.filter(id__in=rec_ids).update(status=precompute_constants.STATUS_PROCESSING,
+                                                            heartbeat_time=timezone.now())
+        if not rec_ids:
+            return []
+        # NB: since update() does not call save() we need to re-query the recs from the DB
+        claimed = {rec.id: rec for rec in model.objects.filter(id__in=rec_ids)}
+        return [claimed[rec_id] for rec_id in rec_ids if rec_id in claimed]
+
+    @staticmethod
+    def lock_ids(db_connection, ids_qs):
+        """Lock the rows of an id values_list FOR UPDATE SKIP LOCKED and return the ids locked."""
+        ids_sql, ids_params = ids_qs.query.sql_with_params()
+        with db_connection.cursor() as cursor:
+            cursor.execute('{} FOR UPDATE SKIP LOCKED'.format(ids_sql), ids_params)
+            return [row[0] for row in cursor.fetchall()]
+
+    def get_candidates(self, recs_qs, limit=None):
+        """
+        Return eligible recommendations in the order they should be claimed.
+
+        Without a priority scorer this is primary key order. With one, the priority_window stalest eligible recs
+        (never completed first) are fetched, along with the priority_window stalest eligible recs behind live traffic
+        so that those are not stuck behind a backlog of colder recs, and all are sorted by descending priority score.
+        """
+        if self.priority_scorer is None:
+            return list(recs_qs.order_by('id')[:limit])
+        candidates = list(recs_qs.order_by('precompute_end_time', 'id')[:self.priority_window])
+        traffic_filter = self.priority_scorer.traffic_filter(recs_qs.model)
+        if traffic_filter is not None:
+            candidate_ids = set(rec.id for rec in candidates)
+            traffic_qs = recs_qs.filter(traffic_filter).order_by('precompute_end_time', 'id')
+            candidates.extend(rec for rec in traffic_qs[:self.priority_window] if rec.id not in candidate_ids)
+        return self.priority_scorer.order(candidates)[:limit]
+
+    def claim_recommendation_optimistic(self, recs_qs):
+        """
+        Attempt to claim an eligible recommendation without taking any locks.
+        Return the claimed recommendation, or None.
+
         This works as follows:
-          - Query the first 10 eligible recommendations (The number 10 is arbitrary; just prevents us from fetching
-            the entire table every time).
+          - Query the first 10 eligible recommendations in claim order (The number 10 is arbitrary; just prevents
+            us from fetching the entire table every time).
           - For each of those, try to update it by setting its status to PROCESSING and its heartbeat_time to now().
             - If the update actually updates a row, then we have successfully claimed the recommendation.
             - If the update does not update a row, then another worker got to it before us. Try the next one.
-          - Return True if claimed a recommendation or False if failed claiming all 10.
-        Thus we never need to acquire a lock on the table to make the claim.
+          - Return None if failed claiming all 10.
 
-        :return: Bool
+        :return: recommendation or None
         """
-        self.recommendation = None
-        for rec in recs_qs.order_by('id')[:10]:
-            if self.use_combined_queue:
-                this_rec_qs = PrecomputeQueue.objects.filter(id=rec.id, status=rec.status,
-                                                              heartbeat_time=rec.heartbeat_time)
-            else:
-                this_rec_qs = RecommendationsPrecompute.objects.filter(id=rec.id, status=rec.status,
-                                                                       heartbeat_time=rec.heartbeat_time)
+        for rec in self.get_candidates(recs_qs, 10):
+            this_rec_qs = recs_qs.model.objects.filter(id=rec.id, status=rec.status, heartbeat_time=rec.heartbeat_time)
             rows_updated = this_rec_qs.update(status=precompute_constants.STATUS_PROCESSING,
                                               heartbeat_time=timezone.now())
             if rows_updated:
                 # I successfully claimed a rec
                 # NB: since update() does not call save() we need to re-query the rec from the DB
                 rec.refresh_from_db()
-                self.recommendation = rec
-                self.log('Claimed recommendation', log.LOG_DEBUG)
-                break
-            else:
-                # Someone got in and claimed it before me.  Try the next one.
-                self.log('Tried and failed to claim recommendation {}'.format(rec.id), log.LOG_DEBUG)
+                return rec
+            # Someone got in and claimed it before me.  Try the next one.
+            self.log('Tried and failed to claim recommendation {}'.format(rec.id), log.LOG_DEBUG)
+        return None
+
+    def start_work_thread(self, recommendation):
+        """
+        Start the child thread (or process) that does the work for a claimed recommendation. Queue entries with the
+        same inputs are sent to the warehouse session (or process) that last ran one, so they share its purchase
+        tables.
+        """
+        affinity = purchase_tables.get_input_fingerprint(recommendation) if self.use_combined_queue else None
+        if self.process_pool is not None:
+            thread = self.process_pool.job(recommendation, affinity)
+        elif self.use_combined_queue:
+            thread = PrecomputeCombinedThread(recommendation)
         else:
-            self.log('Did not claim any recommendation')
-            return False
-        return True
+            thread = PrecomputeThread(recommendation)
+        if self.warehouse_session_pool is not None:
+            thread.warehouse_sessions = self.warehouse_session_pool
+            thread.query_tag = get_query_tag(self.worker_id, recommendation)
+            thread.session_affinity = affinity
+        thread.done_event = self.slot_event
+        thread.start()
+        return thread
 
     def run_work_thread(self):
         """
         Run work in a child thread.
         In the main thread, heartbeat against the recs table to keep our claim current.
         Return the completed thread.
+
+        A job that passes job_max_time raises JobTimeoutError, unless it runs in a child process: its work is then
+        cancelled, the recommendation is left in STATUS_TIMEOUT_ERROR and the worker moves on.
         """
-        if self.use_combined_queue:
-            thread = PrecomputeCombinedThread(self.recommendation)
-            thread.start()
-        else:
-            thread = PrecomputeThread(self.recommendation)
-            thread.start()
+        thread = self.start_work_thread(self.recommendation)
+        self.flush_status_log(self.recommendation)
+        start_time = time.time()
 
         while thread.is_alive():
+            if self.job_max_time and time.time() - start_time > self.job_max_time:
+                break
             self.heartbeat()
             thread.join(timeout=self.heartbeat_interval)
         if thread.is_alive():
@@ -269,27 +649,101 @@ class PrecomputeWorker(object):
             self.recommendation.status = precompute_constants.STATUS_TIMEOUT_ERROR
             if thread.connector is not None:
                 thread.connector.cleanup()
-            raise JobTimeoutError(err_msg)
+            if self.process_pool is None:
+                raise JobTimeoutError(err_msg)
+            thread.join()
         return thread
 
-    def heartbeat(self):
-        """Update heartbeat_time to keep our claim on the file alive"""
-        hb_time = self.recommendation.heartbeat_time = timezone.now()
-        start_time = self.recommendation.precompute_start_time
-        if start_time is not None:
-            self.log('heartbeat {}'.format(hb_time - start_time))
-        self.recommendation.save()
+    def fill_slots(self):
+        """
+        Claim recommendations into free slots and start a work thread for each.
+        Return True if at least one recommendation was claimed.
+        """
+        free_slots = self.slots - len(self.work_slots)
+        if free_slots <= 0:
+            return False
+        self.log('Looking for new recommendations...')
+        claimed = self.claim_recommendations(self.query_recommendations(), free_slots)
+        if not claimed:
+            self.log('Did not claim any recommendation')
+        for recommendation in claimed:
+            self.log('Claimed rec {} into slot {}/{}'.format(recommendation.id, len(self.work_slots) + 1, self.slots),
+                     recommendation=recommendation)
+            recommendation.attempts += 1
+            recommendation.precompute_start_time = timezone.now()
+            self.work_slots.append(WorkSlot(recommendation, self.start_work_thread(recommendation)))
+            self.flush_status_log(recommendation)
+        return bool(claimed)
+
+    def reap_slots(self):
+        """Finalize the recommendations whose work threads have exited and free their slots."""
+        for slot in [s for s in self.work_slots if not s.thread.is_alive()]:
+            self.work_slots.remove(slot)
+            if slot.timed_out:
+                # status was already recorded when the job timed out
+                self.log('Timed out job finished after {} seconds'.format(int(time.time() - slot.start_time)),
+                         recommendation=slot.recommendation)
+                self.flush_status_log(slot.recommendation)
+                self.status_logs.pop(slot.recommendation.id, None)
+                continue
+            try:
+                self.handle_thread_result(slot.thread, slot.recommendation)
+            except Exception as e:
+                log.log_exception('Recommendation {} failed: {}'.format(slot.recommendation.id, e))
+            finally:
+                self.finish_recommendation(slot.recommendation, slot.thread)
+
+    def check_slot_timeouts(self):
+        """
+        Mark jobs that have run longer than job_max_time as timed out.
+        A thread cannot be killed, so the slot stays occupied until the thread exits; this keeps the worker from
+        running more than self.slots jobs against the warehouse at once.
+        """
+        if not self.job_max_time:
+            return
+        for slot in self.work_slots:
+            if slot.timed_out or time.time() - slot.start_time <= self.job_max_time:
+                continue
+            slot.timed_out = True
+            self.log('Recommendation {} snowflake query timed out'.format(slot.recommendation.id),
+                     recommendation=slot.recommendation)
+            slot.recommendation.status = precompute_constants.STATUS_TIMEOUT_ERROR
+            if slot.thread.connector is not None:
+                slot.thread.connector.cleanup()
+            self.finish_recommendation(slot.recommendation, slot.thread)
+
+    def heartbeat_slots(self):
+        """Heartbeat every in-flight job at once, if the last heartbeat is older than heartbeat_interval."""
+        if time.time() - self.last_heartbeat < self.heartbeat_interval:
+            return
+        self.heartbeat([slot.recommendation for slot in self.work_slots if not slot.timed_out])
 
-    def handle_thread_result(self, thread):
+    def heartbeat(self, recommendations=None):
+        """
+        Update heartbeat_time to keep our claim on the files alive.
+        Only heartbeat_time is written, for all of the recommendations in one update.
+        """
+        if recommendations is None:
+            recommendations = [self.recommendation]
+        hb_time = write_heartbeats(self.model, recommendations)
+        self.last_heartbeat = time.time()
+        for recommendation in recommendations:
+            start_time = recommendation.precompute_start_time
+            if start_time is not None:
+                self.log('heartbeat {}'.format(hb_time - start_time), recommendation=recommendation)
+
+    def handle_thread_result(self, thread, recommendation=None):
         """Set status and log according to the results of the work"""
+        recommendation = recommendation if recommendation is not None else self.recommendation
         if thread.exception is not None:
-            self.recommendation.status = precompute_constants.STATUS_SYS_ERROR
-            self.log('Threw an error during processing: {}'.format(thread.traceback), level=log.LOG_DEBUG)
+            recommendation.status = precompute_constants.STATUS_SYS_ERROR
+            self.log('Threw an error during processing: {}'.format(thread.traceback), level=log.LOG_DEBUG,
+                     recommendation=recommendation)
             raise thread.exception
         else:
-            self.recommendation.status = precompute_constants.STATUS_COMPLETE
-            self.recommendation.process_complete = True
-            self.log('products returned: {}'.format(thread.result))
-            self.recommendation.products_returned = sum(thread.result) if thread.result else 0
+            recommendation.status = precompute_constants.STATUS_COMPLETE
+            recommendation.process_complete = True
+            self.log('products returned: {}'.format(thread.result), recommendation=recommendation)
+            recommendation.products_returned = sum(thread.result) if thread.result else 0
             if thread.message:
-                self.log(thread.message)
+                self.log(thread.message, recommendation=recommendation)
@@ -0,0 +1,117 @@
+"""
+Shared Purchase Tables
+======================
+
+Builds the purchase tables of the purchase collab algorithms once per warehouse session and input, instead of once
+per queue entry.
+
+  - purchase_also_purchase, bought_together and subsequently_purchased entries of the same account/market/retailer
+    and lookback read the same purchase events (last_purchase_per_mid_and_pid and
+    offline_purchase_per_customer_and_pid). bought_together also has the pairs of purchase_also_purchase; the two
+    only differ in the algo filter get_algo_filter_dict adds to the sku ranks of bought_together. So bought_together
+    reads the purchase_also_purchase pair table (see get_pair_algorithm), and that table is shared as well. The
+    purchase, purchase_value and trending noncollab algorithms read offline_purchase_per_customer_and_pid too, and
+    build it with ensure_table at the same version (see get_events_version).
+  - ensure_table builds a shared table unless the session already has it at the same version, i.e. built from the
+    same inputs (lookback window, accounts, POS datasets, minimum count) on the same day. The tables are not dropped
+    by WarehouseSession cleanup (see SESSION_TEMP_TABLE_RE), so later jobs on a reused session find them; their data
+    is at most as old as the session (RECS_WAREHOUSE_SESSION_MAX_AGE). At most SHARED_TABLES_PER_SESSION are kept
+    per session; the least recently used ones are dropped first.
+  - The worker runs one queue entry per job, so entries with the same inputs share these tables through session
+    affinity: each job passes get_input_fingerprint of its entry to its warehouse sessions (and, with process
+    isolation, to the choice of child process), and gets the idle session that last ran an entry with the same
+    fingerprint when there is one (see warehouse_session). The collab runner also sorts the entries of a batch by
+    fingerprint, so entries with the same inputs run one after another.
+  - With RECS_SHARED_PURCHASE_TABLES off, shared tables are rebuilt on every call.
+
+Usage
+-----
+    built = ensure_table(warehouse_conn, table, version, lambda: warehouse_conn.execute(...))
+"""
+
+import collections
+import os
+import threading
+import weakref
+
+from django.conf import settings
+from monetate_monitoring import log
+
+from .warehouse_session import SESSION_TEMP_TABLE_RE
+
+SHARED_PURCHASE_TABLES = getattr(settings, 'RECS_SHARED_PURCHASE_TABLES',
+                                 os.environ.get('RECS_SHARED_PURCHASE_TABLES', 'true').lower() == 'true')
+SHARED_TABLES_PER_SESSION = int(getattr(settings, 'RECS_SHARED_PURCHASE_TABLES_PER_SESSION',
+                                        os.environ.get('RECS_SHARED_PURCHASE_TABLES_PER_SESSION', 16)))
+
+# algorithm: algorithm whose pair table it reads
+PAIR_ALGORITHMS = {
+    'bought_together': 'purchase_also_purchase',
+}
+
+# DBAPI connection (i.e. warehouse session) -> SessionTables
+_sessions = weakref.WeakKeyDictionary()
+_sessions_lock = threading.Lock()
+
+
+class SessionTables(object):
+    """The shared tables kept in one warehouse session, with the version each was built at."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # table -> version
+        self.tables = collections.OrderedDict()
+
+
+def get_pair_algorithm(algorithm):
+    return PAIR_ALGORITHMS.get(algorithm, algorithm)
+
+
+def get_input_fingerprint(queue_entry):
+    """Return a key that is the same for queue entries reading the same purchase tables."""
+    return (queue_entry.account_id or 0, queue_entry.market_id or 0, queue_entry.retailer_id or 0,
+            queue_entry.lookback_days or 0)
+
+
+def get_events_version(begin_fact_time, account_ids, account_ids_dataset_ids):
+    """
+    Return the version of the purchase event tables read from the given window, accounts and POS datasets, for
+    ensure_table. Every job building an event table passes the same version for the same inputs.
+    """
+    return begin_fact_time, tuple(sorted(account_ids)), tuple(account_ids_dataset_ids)
+
+
+def get_session_tables(conn):
+    with _sessions_lock:
+        dbapi_conn = conn.connection.connection
+        if dbapi_conn not in _sessions:
+            _sessions[dbapi_conn] = SessionTables()
+        return _sessions[dbapi_conn]
+
+
+def ensure_table(conn, table, version, build):
+    """
+    Call build to create table, unless conn's session has table at version.
+
+    :param table: The temp table build creates; tables not matched by SESSION_TEMP_TABLE_RE are dropped after each
+        job, so they are built on every call
+    :param version: Anything comparable that changes when the inputs of table do
+    :return: whether table was built
+    """
+    if not SESSION_TEMP_TABLE_RE.match(table):
+        build()
+        return True
+    tables = get_session_tables(conn)
+    with tables.lock:
+        if SHARED_PURCHASE_TABLES and tables.tables.get(table) == version:
+            tables.tables[table] = tables.tables.pop(table)
+            log.log_info('Reusing {}'.format(table))
+            return False
+        conn.execute("DROP TABLE IF EXISTS {}".format(table))
+        tables.tables.pop(table, None)
+        build()
+        tables.tables[table] = version
+        while len(tables.tables) > SHARED_TABLES_PER_SESSION:
+            evicted, _ = tables.tables.popitem(last=False)
+            conn.execute("DROP TABLE IF EXISTS {}".format(evicted))
+    return True
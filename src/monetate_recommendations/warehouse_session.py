@@ -0,0 +1,220 @@
+"""
+Warehouse Sessions
+==================
+
+Lets a worker reuse authenticated warehouse connections across precompute jobs instead of connecting (and
+authenticating) once per job.
+
+  - A WarehouseSession owns one connection. It records every temporary table created on it, and after each job drops
+    them and unsets the job's query tag, so the next job starts from a clean session even though temp tables live as
+    long as the connection. Catalog snapshots and reduced catalogs (see catalog_snapshots) and shared purchase tables
+    (see purchase_tables) are kept, since they are meant to be reused. A session that fails a job, or fails its
+    cleanup, is closed rather than reused, and sessions are reconnected after SESSION_MAX_AGE seconds.
+  - A WarehouseSessionPool hands idle sessions to jobs; each job that runs at the same time gets its own session.
+    A job may pass an affinity key (e.g. purchase_tables.get_input_fingerprint of its queue entry); it then gets the
+    idle session that last ran a job with the same key, if any, so it finds the shared tables that job built.
+  - The worker activates its pool on the thread running a job with use_warehouse_sessions(). The precompute functions
+    open their connection with warehouse_connection(), which checks a session out of the active pool, or falls back
+    to a new, unpooled connection that is closed after the job when no pool is active (e.g. management commands and
+    tests).
+
+Usage
+-----
+    pool = WarehouseSessionPool()
+    with use_warehouse_sessions(pool, query_tag, affinity):
+        with warehouse_connection('QUERY4_WH') as warehouse_conn:
+            warehouse_conn.execute(...)
+    pool.close()
+"""
+
+import contextlib
+import os
+import re
+import threading
+import time
+
+from django.conf import settings
+from monetate_monitoring import log
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import NullPool
+
+# sessions older than this are reconnected before their next job; snowflake expires idle sessions after 4 hours
+SESSION_MAX_AGE = int(getattr(settings, 'RECS_WAREHOUSE_SESSION_MAX_AGE',
+                              os.environ.get('RECS_WAREHOUSE_SESSION_MAX_AGE', 3600)))
+
+TEMP_TABLE_RE = re.compile(
+    r'^\s*CREATE\s+(?:OR\s+REPLACE\s+)?(?:LOCAL\s+|GLOBAL\s+)?TEMP(?:ORARY)?\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?'
+    r'([\w$.]+)', re.IGNORECASE)
+# temp tables kept for the life of the session; their owners check they are current before reusing them
+SESSION_TEMP_TABLE_RE = re.compile(
+    r'^scratch\.(?:catalog_snapshot|reduced_catalog|last_purchase_per_mid_and_pid|offline_purchase_per_customer_and_pid'
+    r'|purchase_also_purchase)_\w+$', re.IGNORECASE)
+
+_local = threading.local()
+
+
+class WarehouseSession(object):
+    """
+    One reusable warehouse connection.
+
+    :param dsn: SQLAlchemy url of the warehouse, settings.SNOWFLAKE_QUERY_DSN by default.
+    :param max_age: Seconds after which the connection is replaced instead of reused.
+    """
+
+    def __init__(self, dsn=None, max_age=SESSION_MAX_AGE):
+        self.dsn = dsn or settings.SNOWFLAKE_QUERY_DSN
+        self.max_age = max_age
+        self.engine = None
+        self.conn = None
+        self.connect_time = None
+        self.warehouse = None
+        self.query_tag = None
+        self.temp_tables = set()
+        # affinity key of the last job that ran on the session
+        self.affinity = None
+
+    def connect(self):
+        # one connection per session; the pool below reuses sessions, not the engine's pool
+        self.engine = create_engine(self.dsn, poolclass=NullPool)
+        event.listen(self.engine, 'before_cursor_execute', self.track_temp_tables)
+        self.conn = self.engine.connect()
+        self.connect_time = time.time()
+        self.warehouse = None
+        self.query_tag = None
+        self.temp_tables = set()
+
+    def track_temp_tables(self, conn, cursor, statement, parameters, context, executemany):
+        match = TEMP_TABLE_RE.match(statement)
+        if match and not SESSION_TEMP_TABLE_RE.match(match.group(1)):
+            self.temp_tables.add(match.group(1))
+
+    @property
+    def is_expired(self):
+        return self.conn is None or time.time() - self.connect_time > self.max_age
+
+    def checkout(self, warehouse, query_tag=None):
+        """Return the connection, set up for a job on the given warehouse."""
+        if self.is_expired:
+            self.close()
+            self.connect()
+        if warehouse != self.warehouse:
+            self.conn.execute("use warehouse {}".format(warehouse))
+            self.warehouse = warehouse
+        if query_tag and query_tag != self.query_tag and self.conn.dialect.name == 'snowflake':
+            self.conn.execute("alter session set query_tag = '{}'".format(query_tag))
+            self.query_tag = query_tag
+        return self.conn
+
+    def cleanup(self):
+        """Drop the temp tables created since the last cleanup and unset the query tag."""
+        temp_tables, self.temp_tables = self.temp_tables, set()
+        for table in sorted(temp_tables):
+            self.conn.execute("DROP TABLE IF EXISTS {}".format(table))
+        if self.query_tag:
+            self.conn.execute("alter session unset query_tag")
+            self.query_tag = None
+        return temp_tables
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception as e:
+                log.log_info('Failed to close warehouse session: {}'.format(e))
+        if self.engine is not None:
+            self.engine.dispose()
+        self.engine = None
+        self.conn = None
+
+
+class WarehouseSessionPool(object):
+    """
+    Idle WarehouseSessions of a worker. Sessions are created on demand, so the pool holds at most as many as the
+    worker ran jobs at once.
+    """
+
+    def __init__(self, dsn=None, max_age=SESSION_MAX_AGE):
+        self.dsn = dsn
+        self.max_age = max_age
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self, affinity=None):
+        """Return the most recently used idle session that last ran a job with affinity, else the most recent one."""
+        with self.lock:
+            for i in range(len(self.idle) - 1, -1, -1):
+                if self.idle[i].affinity == affinity:
+                    return self.idle.pop(i)
+            if self.idle:
+                return self.idle.pop()
+        return WarehouseSession(self.dsn, self.max_age)
+
+    def release(self, session, reuse=True):
+        """
+        Clean up a session after a job and keep it for the next one. Sessions of failed jobs are closed, since a
+        failed or cancelled statement can leave the session in an unknown state.
+        """
+        if reuse and session.conn is not None:
+            try:
+                dropped = session.cleanup()
+                if dropped:
+                    log.log_info('Dropped temp tables {}'.format(', '.join(sorted(dropped))))
+            except Exception as e:
+                log.log_exception('Failed to clean up warehouse session: {}'.format(e))
+                reuse = False
+        if not reuse or session.conn is None:
+            session.close()
+            return
+        with self.lock:
+            self.idle.append(session)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for session in idle:
+            session.close()
+
+
+@contextlib.contextmanager
+def use_warehouse_sessions(pool, query_tag=None, affinity=None):
+    """
+    Make warehouse_connection() on this thread use sessions from pool, tagging their statements with query_tag and
+    preferring sessions that last ran a job with the same affinity.
+    """
+    _local.pool = pool
+    _local.query_tag = query_tag
+    _local.affinity = affinity
+    try:
+        yield pool
+    finally:
+        _local.pool = None
+        _local.query_tag = None
+        _local.affinity = None
+
+
+@contextlib.contextmanager
+def warehouse_connection(warehouse):
+    """
+    Yield a warehouse connection using the given warehouse. The connection comes from the pool activated on this
+    thread by use_warehouse_sessions(), if any; otherwise it is a new connection that is closed on exit.
+    """
+    pool = getattr(_local, 'pool', None)
+    if pool is None:
+        # Disable pooling so temp tables do not persist on connections returned to pool
+        engine = create_engine(settings.SNOWFLAKE_QUERY_DSN, poolclass=NullPool)
+        with contextlib.closing(engine.connect()) as warehouse_conn:
+            warehouse_conn.execute("use warehouse {}".format(warehouse))
+            yield warehouse_conn
+        return
+
+    affinity = getattr(_local, 'affinity', None)
+    session = pool.acquire(affinity)
+    succeeded = False
+    try:
+        warehouse_conn = session.checkout(warehouse, _local.query_tag)
+        if affinity is not None:
+            session.affinity = affinity
+        yield warehouse_conn
+        succeeded = True
+    finally:
+        pool.release(session, reuse=succeeded)
@@ -0,0 +1,53 @@
+import threading
+
+import mock
+from monetate.test.testcases import TestCase
+
+from monetate_recommendations import account_pipelines
+from monetate_recommendations.precompute_history import StageTimer, job_stage
+
+
+class AccountPipelinesTestCase(TestCase):
+
+    def setUp(self):
+        self.engine = mock.Mock()
+        patch = mock.patch.object(account_pipelines, 'get_session_engine', return_value=self.engine)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_default_runs_in_order_on_job_connection(self):
+        conn = mock.Mock()
+        calls = []
+        pipelines = [lambda c, i=i: calls.append((c, i)) or i for i in range(3)]
+        self.assertEqual(account_pipelines.run_account_pipelines(conn, pipelines, concurrency=1), [0, 1, 2])
+        self.assertEqual(calls, [(conn, 0), (conn, 1), (conn, 2)])
+        account_pipelines.get_session_engine.assert_not_called()
+
+    def test_pipelines_run_concurrently_on_session_connections(self):
+        running = []
+        lock = threading.Lock()
+        both_running = threading.Event()
+
+        def pipeline(conn, account_id):
+            with lock:
+                running.append(account_id)
+                if len(running) == 2:
+                    both_running.set()
+            with job_stage('unload'):
+                self.assertTrue(both_running.wait(5))
+            return conn, account_id
+
+        timer = StageTimer()
+        with timer.activate():
+            results = account_pipelines.run_account_pipelines(
+                mock.Mock(), [lambda conn, i=i: pipeline(conn, i) for i in range(4)], concurrency=2)
+        self.assertEqual([account_id for _, account_id in results], [0, 1, 2, 3])
+        self.assertEqual(len(self.engine.connect.call_args_list), 2)
+        self.assertIn('unload', timer.timings)
+
+    def test_first_error_is_raised(self):
+        def fail(conn):
+            raise ValueError('account failed')
+
+        with self.assertRaises(ValueError):
+            account_pipelines.run_account_pipelines(mock.Mock(), [fail, lambda conn: 1], concurrency=2)
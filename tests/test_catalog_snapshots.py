@@ -0,0 +1,79 @@
+import mock
+from monetate.test.testcases import TestCase
+
+from monetate_recommendations import catalog_snapshots
+
+
+class CatalogSnapshotsTestCase(TestCase):
+
+    def setUp(self):
+        self.versions = {}
+        patch = mock.patch.object(catalog_snapshots, 'text', side_effect=lambda sql: sql)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def _session(self):
+        conn = mock.Mock()
+
+        def execute(sql, **params):
+            result = mock.Mock()
+            result.first.return_value = self.versions.get(params.get('catalog_id'))
+            return result
+
+        conn.execute.side_effect = execute
+        return conn
+
+    def _builds(self, conn):
+        return [call[0][0] for call in conn.execute.call_args_list if 'CREATE OR REPLACE TEMPORARY TABLE' in call[0][0]]
+
+    def test_snapshot_is_built_once_per_catalog_version_and_session(self):
+        conn = self._session()
+        self.versions[10] = ('2020-08-01 00:00:00', '2020-07-01 00:00:00')
+        self.assertEqual(catalog_snapshots.get_catalog_snapshot(conn, 1, 10), 'scratch.catalog_snapshot_1_10')
+        self.assertEqual(catalog_snapshots.get_catalog_snapshot(conn, 1, 10), 'scratch.catalog_snapshot_1_10')
+        self.assertEqual(len(self._builds(conn)), 1)
+        self.assertIn('pc.retailer_id = 1 AND pc.dataset_id = 10', self._builds(conn)[0])
+
+        self.versions[10] = ('2020-08-02 00:00:00', '2020-07-01 00:00:00')
+        catalog_snapshots.get_catalog_snapshot(conn, 1, 10)
+        self.assertEqual(len(self._builds(conn)), 2)
+
+        other_session = self._session()
+        catalog_snapshots.get_catalog_snapshot(other_session, 1, 10)
+        self.assertEqual(len(self._builds(other_session)), 1)
+
+    def test_least_recently_used_snapshot_is_dropped(self):
+        conn = self._session()
+        with mock.patch.object(catalog_snapshots, 'SNAPSHOTS_PER_SESSION', 2):
+            for catalog_id in [10, 11, 10, 12]:
+                catalog_snapshots.get_catalog_snapshot(conn, 1, catalog_id)
+        conn.execute.assert_any_call('DROP TABLE IF EXISTS scratch.catalog_snapshot_1_11')
+        self.assertEqual(len(self._builds(conn)), 3)
+
+    def test_disabled_snapshots_read_product_catalog(self):
+        conn = self._session()
+        with mock.patch.object(catalog_snapshots, 'CATALOG_SNAPSHOTS', False):
+            latest_catalog = catalog_snapshots.get_catalog_snapshot(conn, 1, 10)
+        self.assertIn('FROM product_catalog as pc', latest_catalog)
+        conn.execute.assert_not_called()
+
+    def test_reduced_catalog_is_shared_by_equal_filters(self):
+        conn = self._session()
+        self.versions[10] = ('2020-08-01 00:00:00', '2020-07-01 00:00:00')
+        early = "WHERE lower(lc.brand) IN (:lower_1)"
+        first = catalog_snapshots.get_reduced_catalog(conn, 1, 10, early, '', {'lower_1': 'a'})
+        again = catalog_snapshots.get_reduced_catalog(conn, 1, 10, '  ' + early + '\n', '', {'lower_1': 'a'})
+        other = catalog_snapshots.get_reduced_catalog(conn, 1, 10, early, '', {'lower_1': 'b'})
+        self.assertEqual(first, again)
+        self.assertNotEqual(first, other)
+        self.assertTrue(first.startswith('scratch.reduced_catalog_1_10_'))
+        self.assertEqual(catalog_snapshots.pop_reduced_catalog_stats(conn), (1, 2))
+        self.assertEqual(catalog_snapshots.pop_reduced_catalog_stats(conn), (0, 0))
+
+        # a new catalog version rebuilds the snapshot and the reductions made from it
+        self.versions[10] = ('2020-08-02 00:00:00', '2020-07-01 00:00:00')
+        catalog_snapshots.get_reduced_catalog(conn, 1, 10, early, '', {'lower_1': 'a'})
+        self.assertEqual(catalog_snapshots.pop_reduced_catalog_stats(conn), (0, 1))
+        builds = [call for call in conn.execute.call_args_list if 'scratch.reduced_catalog_' in call[0][0]]
+        self.assertIn('FROM scratch.catalog_snapshot_1_10 as lc', builds[-1][0][0])
+        self.assertEqual(builds[-1][1], {'lower_1': 'a'})
@@ -0,0 +1,79 @@
+import collections
+import decimal
+import random
+import unittest
+
+import mock
+from monetate.test.testcases import TestCase
+
+from monetate_recommendations import pair_counts
+
+
+def sql_pair_counts(rows, minimum_count):
+    """The pairs of ONLINE_PAP_QUERY: a self join of the device products on the device, counted per pair."""
+    counts = collections.Counter()
+    for account_id, mid_epoch, mid_ts, mid_rnd, pid1 in rows:
+        for other in rows:
+            if other[:4] == (account_id, mid_epoch, mid_ts, mid_rnd) and other[4] != pid1:
+                counts[(account_id, pid1, other[4])] += 1
+    return sorted(pair + (count,) for pair, count in counts.items() if count >= minimum_count)
+
+
+@unittest.skipIf(pair_counts.sparse is None, 'scipy is not installed')
+class PairCountsTestCase(TestCase):
+
+    def _rows(self, seed):
+        rng = random.Random(seed)
+        rows = set()
+        for _ in range(400):
+            account_id = rng.choice([1, 2])
+            rows.add((account_id, 1600000000, rng.randint(1, 40), 7, 'SKU-{}'.format(rng.randint(1, 12))))
+        return sorted(rows)
+
+    def test_pair_counts_match_self_join(self):
+        for seed in range(3):
+            rows = self._rows(seed)
+            for minimum_count in [1, 3]:
+                batches = [rows[start:start + 50] for start in range(0, len(rows), 50)]
+                self.assertEqual(sorted(pair_counts.count_pairs(batches, minimum_count)),
+                                 sql_pair_counts(rows, minimum_count))
+
+    def test_pairs_are_ranked_and_normalized_as_pid_ranks(self):
+        ranks = pair_counts.rank_pairs([
+            (1, 'a', 'b', 2), (1, 'a', 'c', 5), (1, 'a', 'd', 5), (1, 'b', 'a', 2), (2, 'a', 'b', 3),
+        ])
+        self.assertEqual(sorted(ranks), [
+            (1, 'a', 'b', 2, 3, decimal.Decimal('0.01')),
+            (1, 'a', 'c', 5, 2, decimal.Decimal('1000.00')),
+            (1, 'a', 'd', 5, 1, decimal.Decimal('1000.00')),
+            (1, 'b', 'a', 2, 1, decimal.Decimal('0.01')),
+            # (3 - 2) / 3 * 999.99 + 0.01 = 333.34
+            (2, 'a', 'b', 3, 1, decimal.Decimal('333.34')),
+        ])
+
+    def test_candidates_are_limited_per_lookup_key(self):
+        ranks = pair_counts.rank_pairs([(1, 'a', 'b', 2), (1, 'a', 'c', 5), (1, 'a', 'd', 4), (1, 'b', 'a', 2)],
+                                       candidate_limit=2)
+        self.assertEqual(sorted((pid1, pid2, ordinal) for _, pid1, pid2, _, ordinal, _ in ranks),
+                         [('a', 'c', 1), ('a', 'd', 2), ('b', 'a', 1)])
+
+    def test_large_jobs_are_left_to_the_warehouse(self):
+        conn = mock.Mock()
+        conn.execute.return_value.scalar.return_value = 101
+        with mock.patch.object(pair_counts, 'IN_PROCESS_MAX_ROWS', 100):
+            self.assertFalse(pair_counts.rank_pairs_in_process(conn, 'purchase_also_purchase', 'devices', 'ranks'))
+            self.assertFalse(pair_counts.rank_pairs_in_process(conn, 'subsequently_purchased', 'devices', 'ranks'))
+        self.assertEqual(conn.execute.call_count, 1)
+
+    def test_small_jobs_are_loaded_in_batches(self):
+        rows = self._rows(0)
+        conn = mock.Mock()
+        conn.execute.return_value.scalar.return_value = len(rows)
+        conn.execute.return_value.fetchmany.side_effect = [rows[:200], rows[200:], []]
+        with mock.patch.object(pair_counts, 'IN_PROCESS_MAX_ROWS', 1000), \
+                mock.patch.object(pair_counts, 'LOAD_BATCH_SIZE', 100), \
+                mock.patch.object(pair_counts, 'text', side_effect=lambda sql: sql):
+            self.assertTrue(pair_counts.rank_pairs_in_process(conn, 'view_also_view', 'devices', 'ranks'))
+        loads = [call[1]['rows'] for call in conn.execute.call_args_list if 'INSERT INTO ranks' in call[0][0]]
+        expected = pair_counts.rank_pairs(sql_pair_counts(rows, 2))
+        self.assertEqual(len(loads), (len(expected) + 99) // 100)
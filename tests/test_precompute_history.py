@@ -0,0 +1,83 @@
+import threading
+
+import mock
+import monetate.recs.precompute_constants as precompute_constants
+from monetate.test.testcases import TestCase
+
+from monetate_recommendations import precompute_history
+
+
+class FakeRecset(object):
+    def __init__(self, recset_id):
+        self.id = recset_id
+        self.algorithm = 'view'
+        self.lookback_days = 7
+        self.purchase_data_source = 'online'
+
+
+class FakeRecommendation(object):
+    def __init__(self, rec_id, processing_time_seconds=None, products_returned=0):
+        self.id = rec_id
+        self.recset = FakeRecset(rec_id)
+        self.processing_time_seconds = processing_time_seconds
+        self.products_returned = products_returned
+
+
+class StageTimerTestCase(TestCase):
+
+    def test_stages_accumulate_on_active_thread_only(self):
+        timer = precompute_history.StageTimer()
+        with precompute_history.job_stage('rank'):
+            pass
+        self.assertEqual(timer.timings, {})
+        with timer.activate():
+            with precompute_history.job_stage('rank'):
+                pass
+            with precompute_history.job_stage('unload'):
+                pass
+            with precompute_history.job_stage('rank'):
+                pass
+        self.assertEqual(list(timer.timings.keys()), ['rank', 'unload'])
+        # deactivated once the job is done
+        with precompute_history.job_stage('metric'):
+            pass
+        self.assertNotIn('metric', timer.timings)
+
+    def test_stages_of_concurrent_threads_add_up(self):
+        timer = precompute_history.StageTimer()
+
+        def add_stages():
+            for _ in range(10000):
+                timer.add('rank', 1)
+
+        threads = [threading.Thread(target=add_stages) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(timer.timings, {'rank': 80000})
+
+
+class EstimateJobsTestCase(TestCase):
+
+    def setUp(self):
+        patch = mock.patch.object(precompute_history, 'PrecomputeJobHistory')
+        self.history = patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_median_of_recent_completed_runs(self):
+        with_history, without_history, never_run = (FakeRecommendation(1), FakeRecommendation(2, 30, 4),
+                                                    FakeRecommendation(3))
+        key = precompute_history.get_job_key(with_history)
+        runs = [(key, 100, 10), (key, 300, 30), (key, 200, 20), (key, 9000, 90)]
+        query = self.history.objects.filter.return_value.order_by.return_value.values_list
+        query.return_value = runs
+        estimates = precompute_history.estimate_jobs([with_history, without_history, never_run], samples=3)
+        self.history.objects.filter.assert_called_once_with(
+            job_key__in={key, precompute_history.get_job_key(without_history),
+                         precompute_history.get_job_key(never_run)},
+            status=precompute_constants.STATUS_COMPLETE)
+        # one query for the whole batch; only the 3 most recent runs count
+        self.assertEqual(estimates[1], precompute_history.JobEstimate(200, 20, 3))
+        self.assertEqual(estimates[2], precompute_history.JobEstimate(30, 4, 0))
+        self.assertEqual(estimates[3], precompute_history.JobEstimate(None, None, 0))
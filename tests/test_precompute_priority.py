@@ -0,0 +1,89 @@
+from datetime import timedelta
+
+import mock
+from django.utils import timezone
+from monetate.test.testcases import TestCase
+
+from monetate_recommendations import precompute_priority
+from monetate_recommendations.precompute_history import JobEstimate
+
+
+class FakeRecset(object):
+    def __init__(self, recset_id, is_component_recset=False):
+        self.id = recset_id
+        self.is_component_recset = is_component_recset
+
+
+class FakeRecommendation(object):
+    def __init__(self, rec_id, hours_stale=None, attempts=0, processing_time_seconds=None, input_count=0):
+        self.id = rec_id
+        self.recset = FakeRecset(rec_id)
+        self.attempts = attempts
+        self.processing_time_seconds = processing_time_seconds
+        self.precompute_end_time = None if hours_stale is None else timezone.now() - timedelta(hours=hours_stale)
+        self.input_count = input_count
+
+
+class PriorityScorerTestCase(TestCase):
+
+    def setUp(self):
+        input_counts = {}
+        self.recommendations = []
+
+        def get_recent_input_count(recset):
+            return input_counts[recset.id]
+
+        def make(*args, **kwargs):
+            rec = FakeRecommendation(*args, **kwargs)
+            input_counts[rec.id] = rec.input_count
+            return rec
+
+        self.make = make
+        patches = [
+            mock.patch.object(precompute_priority, 'get_recent_input_count', side_effect=get_recent_input_count),
+            mock.patch.object(precompute_priority, 'is_strategy_active', return_value=False),
+            mock.patch.object(precompute_priority, 'estimate_jobs', return_value={}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.scorer = precompute_priority.PriorityScorer()
+
+    def _order(self, *recommendations):
+        return [rec.id for rec in self.scorer.order(list(recommendations))]
+
+    def test_never_run_before_recently_run(self):
+        self.assertEqual(self._order(self.make(1, hours_stale=1), self.make(2)), [2, 1])
+
+    def test_traffic_outranks_equal_staleness(self):
+        self.assertEqual(self._order(self.make(1, hours_stale=10), self.make(2, hours_stale=10, input_count=5)),
+                         [2, 1])
+
+    def test_failing_and_expensive_jobs_fall_behind(self):
+        self.assertEqual(self._order(self.make(1, hours_stale=10, attempts=2), self.make(2, hours_stale=10)), [2, 1])
+        self.assertEqual(self._order(self.make(1, hours_stale=10, processing_time_seconds=3600),
+                                     self.make(2, hours_stale=10, processing_time_seconds=60)), [2, 1])
+
+    def test_cost_comes_from_history_estimate(self):
+        expensive, cheap = self.make(1, hours_stale=10, processing_time_seconds=60), self.make(2, hours_stale=10)
+        precompute_priority.estimate_jobs.return_value = {
+            1: JobEstimate(3600, 100, 5),
+            2: JobEstimate(60, 100, 5),
+        }
+        self.assertEqual(self._order(expensive, cheap), [2, 1])
+
+    def test_traffic_weight_is_cached(self):
+        rec = self.make(1, hours_stale=10, input_count=5)
+        self.scorer.order([rec])
+        self.scorer.order([rec])
+        self.assertEqual(precompute_priority.get_recent_input_count.call_count, 1)
+
+    def test_traffic_filter_selects_recs_of_recsets_with_most_inputs(self):
+        class Model(object):
+            pass
+
+        with mock.patch.object(precompute_priority, 'get_recent_input_counts', return_value={3: 9, 4: 2}) as counts:
+            traffic_filter = self.scorer.traffic_filter(Model)
+            self.assertIs(self.scorer.traffic_filter(Model), traffic_filter)
+        self.assertEqual(sorted(traffic_filter.children[0][1]), [3, 4])
+        counts.assert_called_once_with(precompute_priority.TRAFFIC_FILTER_RECSETS)
@@ -0,0 +1,119 @@
+import os
+import signal
+import time
+
+import mock
+from monetate.test.testcases import TestCase
+
+from monetate_recommendations import precompute_process
+from monetate_recommendations.precompute_history import StageTimer
+
+
+class FakeRecommendation(object):
+    def __init__(self, rec_id):
+        self.id = rec_id
+        self.attempts = 1
+
+
+class FakeModel(object):
+    class objects(object):
+        @staticmethod
+        def get(id):
+            return FakeRecommendation(id)
+
+
+class FakeThread(object):
+    """
+    Stands in for PrecomputeThread: recommendation 0 hangs, -2 hangs ignoring SIGTERM, other negative ids fail, others
+    return [id, pid].
+    """
+
+    def __init__(self, recommendation):
+        self.recommendation = recommendation
+        self.result = None
+        self.exception = None
+        self.message = None
+        self.traceback = ''
+        self.stage_timer = StageTimer()
+
+    def run(self):
+        if self.recommendation.id == 0:
+            time.sleep(60)
+        elif self.recommendation.id == -2:
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            time.sleep(60)
+        elif self.recommendation.id < 0:
+            self.exception = ValueError('boom')
+        else:
+            self.stage_timer.add('rank', 1.5)
+            self.result = [self.recommendation.id, os.getpid()]
+
+
+class JobProcessPoolTestCase(TestCase):
+
+    def setUp(self):
+        self.pool = precompute_process.JobProcessPool(FakeModel, FakeThread, 'worker-1')
+        self.addCleanup(self.pool.close)
+
+    def _run(self, rec_id, timeout=30, affinity=None):
+        job = self.pool.job(FakeRecommendation(rec_id), affinity)
+        job.start()
+        job.join(timeout)
+        return job
+
+    def test_jobs_run_in_a_reused_child_process(self):
+        first = self._run(1)
+        second = self._run(2)
+        self.assertFalse(first.is_alive())
+        self.assertIsNone(first.exception)
+        self.assertEqual(first.result[0], 1)
+        self.assertEqual(first.stage_timer.timings, {'rank': 1.5})
+        self.assertNotEqual(first.result[1], os.getpid())
+        self.assertEqual(second.result[1], first.result[1])
+
+    def test_job_prefers_process_that_ran_its_affinity(self):
+        first = self.pool.job(FakeRecommendation(1), (1, 2, 0, 30))
+        second = self.pool.job(FakeRecommendation(2), (3, 2, 0, 30))
+        for job in (first, second):
+            job.start()
+        for job in (first, second):
+            job.join(30)
+        self.assertNotEqual(first.result[1], second.result[1])
+        self.assertEqual(self._run(3, affinity=(3, 2, 0, 30)).result[1], second.result[1])
+        self.assertEqual(self._run(4, affinity=(1, 2, 0, 30)).result[1], first.result[1])
+        self.assertEqual(self._run(5, affinity=(3, 2, 0, 30)).result[1], second.result[1])
+
+    def test_job_error_is_returned(self):
+        job = self._run(-1)
+        self.assertIsInstance(job.exception, precompute_process.JobProcessError)
+        self.assertIn('boom', str(job.exception))
+        # the process survives a failed job
+        self.assertEqual(len(self.pool.idle), 1)
+
+    @mock.patch.object(precompute_process, 'cancel_queries', return_value=['q1'])
+    def test_cleanup_cancels_queries_and_replaces_process(self, cancel_queries):
+        job = self._run(0, timeout=1)
+        self.assertTrue(job.is_alive())
+        job.connector.cleanup()
+        job.join(30)
+        self.assertFalse(job.is_alive())
+        cancel_queries.assert_called_once_with(job.query_tag)
+        self.assertIsInstance(job.exception, precompute_process.JobProcessError)
+        self.assertEqual(self.pool.idle, [])
+        # the next job gets a new process
+        self.assertEqual(self._run(3).result[0], 3)
+
+    @mock.patch.object(precompute_process, 'TERMINATE_TIMEOUT', 1)
+    @mock.patch.object(precompute_process, 'cancel_queries', return_value=[])
+    def test_cleanup_kills_process_that_ignores_terminate(self, cancel_queries):
+        job = self._run(-2, timeout=1)
+        self.assertTrue(job.is_alive())
+        job.connector.cleanup()
+        job.join(30)
+        self.assertFalse(job.is_alive())
+        self.assertFalse(job.process.is_alive())
+        self.assertEqual(job.process.process.exitcode, -signal.SIGKILL)
+
+    def test_query_tag_is_safe_to_inline(self):
+        tag = precompute_process.get_query_tag("host'name-1", FakeRecommendation(5))
+        self.assertEqual(tag, 'recs_precompute:host_name-1:FakeRecommendation:5:1')
@@ -0,0 +1,110 @@
+import datetime
+
+import mock
+from monetate.test.testcases import TestCase
+
+from monetate_recommendations import precompute_rollups
+
+
+class PrecomputeRollupsTestCase(TestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(precompute_rollups, 'text', side_effect=lambda sql: sql),
+            mock.patch.object(precompute_rollups.sqlalchemy_warehouse, 'get_session_time_bounds',
+                              side_effect=lambda begin, end: (begin, end)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_missing_days_are_grouped_by_account(self):
+        day = datetime.date(2020, 8, 1)
+        days = [day + datetime.timedelta(days=i) for i in range(5)]
+        loaded = {(1, days[0]), (1, days[1]), (1, days[2]), (2, days[0]), (2, days[1]), (2, days[2]), (1, days[4])}
+        end_date = days[4] + datetime.timedelta(days=1)
+        self.assertEqual(precompute_rollups.get_missing_day_ranges([1, 2], loaded, days[0], end_date), [
+            ([1, 2], days[3], days[4]),
+            ([2], days[4], end_date),
+        ])
+        self.assertEqual(precompute_rollups.get_missing_day_ranges([1], loaded | {(1, days[3])}, days[0], days[4]), [])
+
+    def test_only_missing_days_are_loaded(self):
+        end_date = datetime.date(2020, 8, 31)
+        begin_date = end_date - datetime.timedelta(days=30)
+        loaded = [(1, begin_date + datetime.timedelta(days=i)) for i in range(29)]
+        conn = mock.Mock()
+        conn.execute.side_effect = lambda sql, **params: loaded if 'SELECT account_id, fact_date' in sql else None
+
+        days_loaded = precompute_rollups.ensure_rollups(conn, precompute_rollups.PURCHASE_ROLLUP, [1], begin_date,
+                                                        end_date)
+
+        self.assertEqual(days_loaded, 1)
+        load = [call for call in conn.execute.call_args_list
+                if 'MERGE INTO scratch.recs_product_purchase_daily' in call[0][0]]
+        self.assertEqual(len(load), 1)
+        self.assertEqual(load[0][1]['begin_fact_time'], datetime.datetime(2020, 8, 30))
+        self.assertEqual(load[0][1]['end_fact_time'], datetime.datetime(2020, 8, 31))
+        mark = [call for call in conn.execute.call_args_list if 'recs_metric_rollup_days t' in call[0][0]]
+        self.assertEqual(mark[0][1]['account_ids_json'], '[1]')
+        self.assertEqual(mark[0][1]['days'], 1)
+
+    def test_unsettled_days_are_not_loaded(self):
+        conn = mock.Mock()
+        conn.execute.return_value = []
+        with mock.patch.object(precompute_rollups, 'ROLLUP_SETTLE_DAYS', 3):
+            precompute_rollups.ensure_rollups(conn, precompute_rollups.VIEW_ROLLUP, [1], datetime.date(2020, 8, 1),
+                                              datetime.date(2020, 8, 31))
+        loaded_sql, params = conn.execute.call_args_list[2][0][0], conn.execute.call_args_list[2][1]
+        self.assertIn('AND loaded_time >= DATEADD(day, 1 + :settle_days, fact_date)', loaded_sql)
+        self.assertEqual(params['settle_days'], 3)
+
+    def test_metric_table_sums_rollups_over_window(self):
+        conn = mock.Mock()
+        conn.execute.return_value = []
+        table_params = dict(account_id=None, lookback=30, market_id=3, retailer_scope=None)
+        precompute_rollups.create_metric_table_from_rollups(
+            conn, 'purchase_value', [1, 2], table_params, datetime.datetime(2020, 8, 1),
+            datetime.datetime(2020, 8, 31))
+        metric_sql, params = conn.execute.call_args_list[-1][0][0], conn.execute.call_args_list[-1][1]
+        self.assertIn('scratch.purchase_value_None_30_3_None_online AS', metric_sql)
+        self.assertIn('SUM(account_value) as subtotal', metric_sql)
+        self.assertEqual(params, dict(account_ids=[1, 2], begin_fact_date=datetime.date(2020, 8, 1),
+                                      end_fact_date=datetime.date(2020, 8, 31)))
+
+    def test_trending_reads_both_windows_in_one_scan(self):
+        conn = mock.Mock()
+        conn.execute.return_value = []
+        table_params = dict(account_id=1, lookback=7, market_id=None, retailer_scope=None)
+        precompute_rollups.create_metric_table_from_rollups(
+            conn, 'trending', [1], table_params, datetime.datetime(2020, 8, 24), datetime.datetime(2020, 8, 31),
+            datetime.datetime(2020, 8, 1), datetime.datetime(2020, 8, 31))
+        loads = [call for call in conn.execute.call_args_list if call[0][0].lstrip().startswith('MERGE INTO')]
+        self.assertEqual(loads[0][1]['begin_fact_date'], datetime.date(2020, 8, 1))
+        metric_sql, params = conn.execute.call_args_list[-1][0][0], conn.execute.call_args_list[-1][1]
+        self.assertEqual(metric_sql.count('FROM scratch.recs_product_purchase_daily'), 1)
+        self.assertEqual(params['begin_fact_date'], datetime.date(2020, 8, 24))
+        self.assertEqual(params['begin_30_day_fact_date'], datetime.date(2020, 8, 1))
+
+    def test_device_table_reads_window_of_device_rollups(self):
+        conn = mock.Mock()
+        conn.execute.return_value = []
+        query = 'CREATE TEMPORARY TABLE IF NOT EXISTS scratch.last_purchase_{account_id} AS {device_products}'
+        with mock.patch.object(precompute_rollups, 'COLLAB_PAIR_ROLLUPS', True):
+            self.assertTrue(precompute_rollups.uses_pair_rollups('subsequently_purchased'))
+            precompute_rollups.create_device_table_from_rollups(
+                conn, 'subsequently_purchased', query, dict(account_id=1), [1], datetime.datetime(2020, 8, 1),
+                datetime.datetime(2020, 8, 31))
+        statements = [call[0][0] for call in conn.execute.call_args_list]
+        load = [statement for statement in statements if 'MERGE INTO scratch.recs_device_purchase_daily' in statement]
+        self.assertEqual(len(load), 1)
+        self.assertIn('MAX(fact_time) fact_time', load[0])
+        device_sql, params = statements[-1], conn.execute.call_args_list[-1][1]
+        self.assertIn('scratch.last_purchase_1 AS', device_sql)
+        # the last purchase over the whole window, so pairs bought on different days are kept
+        self.assertIn('SELECT account_id, mid_epoch, mid_ts, mid_rnd, product_id, MAX(fact_time) fact_time', device_sql)
+        self.assertIn('FROM scratch.recs_device_purchase_daily', device_sql)
+        self.assertIn('FROM m_dedup_purchase_line', device_sql)
+        self.assertEqual(params, dict(account_ids=[1], begin_fact_date=datetime.date(2020, 8, 1),
+                                      end_fact_date=datetime.date(2020, 8, 31),
+                                      end_fact_time=datetime.datetime(2020, 8, 31)))
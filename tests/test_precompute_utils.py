@@ -1,4 +1,5 @@
 import json
+import mock
 from monetate.test.testcases import TestCase
 
 from monetate_recommendations import precompute_utils
@@ -643,4 +644,160 @@ class PrecomputeUtilsTestCase(TestCase):
                                                                                                     recset_filter_json, global_filter_json, catalog_fields)
         self.assertEqual(expected_context_attributes, actual_context_attributes)
         self.assertEqual(expected_recommendation_attributes, actual_recommendation_attributes)
-        self.assertEqual(expected_recommendation_attributes_group_by, actual_recommendation_attributes_group_by)
\ No newline at end of file
+        self.assertEqual(expected_recommendation_attributes_group_by, actual_recommendation_attributes_group_by)
+
+    def test_metric_table_batch_builds_each_key_once(self):
+        def recset(recset_id, account_id=None, lookback_days=7, market_driven=False):
+            return mock.Mock(id=recset_id, algorithm='view', lookback_days=lookback_days, market=None,
+                             retailer=mock.Mock(id=1), retailer_market_scope=market_driven or None,
+                             purchase_data_source='online', is_market_or_retailer_driven_ds=market_driven)
+
+        batch = precompute_utils.MetricTableBatch()
+        keys = [
+            precompute_utils.get_metric_table_key(recset(1), 10),
+            precompute_utils.get_metric_table_key(recset(2), 10),
+            precompute_utils.get_metric_table_key(recset(3), 11),
+            precompute_utils.get_metric_table_key(recset(4, lookback_days=30), 10),
+            precompute_utils.get_metric_table_key(recset(5, market_driven=True), 10),
+            precompute_utils.get_metric_table_key(recset(6, market_driven=True), 11),
+        ]
+        built = []
+        for key in keys:
+            if not batch.is_built(key):
+                batch.add(key)
+                built.append(key)
+        self.assertEqual(built, [keys[0], keys[2], keys[3], keys[4]])
+        self.assertEqual(batch.scans_saved, 2)
+
+    def test_rank_recset_accounts_ranks_all_accounts_at_once(self):
+        recset = mock.Mock(id=5, algorithm='view', lookback_days=7, market=None, retailer_market_scope=None,
+                           purchase_data_source='online', geo_target='country')
+        accounts_inputs = [
+            precompute_utils.AccountRankInputs(account_id, 100 + (account_id % 2), '', '', {}, False)
+            for account_id in [1, 2, 3]
+        ]
+        conn = mock.Mock()
+        with mock.patch.object(precompute_utils, 'text', side_effect=lambda sql: sql), \
+                mock.patch.object(precompute_utils, 'get_catalog_snapshot',
+                                  side_effect=lambda conn, retailer_id, catalog_id: 'snapshot_{}'.format(catalog_id)), \
+                mock.patch.object(precompute_utils, 'get_reduced_catalog',
+                                  side_effect=lambda conn, retailer_id, catalog_id, *filters: 'reduced_{}'.format(
+                                      catalog_id)):
+            ranked = precompute_utils.rank_recset_accounts(conn, recset, accounts_inputs)
+        rank_sql = conn.execute.call_args_list[0][0][0]
+        self.assertIn('FROM VALUES (1, 101), (2, 100), (3, 101)', rank_sql)
+        self.assertIn('SELECT * FROM snapshot_100\n    UNION ALL\n    SELECT * FROM snapshot_101', rank_sql)
+        self.assertIn('SELECT 3 AS recs_account_id, item_group_id, id FROM reduced_101', rank_sql)
+        self.assertNotIn('product_catalog', rank_sql)
+        self.assertIn('PARTITION BY recs_account_id,country_code', rank_sql)
+        self.assertEqual(rank_sql.count('UNION ALL'), 5)
+        self.assertEqual(conn.execute.call_count, 1)
+        self.assertEqual([account_id for account_id, _, _ in ranked], [1, 2, 3])
+        self.assertEqual(ranked[0][1],
+                         '(SELECT * FROM scratch.recset_5_static_account_ranks WHERE recs_account_id = 1)')
+
+    def test_partitioned_unload_writes_manifest(self):
+        target = '@stage/recs_global/2020/08/19/recs_global-20200819T163500.000Z_PT1M-0-100-precompute_1_2.json.gz'
+        prefix = target[:-len('.json.gz')] + '/'
+        conn = mock.Mock()
+        conn.execute.return_value.fetchall.side_effect = [
+            [('part=0001/data_q_0_0_0.json.gz', 100, 3), ('part=0002/data_q_0_0_0.json.gz', 50, 1)],
+            [('s3://bucket/' + prefix[len('@stage/'):] + 'part=0001/data_q_0_0_0.json.gz', 100, 'md5a', ''),
+             ('s3://bucket/' + prefix[len('@stage/'):] + 'part=0002/data_q_0_0_0.json.gz', 50, 'md5b', '')],
+        ]
+        with mock.patch.object(precompute_utils, 'UNLOAD_MODE', 'partitioned'), \
+                mock.patch.object(precompute_utils, 'text', side_effect=lambda sql: sql):
+            options = precompute_utils.get_unload_options(precompute_utils.LOOKUP_KEY_PARTITION)
+            rows = precompute_utils.execute_unload(conn, 'COPY ' + options, target, shard_key=1)
+        self.assertIn("HASH($1:document:lookup_key)) % 16", options)
+        self.assertNotIn('SINGLE=TRUE', options)
+        conn.execute.assert_any_call('COPY ' + options, target=prefix, shard_key=1)
+        self.assertEqual(rows, 4)
+        manifest_call = conn.execute.call_args_list[-1]
+        self.assertEqual(manifest_call[1]['target'], target[:-len('.json.gz')] + '.manifest.json.gz')
+        self.assertEqual(json.loads(manifest_call[1]['manifest']), {'rows': 4, 'files': [
+            {'path': 'part=0001/data_q_0_0_0.json.gz', 'rows': 3, 'size': 100, 'md5': 'md5a'},
+            {'path': 'part=0002/data_q_0_0_0.json.gz', 'rows': 1, 'size': 50, 'md5': 'md5b'},
+        ]})
+
+    def test_unload_counts_come_from_copy_and_empty_results_unload_once(self):
+        recset = mock.Mock(id=5, geo_target=None)
+        unload_sql = precompute_utils.get_unload_sql(None, False)
+        paths = ('@stage/old.json.gz', '@stage/new.json.gz', '2020-08-19 16:35:00')
+        with mock.patch.object(precompute_utils, 'text', side_effect=lambda sql: sql), \
+                mock.patch.object(precompute_utils, 'create_unload_target_path', return_value=paths), \
+                mock.patch.object(precompute_utils, 'get_single_value_query', side_effect=[0, 7, 7, 7]), \
+                mock.patch.object(precompute_utils, 'get_shard_key', return_value=1):
+            conn = mock.Mock()
+            self.assertEqual(precompute_utils.unload_recset_account(conn, recset, 1, 'ranks', unload_sql,
+                                                                    unified_precompute=True), 0)
+            self.assertEqual(conn.execute.call_count, 2)
+            conn = mock.Mock()
+            self.assertEqual(precompute_utils.unload_recset_account(conn, recset, 1, 'ranks', unload_sql,
+                                                                    unified_precompute=True), 7)
+            self.assertEqual([call[1].get('target') for call in conn.execute.call_args_list],
+                             [None, paths[0], paths[1]])
+            conn = mock.Mock()
+            self.assertEqual(precompute_utils.unload_recset_account(conn, recset, 1, 'ranks', unload_sql), 7)
+            self.assertEqual([call[1]['target'] for call in conn.execute.call_args_list], [paths[0]])
+
+    def test_unified_precompute_documents_are_aggregated_once(self):
+        recset = mock.Mock(id=5, geo_target='country')
+        unload_sql = precompute_utils.get_unload_sql('country', True)
+        paths = ('@stage/old.json.gz', '@stage/new.json.gz', '2020-08-19 16:35:00')
+        with mock.patch.object(precompute_utils, 'text', side_effect=lambda sql: sql), \
+                mock.patch.object(precompute_utils, 'create_unload_target_path', return_value=paths), \
+                mock.patch.object(precompute_utils, 'get_single_value_query', return_value=3), \
+                mock.patch.object(precompute_utils, 'get_shard_key', return_value=1):
+            conn = mock.Mock()
+            precompute_utils.unload_recset_account(conn, recset, 1, 'scratch.recset_1_5_ranks', unload_sql,
+                                                   unified_precompute=True)
+        statements = [call[0][0] for call in conn.execute.call_args_list]
+        self.assertEqual([statement.count('array_agg') for statement in statements], [1, 0, 0])
+        self.assertIn('FROM scratch.recset_1_5_ranks\nGROUP BY country_code,split_product_type', statements[0])
+        self.assertIn("'feed_type', 'RECSET_NONCOLLAB_RECS'", statements[1])
+        self.assertIn("'pushdown_filter_hash', legacy_pushdown_filter_hash", statements[1])
+        self.assertIn("'feed_type', 'RECSET_RECS'", statements[2])
+        for statement in statements[1:]:
+            self.assertIn('FROM scratch.recset_1_5_documents', statement)
+
+    def test_half_pair_tables_are_ranked_in_both_directions(self):
+        vav = precompute_utils.get_pid_ranks_query('view_also_view', 1, None, None, 30, 'online')
+        self.assertIn('scratch.pid_ranks_view_also_view_1_None_None_30\n', vav)
+        self.assertEqual(vav.count('FROM scratch.view_also_view_1_None_None_30_online'), 3)
+        self.assertIn('SELECT account_id, pid2 AS pid1, pid1 AS pid2, score FROM scratch.view_also_view_1', vav)
+
+        bought_together = precompute_utils.get_pid_ranks_query('bought_together', 1, None, None, 30, 'online',
+                                                               pair_algorithm='purchase_also_purchase')
+        self.assertIn('scratch.pid_ranks_bought_together_1_None_None_30\n', bought_together)
+        self.assertEqual(bought_together.count('FROM scratch.purchase_also_purchase_1_None_None_30_online'), 2)
+        self.assertNotIn('UNION ALL', bought_together)
+
+    def test_half_pair_tables_are_limited_per_direction_before_ranking(self):
+        vav = precompute_utils.get_pid_ranks_query('view_also_view', 1, None, None, 30, 'online', candidate_limit=500)
+        self.assertEqual(vav.count('FROM scratch.view_also_view_1_None_None_30_online'), 3)
+        self.assertIn('(PARTITION BY account_id, pid1 ORDER BY score DESC, pid2 DESC) <= 500\n'
+                      '                UNION ALL', vav)
+        self.assertIn('(PARTITION BY account_id, pid2 ORDER BY score DESC, pid1 DESC) <= 500\n', vav)
+        self.assertIn('QUALIFY ordinal <= 500', vav)
+
+    def test_pid_ranks_keep_more_candidates_for_filtered_recsets(self):
+        no_filters = '{"type": "and", "filters": []}'
+        static = json.dumps({"type": "and", "filters": [
+            {"type": "equal", "left": {"type": "field", "field": "brand"}, "right": {"type": "value", "value": ["a"]}}]})
+        by_product_type = json.dumps({"type": "and", "filters": [
+            {"type": "equal", "left": {"type": "field", "field": "product_type"},
+             "right": {"type": "function", "value": "items_from_base_recommendation"}}]})
+        with mock.patch.object(precompute_utils, 'PID_CANDIDATE_LIMIT', 500), \
+                mock.patch.object(precompute_utils, 'PID_FILTERED_CANDIDATE_LIMIT', 5000):
+            self.assertEqual(precompute_utils.get_filter_candidate_limit([no_filters, None]), 500)
+            self.assertEqual(precompute_utils.get_filter_candidate_limit([no_filters, static]), 5000)
+            self.assertEqual(precompute_utils.get_filter_candidate_limit(
+                [no_filters, json.dumps(precompute_utils.get_algo_filter_dict('bought_together'))]), 5000)
+            self.assertIsNone(precompute_utils.get_filter_candidate_limit([by_product_type]))
+
+        limited = precompute_utils.get_pid_ranks_query('purchase_also_purchase', 1, None, None, 30, 'online',
+                                                       candidate_limit=500)
+        self.assertIn('QUALIFY ordinal <= 500', limited)
+        self.assertNotIn('QUALIFY', precompute_utils.get_pid_ranks_query('purchase_also_purchase', 1, None, None, 30,
+                                                                         'online'))
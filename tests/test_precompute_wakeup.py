@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import threading
+
+import mock
+from monetate.test.testcases import TestCase
+
+from monetate_recommendations import precompute_wakeup
+
+
+class IdleBackoffTestCase(TestCase):
+
+    @mock.patch.object(precompute_wakeup.random, 'random', return_value=0)
+    def test_delay_doubles_up_to_max_and_resets(self, _):
+        backoff = precompute_wakeup.IdleBackoff(10, 60)
+        self.assertEqual([backoff.next_delay() for _ in range(5)], [10, 20, 40, 60, 60])
+        backoff.reset()
+        self.assertEqual(backoff.next_delay(), 10)
+
+    def test_delay_is_jittered_down(self):
+        backoff = precompute_wakeup.IdleBackoff(10, 60)
+        delays = [backoff.next_delay() for _ in range(20)]
+        self.assertTrue(all(30 <= delay <= 60 for delay in delays[3:]))
+        self.assertGreater(len(set(delays[3:])), 1)
+
+
+class WakeupChannelTestCase(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.wakeup_file = os.path.join(directory, 'wakeup')
+
+    def test_notify_sets_event(self):
+        event = threading.Event()
+        with mock.patch.object(precompute_wakeup, 'get_wakeup_file', return_value=self.wakeup_file):
+            channel = precompute_wakeup.get_wakeup_channel(event)
+            self.assertFalse(channel.consume())
+            self.assertTrue(precompute_wakeup.notify_workers())
+        with mock.patch.object(precompute_wakeup.time, 'sleep', side_effect=[None, SystemExit]):
+            with self.assertRaises(SystemExit):
+                channel.watch()
+        self.assertTrue(event.is_set())
+        self.assertTrue(channel.consume())
+        self.assertFalse(channel.consume())
+
+    def test_disabled_without_wakeup_file(self):
+        with mock.patch.object(precompute_wakeup, 'get_wakeup_file', return_value=None):
+            self.assertFalse(precompute_wakeup.notify_workers())
+            self.assertIsInstance(precompute_wakeup.get_wakeup_channel(threading.Event()),
+                                  precompute_wakeup.NullWakeupChannel)
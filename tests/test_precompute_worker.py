@@ -0,0 +1,279 @@
+import mock
+import monetate.recs.precompute_constants as precompute_constants
+from monetate.test.testcases import TestCase
+
+from monetate_recommendations import precompute_algo_map, precompute_worker
+from monetate_recommendations.precompute_heartbeat import StatusLogBuffer
+from monetate_recommendations.precompute_history import StageTimer
+
+
+class FakeRecommendation(object):
+    def __init__(self, rec_id):
+        self.id = rec_id
+        self.status = precompute_constants.STATUS_PROCESSING
+        self.attempts = 0
+        self.heartbeat_time = None
+        self.precompute_start_time = None
+        self.precompute_end_time = None
+        self.processing_time_seconds = None
+        self.products_returned = 0
+        self.process_complete = False
+        self.status_log = ''
+        self.saved = 0
+
+    def append_to_status_log(self, msg):
+        self.status_log += msg
+
+    def save(self, *args, **kwargs):
+        self.saved += 1
+
+
+class FakeThread(object):
+    def __init__(self, result=None, exception=None):
+        self.alive = True
+        self.result = result
+        self.exception = exception
+        self.message = None
+        self.traceback = ''
+        self.connector = None
+        self.stage_timer = StageTimer()
+
+    def is_alive(self):
+        return self.alive
+
+
+class PrecomputeWorkerSlotsTestCase(TestCase):
+
+    def setUp(self):
+        patch = mock.patch.object(precompute_worker, 'record_job')
+        self.record_job = patch.start()
+        self.addCleanup(patch.stop)
+
+    def _worker(self, recommendations, **kwargs):
+        worker = precompute_worker.PrecomputeWorker(**kwargs)
+        queue = list(recommendations)
+
+        def claim(recs_qs, count):
+            claimed = queue[:count]
+            del queue[:count]
+            return claimed
+
+        worker.model = mock.Mock()
+        worker.query_recommendations = mock.Mock()
+        worker.claim_recommendations = mock.Mock(side_effect=claim)
+        worker.start_work_thread = mock.Mock(side_effect=lambda rec: FakeThread(result=[rec.id]))
+        return worker
+
+    def test_fill_slots_claims_up_to_slot_count(self):
+        recs = [FakeRecommendation(i) for i in range(5)]
+        worker = self._worker(recs, slots=3)
+        self.assertTrue(worker.fill_slots())
+        self.assertEqual([slot.recommendation.id for slot in worker.work_slots], [0, 1, 2])
+        self.assertTrue(all(slot.recommendation.attempts == 1 for slot in worker.work_slots))
+        worker.claim_recommendations.assert_called_once_with(worker.query_recommendations.return_value, 3)
+        # every slot busy, nothing more is claimed
+        self.assertFalse(worker.fill_slots())
+
+    def test_reap_slots_finalizes_each_slot_independently(self):
+        recs = [FakeRecommendation(i) for i in range(2)]
+        worker = self._worker(recs, slots=2)
+        worker.fill_slots()
+        finished, running = worker.work_slots
+        finished.thread.alive = False
+        finished.thread.exception = ValueError('boom')
+        worker.reap_slots()
+        self.assertEqual(worker.work_slots, [running])
+        self.assertEqual(finished.recommendation.status, precompute_constants.STATUS_SYS_ERROR)
+        self.assertIsNotNone(finished.recommendation.precompute_end_time)
+        self.assertEqual(running.recommendation.status, precompute_constants.STATUS_PROCESSING)
+
+        running.thread.alive = False
+        worker.reap_slots()
+        self.assertEqual(worker.work_slots, [])
+        self.assertEqual(running.recommendation.status, precompute_constants.STATUS_COMPLETE)
+        self.assertEqual(running.recommendation.products_returned, 1)
+        self.assertEqual([call[0][0] for call in self.record_job.call_args_list],
+                         [finished.recommendation, running.recommendation])
+
+    def test_timed_out_slot_keeps_capacity_until_thread_exits(self):
+        recs = [FakeRecommendation(i) for i in range(3)]
+        worker = self._worker(recs, slots=1, job_max_time=60)
+        worker.fill_slots()
+        slot = worker.work_slots[0]
+        slot.start_time -= 120
+        worker.check_slot_timeouts()
+        self.assertTrue(slot.timed_out)
+        self.assertEqual(slot.recommendation.status, precompute_constants.STATUS_TIMEOUT_ERROR)
+        self.assertFalse(worker.fill_slots())
+
+        slot.thread.alive = False
+        worker.reap_slots()
+        self.assertEqual(slot.recommendation.status, precompute_constants.STATUS_TIMEOUT_ERROR)
+        self.assertTrue(worker.fill_slots())
+        worker.claim_recommendations.assert_called_with(worker.query_recommendations.return_value, 1)
+
+    def test_heartbeat_updates_all_slots_in_one_statement(self):
+        recs = [FakeRecommendation(i) for i in range(3)]
+        worker = self._worker(recs, slots=3)
+        worker.fill_slots()
+        worker.model.reset_mock()
+        worker.heartbeat_slots()
+        worker.model.objects.filter.assert_called_once_with(id__in=[0, 1, 2])
+        update = worker.model.objects.filter.return_value.update
+        self.assertEqual(list(update.call_args[1].keys()), ['heartbeat_time'])
+        self.assertTrue(all(rec.heartbeat_time is not None for rec in recs))
+        self.assertTrue(all(rec.saved == 0 for rec in recs))
+        # not due again until heartbeat_interval has passed
+        worker.heartbeat_slots()
+        self.assertEqual(worker.model.objects.filter.call_count, 1)
+
+    def test_status_log_written_at_stage_boundaries(self):
+        rec = FakeRecommendation(1)
+        worker = self._worker([rec], slots=1)
+        worker.fill_slots()
+        # claim and start lines are written together
+        worker.model.objects.filter.return_value.update.assert_called_once_with(status_log=rec.status_log)
+        self.assertEqual(len(rec.status_log.splitlines()), 1)
+        worker.model.reset_mock()
+        worker.log('stage 1', recommendation=rec)
+        worker.log('stage 2', recommendation=rec)
+        self.assertFalse(worker.model.objects.filter.called)
+        worker.work_slots[0].thread.alive = False
+        worker.reap_slots()
+        self.assertEqual(rec.saved, 1)
+        self.assertIn('stage 2', rec.status_log)
+        self.assertNotIn(rec.id, worker.status_logs)
+
+    def test_candidates_follow_priority_scorer(self):
+        recs = [FakeRecommendation(i) for i in range(3)]
+        worker = precompute_worker.PrecomputeWorker(priority_window=3)
+        worker.priority_scorer = mock.Mock()
+        worker.priority_scorer.order.side_effect = lambda candidates: list(reversed(candidates))
+        worker.priority_scorer.traffic_filter.return_value = None
+        recs_qs = mock.MagicMock()
+        recs_qs.order_by.return_value.__getitem__.return_value = recs
+        self.assertEqual([rec.id for rec in worker.get_candidates(recs_qs, 2)], [2, 1])
+        recs_qs.order_by.assert_called_once_with('precompute_end_time', 'id')
+        recs_qs.order_by.return_value.__getitem__.assert_called_once_with(slice(None, 3))
+
+    def test_candidates_include_stalest_recs_behind_traffic(self):
+        stalest = [FakeRecommendation(i) for i in range(2)]
+        hot = [FakeRecommendation(1), FakeRecommendation(7)]
+        worker = precompute_worker.PrecomputeWorker(priority_window=2)
+        worker.priority_scorer = mock.Mock()
+        worker.priority_scorer.order.side_effect = lambda candidates: candidates
+        recs_qs = mock.MagicMock()
+        recs_qs.order_by.return_value.__getitem__.return_value = stalest
+        recs_qs.filter.return_value.order_by.return_value.__getitem__.return_value = hot
+        self.assertEqual([rec.id for rec in worker.get_candidates(recs_qs)], [0, 1, 7])
+        recs_qs.filter.assert_called_once_with(worker.priority_scorer.traffic_filter.return_value)
+
+    def _claim(self, worker, recs_qs, count):
+        with mock.patch.object(precompute_worker, 'connections', mock.MagicMock()), \
+                mock.patch.object(precompute_worker, 'transaction'), \
+                mock.patch.object(precompute_worker, 'supports_skip_locked', return_value=True):
+            return worker.claim_recommendations(recs_qs, count)
+
+    def test_priority_claim_locks_only_the_recs_it_claims(self):
+        worker = precompute_worker.PrecomputeWorker()
+        worker.get_candidates = mock.Mock(return_value=[FakeRecommendation(i) for i in [5, 3, 8, 1]])
+        recs_qs = mock.MagicMock()
+        recs_qs.model.objects.filter.side_effect = lambda id__in: [FakeRecommendation(i) for i in id__in]
+        held_by_others = set([5, 8])
+        locked = []
+
+        def lock_ids(db_connection, ids_qs):
+            batch_ids = recs_qs.filter.call_args[1]['id__in']
+            locked.append(batch_ids)
+            return [rec_id for rec_id in batch_ids if rec_id not in held_by_others]
+
+        worker.lock_ids = mock.Mock(side_effect=lock_ids)
+        self.assertEqual([rec.id for rec in self._claim(worker, recs_qs, 2)], [3, 1])
+        # skipped candidates are replaced by the next best ones, never locked in bulk
+        self.assertEqual(locked, [[5, 3], [8], [1]])
+        self.assertFalse(worker.claim_contended)
+
+        held_by_others.update([3, 1])
+        self.assertEqual(self._claim(worker, recs_qs, 2), [])
+        self.assertTrue(worker.claim_contended)
+
+    def test_contended_claim_does_not_back_off(self):
+        worker = precompute_worker.PrecomputeWorker(contended_poll_interval=0, worker_max_time=0.05)
+        worker.idle_backoff = mock.Mock()
+        worker.wait_for_work = mock.Mock()
+
+        def poll():
+            worker.claim_contended = True
+
+        worker.poll = mock.Mock(side_effect=poll)
+        worker.do_work()
+        self.assertTrue(worker.poll.called)
+        self.assertFalse(worker.idle_backoff.next_delay.called)
+        worker.wait_for_work.assert_called_with(0)
+
+    def test_process_isolated_timeout_does_not_stop_worker(self):
+        rec = FakeRecommendation(1)
+        worker = self._worker([rec], isolation='process', job_max_time=0.01, heartbeat_interval=0.01)
+        thread = FakeThread()
+        thread.join = mock.Mock()
+        thread.connector = mock.Mock()
+        thread.connector.cleanup.side_effect = lambda: setattr(thread, 'alive', False)
+        worker.start_work_thread = mock.Mock(return_value=thread)
+        worker.recommendation = rec
+        self.assertIs(worker.run_work_thread(), thread)
+        thread.connector.cleanup.assert_called_once_with()
+        self.assertEqual(rec.status, precompute_constants.STATUS_TIMEOUT_ERROR)
+
+        worker.process_pool = None
+        thread.alive = True
+        with self.assertRaises(precompute_worker.JobTimeoutError):
+            worker.run_work_thread()
+
+
+class NoncollabQueueEntryTestCase(TestCase):
+
+    def test_entry_runs_its_active_recsets_for_its_account(self):
+        entry = mock.Mock(id=7, algorithm='view')
+        entry.account.id = 3
+        active, inactive = mock.Mock(id=1), mock.Mock(id=2)
+        view_algorithm = mock.Mock(return_value=[[10, 20]])
+        with mock.patch.dict(precompute_algo_map.FUNC_MAP, {'view': view_algorithm}), \
+                mock.patch.object(precompute_algo_map.precompute_utils, 'get_recset_ids',
+                                  return_value=[active, inactive]), \
+                mock.patch.object(precompute_algo_map, 'is_strategy_active', side_effect=lambda r: r is active):
+            self.assertEqual(precompute_algo_map.process_noncollab_queue_entry(entry), [10, 20])
+        view_algorithm.assert_called_once_with([active], account_ids=[3])
+
+
+class SkipLockedTestCase(TestCase):
+
+    def _supports(self, version_string, version):
+        db_connection = mock.MagicMock(alias='default', vendor='mysql', mysql_version=version)
+        db_connection.features.has_select_for_update_skip_locked = False
+        db_connection.cursor.return_value.__enter__.return_value.fetchone.return_value = [version_string]
+        with mock.patch.object(precompute_worker, '_mariadb_aliases', {}):
+            return precompute_worker.supports_skip_locked(db_connection)
+
+    def test_mariadb_needs_10_6(self):
+        self.assertTrue(self._supports('8.0.32', (8, 0, 32)))
+        self.assertFalse(self._supports('5.7.40-log', (5, 7, 40)))
+        self.assertFalse(self._supports('10.5.19-MariaDB-log', (10, 5, 19)))
+        self.assertTrue(self._supports('10.6.12-MariaDB', (10, 6, 12)))
+
+
+class StatusLogBufferTestCase(TestCase):
+
+    def test_keeps_most_recent_lines(self):
+        rec = FakeRecommendation(1)
+        rec.status_log = 'old 1\nold 2\n'
+        status_log = StatusLogBuffer(rec, max_lines=3)
+        status_log.append('new 1\n')
+        status_log.append('new 2\n')
+        self.assertEqual(status_log.status_log, 'old 2\nnew 1\nnew 2\n')
+        model = mock.Mock()
+        status_log.flush(model)
+        model.objects.filter.assert_called_once_with(id=1)
+        model.objects.filter.return_value.update.assert_called_once_with(status_log='old 2\nnew 1\nnew 2\n')
+        # nothing pending, nothing written
+        status_log.flush(model)
+        self.assertEqual(model.objects.filter.call_count, 1)
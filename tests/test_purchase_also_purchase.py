@@ -1,5 +1,7 @@
 import hashlib
 import json
+import mock
+import unittest
 import monetate.dio.models as dio_models
 import monetate.recs.models as recs_models
 from datetime import datetime, timedelta
@@ -7,6 +9,7 @@ from django.db.models import Q
 from monetate.warehouse.fact_generator import WarehouseFactsTestGenerator
 from monetate_caching.cache import invalidation_context
 
+from monetate_recommendations import pair_counts
 from .patch import patch_invalidations
 from .testcases import RecsTestCaseWithData
 
@@ -375,6 +378,18 @@ class PurchaseAlsoPurchaseTestCase(RecsTestCaseWithData):
         self._run_collab_recs_test('purchase_also_purchase', 2, recsets,
                                    expected_results, market=self.market, purchase_data_source="online_offline")
 
+
+@unittest.skipIf(pair_counts.sparse is None, 'scipy is not installed')
+class PurchaseAlsoPurchaseInProcessTestCase(PurchaseAlsoPurchaseTestCase):
+    """Runs the cases above with the pairs counted and ranked in process, which must give the same results."""
+
+    def setUp(self):
+        super(PurchaseAlsoPurchaseInProcessTestCase, self).setUp()
+        patch = mock.patch.object(pair_counts, 'IN_PROCESS_MAX_ROWS', 1000000)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+
 class PurchaseAlsoPurchaseFiltersTestCase(RecsTestCaseWithData):
     @classmethod
     @patch_invalidations
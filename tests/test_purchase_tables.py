@@ -0,0 +1,74 @@
+import datetime
+
+import mock
+from monetate.test.testcases import TestCase
+
+from monetate_recommendations import precompute_purchase_associated_pids, precompute_utils, purchase_tables
+
+
+class PurchaseTablesTestCase(TestCase):
+
+    def setUp(self):
+        for module in [precompute_purchase_associated_pids, precompute_utils]:
+            patch = mock.patch.object(module, 'text', side_effect=lambda sql: sql)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _builds(self, conn, prefix):
+        return [call for call in conn.execute.call_args_list
+                if call[0][0].lstrip().startswith('CREATE TEMPORARY TABLE IF NOT EXISTS ' + prefix)]
+
+    def _run(self, conn, algorithm, begin_fact_time=datetime.datetime(2020, 8, 1), source='online', datasets=()):
+        return precompute_purchase_associated_pids.run_purchase_queries(
+            1, [1], None, None, 30, algorithm, source, begin_fact_time, list(datasets), 1, conn)
+
+    def test_purchase_events_and_pairs_are_shared_by_algorithms(self):
+        conn = mock.Mock()
+        for algorithm in ['purchase_also_purchase', 'bought_together', 'subsequently_purchased']:
+            self.assertFalse(self._run(conn, algorithm))
+
+        self.assertEqual(len(self._builds(conn, 'scratch.last_purchase_per_mid_and_pid_1_None_None_30')), 1)
+        self.assertEqual(len(self._builds(conn, 'scratch.purchase_also_purchase_1_None_None_30_online')), 1)
+        self.assertEqual(self._builds(conn, 'scratch.bought_together_'), [])
+        self.assertEqual(len(self._builds(conn, 'scratch.subsequently_purchased_1_None_None_30_online')), 1)
+
+        # a new day rebuilds the events and the pairs read from them
+        self._run(conn, 'bought_together', begin_fact_time=datetime.datetime(2020, 8, 2))
+        self.assertEqual(len(self._builds(conn, 'scratch.last_purchase_per_mid_and_pid_1_None_None_30')), 2)
+        self.assertEqual(len(self._builds(conn, 'scratch.purchase_also_purchase_1_None_None_30_online')), 2)
+        conn.execute.assert_any_call('DROP TABLE IF EXISTS scratch.last_purchase_per_mid_and_pid_1_None_None_30')
+
+    def test_noncollab_offline_purchases_are_versioned(self):
+        conn = mock.Mock()
+        recset = mock.Mock(algorithm='purchase', purchase_data_source='offline', lookback_days=30)
+        offline_table = 'scratch.offline_purchase_per_customer_and_pid_1_None_None_30'
+
+        def build_noncollab(begin_fact_time):
+            precompute_utils.create_helper_query_for_non_collab_algorithm(
+                recset, 1, None, None, begin_fact_time, [1, 10], conn, account_ids=[1])
+
+        self._run(conn, 'purchase_also_purchase', source='offline', datasets=[1, 10])
+        build_noncollab(datetime.datetime(2020, 8, 1))
+        self.assertEqual(len(self._builds(conn, offline_table)), 1)
+
+        # a later window does not read the table left on the session
+        build_noncollab(datetime.datetime(2020, 8, 2))
+        self.assertEqual(len(self._builds(conn, offline_table)), 2)
+        conn.execute.assert_any_call('DROP TABLE IF EXISTS ' + offline_table)
+
+    def test_least_recently_used_table_is_dropped(self):
+        conn = mock.Mock()
+        build = mock.Mock()
+        with mock.patch.object(purchase_tables, 'SHARED_TABLES_PER_SESSION', 2):
+            for table in ['a', 'b', 'a', 'c']:
+                purchase_tables.ensure_table(conn, 'scratch.last_purchase_per_mid_and_pid_' + table, 1, build)
+        self.assertEqual(build.call_count, 3)
+        conn.execute.assert_called_with('DROP TABLE IF EXISTS scratch.last_purchase_per_mid_and_pid_b')
+
+    def test_disabled_sharing_rebuilds_tables(self):
+        conn = mock.Mock()
+        build = mock.Mock()
+        with mock.patch.object(purchase_tables, 'SHARED_PURCHASE_TABLES', False):
+            for _ in range(2):
+                self.assertTrue(purchase_tables.ensure_table(conn, 'scratch.purchase_also_purchase_1', 1, build))
+        self.assertEqual(build.call_count, 2)
@@ -1,12 +1,16 @@
 import hashlib
 import json
+import mock
+import unittest
 import monetate.dio.models as dio_models
 import monetate.recs.models as recs_models
 from datetime import datetime, timedelta
 from django.db.models import Q
+from monetate.test.testcases import TestCase
 from monetate.warehouse.fact_generator import WarehouseFactsTestGenerator
 from monetate_caching.cache import invalidation_context
 
+from monetate_recommendations import pair_counts, precompute_view_associated_pids
 from .patch import patch_invalidations
 from .testcases import RecsTestCaseWithData
 
@@ -251,6 +255,18 @@ class ViewAlsoViewTestCase(RecsTestCaseWithData):
             ]
         self._run_collab_recs_test('view_also_view', 7, recsets, expected_results, account=self.account)
 
+
+@unittest.skipIf(pair_counts.sparse is None, 'scipy is not installed')
+class ViewAlsoViewInProcessTestCase(ViewAlsoViewTestCase):
+    """Runs the cases above with the pairs counted and ranked in process, which must give the same results."""
+
+    def setUp(self):
+        super(ViewAlsoViewInProcessTestCase, self).setUp()
+        patch = mock.patch.object(pair_counts, 'IN_PROCESS_MAX_ROWS', 1000000)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+
 class ViewAlsoViewFiltersTestCase(RecsTestCaseWithData):
     @classmethod
     @patch_invalidations
@@ -362,4 +378,23 @@ class ViewAlsoViewFiltersTestCase(RecsTestCaseWithData):
                 ('TP-00004', [('SKU-00006', 1), ('SKU-00005', 2)]),
                 ('TP-00005', [('SKU-00004', 1)]),
             ]
-        self._run_collab_recs_test('view_also_view', 7, recsets, expected_results, account=self.account)
\ No newline at end of file
+        self._run_collab_recs_test('view_also_view', 7, recsets, expected_results, account=self.account)
+
+
+class DeviceViewCapTestCase(TestCase):
+
+    def test_no_cap_keeps_all_device_views(self):
+        self.assertEqual(precompute_view_associated_pids.get_device_view_limit([1, 2], cap=0, cap_by_account={}), '')
+
+    def test_global_cap_keeps_most_recent_views(self):
+        limit = precompute_view_associated_pids.get_device_view_limit([1, 2], cap=200, cap_by_account={},
+                                                                      sampling='recent')
+        self.assertEqual(limit, 'QUALIFY ROW_NUMBER() OVER (PARTITION BY p.account_id, p.mid_epoch, p.mid_ts, '
+                                'p.mid_rnd ORDER BY p.fact_time DESC, p.product_id) <= 200')
+
+    def test_account_caps_override_global_cap(self):
+        limit = precompute_view_associated_pids.get_device_view_limit([1, 2, 3], cap=0, cap_by_account={2: 50, 3: 80},
+                                                                      sampling='sample')
+        self.assertIn('ORDER BY HASH(p.product_id, p.mid_epoch, p.mid_ts, p.mid_rnd), p.product_id', limit)
+        self.assertTrue(limit.endswith(
+            '<= CASE p.account_id WHEN 1 THEN (:lookback / 30.0 * 1000) WHEN 2 THEN 50 WHEN 3 THEN 80 END'))
@@ -0,0 +1,123 @@
+import mock
+from monetate.test.testcases import TestCase
+
+from monetate_recommendations import warehouse_session
+
+
+class FakeEngine(object):
+    """Stands in for a snowflake engine; runs the before_cursor_execute listener for every statement."""
+
+    def __init__(self):
+        self.listeners = []
+        self.connections = []
+
+    def connect(self):
+        conn = mock.Mock()
+        conn.dialect.name = 'snowflake'
+        conn.statements = []
+
+        def execute(statement, *args, **kwargs):
+            for listener in self.listeners:
+                listener(conn, None, statement, None, None, False)
+            conn.statements.append(statement)
+
+        conn.execute.side_effect = execute
+        self.connections.append(conn)
+        return conn
+
+    def dispose(self):
+        pass
+
+
+class WarehouseSessionTestCase(TestCase):
+
+    def setUp(self):
+        self.engines = []
+
+        def create_engine(*args, **kwargs):
+            self.engines.append(FakeEngine())
+            return self.engines[-1]
+
+        patches = [
+            mock.patch.object(warehouse_session, 'create_engine', side_effect=create_engine),
+            mock.patch.object(warehouse_session.event, 'listen',
+                              side_effect=lambda engine, name, fn: engine.listeners.append(fn)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.pool = warehouse_session.WarehouseSessionPool(dsn='snowflake://test')
+
+    def _run_job(self, statements, query_tag='tag'):
+        with warehouse_session.use_warehouse_sessions(self.pool, query_tag):
+            with warehouse_session.warehouse_connection('QUERY2_WH') as conn:
+                for statement in statements:
+                    conn.execute(statement)
+        return conn
+
+    def test_connection_is_reused_and_temp_tables_dropped_between_jobs(self):
+        conn = self._run_job(['CREATE TEMPORARY TABLE IF NOT EXISTS scratch.view_1_30 AS SELECT 1',
+                              'CREATE TEMPORARY TABLE scratch.recset_1_2_ranks AS SELECT 1',
+                              'CREATE OR REPLACE TEMPORARY TABLE scratch.catalog_snapshot_1_10 AS SELECT 1',
+                              'CREATE TEMPORARY TABLE scratch.last_purchase_per_mid_and_pid_1 AS SELECT 1',
+                              'SELECT * FROM scratch.view_1_30'])
+        self.assertEqual(conn.statements, [
+            'use warehouse QUERY2_WH',
+            "alter session set query_tag = 'tag'",
+            'CREATE TEMPORARY TABLE IF NOT EXISTS scratch.view_1_30 AS SELECT 1',
+            'CREATE TEMPORARY TABLE scratch.recset_1_2_ranks AS SELECT 1',
+            'CREATE OR REPLACE TEMPORARY TABLE scratch.catalog_snapshot_1_10 AS SELECT 1',
+            'CREATE TEMPORARY TABLE scratch.last_purchase_per_mid_and_pid_1 AS SELECT 1',
+            'SELECT * FROM scratch.view_1_30',
+            'DROP TABLE IF EXISTS scratch.recset_1_2_ranks',
+            'DROP TABLE IF EXISTS scratch.view_1_30',
+            'alter session unset query_tag',
+        ])
+        del conn.statements[:]
+        self.assertIs(self._run_job(['SELECT 1'], query_tag='other'), conn)
+        self.assertEqual(conn.statements, ["alter session set query_tag = 'other'", 'SELECT 1',
+                                           'alter session unset query_tag'])
+        self.assertEqual(len(self.engines), 1)
+
+    def test_job_gets_session_that_last_ran_its_affinity(self):
+        with warehouse_session.use_warehouse_sessions(self.pool, 'a', affinity=(1, 2, 0, 30)):
+            with warehouse_session.warehouse_connection('QUERY2_WH') as first:
+                with warehouse_session.use_warehouse_sessions(self.pool, 'b', affinity=(3, 2, 0, 30)):
+                    with warehouse_session.warehouse_connection('QUERY2_WH') as second:
+                        pass
+        # first was released last, but second last ran (3, 2, 0, 30)
+        with warehouse_session.use_warehouse_sessions(self.pool, 'c', affinity=(3, 2, 0, 30)):
+            with warehouse_session.warehouse_connection('QUERY2_WH') as conn:
+                self.assertIs(conn, second)
+        # a job without affinity leaves the affinity of its session alone
+        self.assertIs(self._run_job([]), second)
+        with warehouse_session.use_warehouse_sessions(self.pool, 'd', affinity=(1, 2, 0, 30)):
+            with warehouse_session.warehouse_connection('QUERY2_WH') as conn:
+                self.assertIs(conn, first)
+        with warehouse_session.use_warehouse_sessions(self.pool, 'e', affinity=(3, 2, 0, 30)):
+            with warehouse_session.warehouse_connection('QUERY2_WH') as conn:
+                self.assertIs(conn, second)
+
+    def test_session_of_failed_job_is_closed(self):
+        with self.assertRaises(ValueError):
+            with warehouse_session.use_warehouse_sessions(self.pool):
+                with warehouse_session.warehouse_connection('QUERY2_WH'):
+                    raise ValueError()
+        self.engines[0].connections[0].close.assert_called_once_with()
+        self.assertEqual(self.pool.idle, [])
+
+    def test_expired_session_reconnects(self):
+        self.pool.max_age = -1
+        self._run_job([])
+        self._run_job([])
+        self.assertEqual(len(self.engines), 2)
+        self.engines[0].connections[0].close.assert_called_once_with()
+
+    def test_no_active_pool_opens_connection_per_job(self):
+        with warehouse_session.warehouse_connection('QUERY2_WH'):
+            pass
+        with warehouse_session.warehouse_connection('QUERY2_WH'):
+            pass
+        self.assertEqual(len(self.engines), 2)
+        for engine in self.engines:
+            engine.connections[0].close.assert_called_once_with()